@@ -0,0 +1,61 @@
+from django.contrib.auth.models import Group, Permission
+from django.db.models import Q
+
+
+class UserAccess(object):
+    """
+    Group names and permissions of one user, loaded once and memoized.
+
+    Kept on the user object, so it lives as long as the request's user.
+    """
+
+    def __init__(self, user, groups=None):
+        self.user = user
+        self._groups = frozenset(groups) if groups is not None else None
+
+    @property
+    def groups(self):
+        if self._groups is None:
+            if self.user.is_authenticated:
+                self._groups = frozenset(Group.objects.filter(user=self.user).values_list('name', flat=True))
+            else:
+                self._groups = frozenset()
+        return self._groups
+
+    def in_group(self, *names):
+        return not self.groups.isdisjoint(names)
+
+    def has_perm(self, perm):
+        return self.has_perms([perm])
+
+    def has_perms(self, perm_list):
+        if not (self.user.is_active and self.user.is_authenticated):
+            return False
+        if self.user.is_superuser:
+            return True
+        return all(perm in self.permissions for perm in perm_list)
+
+    @property
+    def permissions(self):
+        """
+        Same set as ModelBackend.get_all_permissions, but in one query.
+        """
+        if not hasattr(self.user, '_perm_cache'):
+            perms = Permission.objects.filter(
+                Q(user=self.user) | Q(group__user=self.user)
+            ).values_list('content_type__app_label', 'codename').distinct()
+            self.user._perm_cache = {f'{app_label}.{codename}' for app_label, codename in perms}
+        return self.user._perm_cache
+
+    def prefetch(self):
+        groups = self.groups
+        permissions = self.permissions if self.user.is_authenticated else set()
+        return groups, permissions
+
+
+def get_user_access(user):
+    access = getattr(user, '_access', None)
+    if access is None:
+        access = UserAccess(user)
+        user._access = access
+    return access
@@ -1,22 +1,125 @@
-from .models import CSUser
+import datetime
 
+from django.conf import settings
+from django.core import signing
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.db.models import EmailField, Func, Q
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+from rest_framework import authentication, exceptions
 
-class EmailAuthBackend(object):
+from main_app.metrics import record_cache_lookup
+
+from .access import UserAccess, get_user_access
+from .models import CSUser, RevokedAPIToken
+
+API_TOKEN_SALT = 'auth_app.api_token'
+REVOKED_API_TOKENS_CACHE_KEY = 'auth_app.revoked_api_tokens'
+
+
+class NormalizedEmail(Func):
     """
-    Authenticate using an e-mail address.
+    Lower-cased email, NULL when blank. Matches the unique index on CSUser.
     """
+    template = "NULLIF(LOWER(%(expressions)s), '')"
+    output_field = EmailField()
 
-    def authenticate(self, request, username=None, password=None):
-        try:
-            user = CSUser.objects.get(email=username)
-            if user.check_password(password):
-                return user
+
+class UsernameOrEmailBackend(ModelBackend):
+    """
+    Authenticate using a username or a case-insensitive e-mail address.
+
+    Both are looked up in one indexed query and the password is hashed once.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(CSUser.USERNAME_FIELD)
+        if username is None or password is None:
             return None
-        except CSUser.DoesNotExist:
+        users = list(CSUser._default_manager.annotate(normalized_email=NormalizedEmail('email')).filter(
+            Q(username=username) | Q(normalized_email=username.lower()))[:2])
+        # a username match wins over another user's e-mail
+        user = next((user for user in users if user.username == username), users[0] if users else None)
+        if user is None:
+            # hash once anyway, so a missing user takes as long as a wrong password
+            CSUser().set_password(password)
             return None
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
 
-    def get_user(self, user_id):
-        try:
-            return CSUser.objects.get(pk=user_id)
-        except CSUser.DoesNotExist:
+
+def issue_api_token(user):
+    """
+    Returns a signed token carrying the user id, flags and permissions.
+    """
+    payload = {
+        'jti': get_random_string(16),
+        'uid': user.pk,
+        'name': user.get_username(),
+        'staff': user.is_staff,
+        'super': user.is_superuser,
+        'perms': sorted(get_user_access(user).permissions),
+        'groups': sorted(get_user_access(user).groups),
+    }
+    return signing.dumps(payload, salt=API_TOKEN_SALT, compress=True)
+
+
+def load_api_token(token):
+    """
+    Returns the token payload, raises signing.BadSignature if it is forged or expired.
+    """
+    return signing.loads(token, salt=API_TOKEN_SALT, max_age=settings.API_TOKEN_MAX_AGE)
+
+
+def get_revoked_api_tokens():
+    revoked = cache.get(REVOKED_API_TOKENS_CACHE_KEY)
+    record_cache_lookup('revoked_api_tokens', revoked is not None)
+    if revoked is None:
+        revoked = set(RevokedAPIToken.objects.filter(expires__gt=timezone.now()).values_list('jti', flat=True))
+        cache.set(REVOKED_API_TOKENS_CACHE_KEY, revoked, settings.API_TOKEN_REVOCATION_CACHE_TIMEOUT)
+    return revoked
+
+
+def revoke_api_token(token):
+    payload = load_api_token(token)
+    expires = timezone.now() + datetime.timedelta(seconds=settings.API_TOKEN_MAX_AGE)
+    RevokedAPIToken.objects.get_or_create(jti=payload['jti'], defaults={'expires': expires})
+    cache.delete(REVOKED_API_TOKENS_CACHE_KEY)
+
+
+class APITokenAuthentication(authentication.BaseAuthentication):
+    """
+    Authenticate by a signed token: `Authorization: Bearer <token>`.
+
+    The user is rebuilt from the token, so no session or user query is made.
+    It is not a loaded row and must not be saved.
+    """
+    keyword = 'Bearer'
+
+    def authenticate(self, request):
+        auth = authentication.get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
             return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+        token = auth[1].decode()
+        try:
+            payload = load_api_token(token)
+        except signing.BadSignature:
+            raise exceptions.AuthenticationFailed('Invalid or expired token.')
+        if payload['jti'] in get_revoked_api_tokens():
+            raise exceptions.AuthenticationFailed('Token has been revoked.')
+
+        user = CSUser(id=payload['uid'], username=payload['name'], is_active=True,
+                      is_staff=payload['staff'], is_superuser=payload['super'])
+        user._state.adding = False
+        # read by ModelBackend.has_perm instead of querying the permissions
+        user._perm_cache = set(payload['perms'])
+        user._access = UserAccess(user, groups=payload['groups'])
+        return user, token
+
+    def authenticate_header(self, request):
+        return self.keyword
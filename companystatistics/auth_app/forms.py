@@ -33,6 +33,12 @@ class CSUserEditForm(UserChangeForm):
             if field_name == 'password':
                 field.widget = forms.HiddenInput()
 
+    def clean_email(self):
+        email = self.cleaned_data['email']
+        if email and CSUser.objects.filter(email__iexact=email).exclude(pk=self.instance.pk).exists():
+            raise forms.ValidationError('Пользователь с таким e-mail уже существует.')
+        return email
+
 
 class CSUserProfileEditForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware as BaseAuthenticationMiddleware
+from django.utils.functional import SimpleLazyObject
+
+from .access import get_user_access
+
+
+class AuthenticationMiddleware(BaseAuthenticationMiddleware):
+    """
+    Adds `request.user_access`, the memoized groups and permissions of `request.user`.
+
+    With PREFETCH_USER_ACCESS they are loaded up front for authenticated users.
+    """
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user_access = SimpleLazyObject(lambda: get_user_access(request.user))
+        if settings.PREFETCH_USER_ACCESS and request.user.is_authenticated:
+            request.user_access.prefetch()
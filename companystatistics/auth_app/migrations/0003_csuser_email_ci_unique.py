@@ -0,0 +1,27 @@
+from django.db import migrations
+
+
+def check_duplicate_emails(apps, schema_editor):
+    CSUser = apps.get_model('auth_app', 'CSUser')
+    emails = {}
+    for user_id, email in CSUser.objects.exclude(email='').values_list('id', 'email'):
+        emails.setdefault(email.lower(), []).append(user_id)
+    duplicates = {email: ids for email, ids in emails.items() if len(ids) > 1}
+    if duplicates:
+        raise ValueError(f'Users share an e-mail address, make them unique first: {duplicates}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth_app', '0002_revokedapitoken'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicate_emails, migrations.RunPython.noop),
+        # blank e-mails become NULL, which a unique index does not compare
+        migrations.RunSQL(
+            "CREATE UNIQUE INDEX auth_app_csuser_email_ci_uniq ON auth_app_csuser (NULLIF(LOWER(email), ''))",
+            'DROP INDEX auth_app_csuser_email_ci_uniq',
+        ),
+    ]
@@ -1,22 +1,28 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.utils.functional import cached_property
 
 
 class CSUser(AbstractUser):
-    pass
+    # e-mail is unique case-insensitively through an expression index, see migration 0003
 
+    @cached_property
+    def profile(self):
+        """
+        The user's profile, created on first access.
+        """
+        profile, created = CSUserProfile.objects.get_or_create(user=self)
+        return profile
 
-class CSUserProfile(models.Model):
 
-    user = models.OneToOneField(CSUser, unique=True, null=False, db_index=True, on_delete=models.CASCADE)
+class RevokedAPIToken(models.Model):
+    jti = models.CharField(max_length=32, unique=True)
+    expires = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.jti
 
-    @receiver(post_save, sender=CSUser)
-    def create_user_profile(sender, instance, created, **kwargs):
-        if created:
-            CSUserProfile.objects.create(user=instance)
 
-    @receiver(post_save, sender=CSUser)
-    def save_user_profile(sender, instance, **kwargs):
-        instance.csuserprofile.save()
+class CSUserProfile(models.Model):
+
+    user = models.OneToOneField(CSUser, unique=True, null=False, db_index=True, on_delete=models.CASCADE)
@@ -7,3 +7,12 @@ class CSUserSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = CSUser
         fields = ['id', 'username', 'first_name', 'email']
+
+
+class APITokenSerializer(serializers.Serializer):
+    username = serializers.CharField()
+    password = serializers.CharField(style={'input_type': 'password'}, trim_whitespace=False)
+
+
+class APITokenRevokeSerializer(serializers.Serializer):
+    token = serializers.CharField()
@@ -1,12 +1,14 @@
 from django import template
 
+from auth_app.access import get_user_access
+
 register = template.Library()
 
 
 @register.filter
 def in_group(user, groups):
     """Returns a boolean if the user is in the given group, or comma-separated
-    list of groups.
+    list of groups. The user's groups are loaded once per request.
 
     Usage::
 
@@ -21,8 +23,7 @@ def in_group(user, groups):
         {% endif %}
 
     """
-    if user.is_authenticated():
-        group_list = groups.split(',')
-        return bool(user.groups.filter(name__in=group_list).values('name'))
+    if user.is_authenticated:
+        return get_user_access(user).in_group(*groups.split(','))
     else:
         return False
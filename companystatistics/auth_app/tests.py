@@ -1,7 +1,20 @@
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import AnonymousUser, Group, Permission
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.template import Context, Template
 from django.test import TestCase
 from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase, APIRequestFactory
 
-from .models import CSUser
+from .access import get_user_access
+from .authentication import APITokenAuthentication, NormalizedEmail, get_revoked_api_tokens
+from .forms import CSUserEditForm
+from .models import CSUser, CSUserProfile
+from .templatetags.my_tags import in_group
 
 
 class TestCaseAdminLogin(TestCase):
@@ -112,3 +125,164 @@ class TestUserPagesNotLogin(TestCase):
     def test_user_edit(self):
         response = self.client.get('/auth/edit/')
         self.assertEqual(response.status_code, 302)
+
+
+class TestAPIToken(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = CSUser.objects.create_user(username='user', email='user@cs.local', password='user')
+        self.user.user_permissions.add(Permission.objects.get(codename='add_stat'))
+        response = self.client.post(reverse('auth_app:api_token'), {'username': 'user', 'password': 'user'})
+        self.assertEqual(response.status_code, 200)
+        self.token = response.data['token']
+
+    def test_wrong_password(self):
+        response = self.client.post(reverse('auth_app:api_token'), {'username': 'user', 'password': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_no_session_or_user_queries(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        get_revoked_api_tokens()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('auth_app:csuser-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 2)  # the page count and rows of the user list itself
+        for query in queries:
+            self.assertNotIn('django_session', query['sql'])
+
+    def test_permissions_from_token(self):
+        user, token = APITokenAuthentication().authenticate(
+            APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {self.token}'))
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('stat_app.add_stat'))
+            self.assertFalse(user.has_perm('stat_app.delete_stat'))
+
+    def test_forged_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}x')
+        response = self.client.get(reverse('auth_app:csuser-list'))
+        self.assertEqual(response.status_code, 401)
+
+    def test_revoked_token(self):
+        response = self.client.post(reverse('auth_app:api_token_revoke'), {'token': self.token})
+        self.assertEqual(response.status_code, 204)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        response = self.client.get(reverse('auth_app:csuser-list'))
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(API_TOKEN_MAX_AGE=-1)
+    def test_expired_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        response = self.client.get(reverse('auth_app:csuser-list'))
+        self.assertEqual(response.status_code, 401)
+
+
+class TestUsernameOrEmailLogin(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        CSUser.objects.create_user(username='user', email='User@cs.local', password='user')
+        CSUser.objects.create_user(username='other@cs.local', email='other@cs.local', password='other')
+        CSUser.objects.create_user(username='blank', password='blank')
+        CSUser.objects.create_user(username='blank2', password='blank')
+
+    def test_login_by_username(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(authenticate(username='user', password='user').username, 'user')
+
+    def test_login_by_email_ignores_case(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(authenticate(username='user@CS.local', password='user').username, 'user')
+
+    def test_wrong_password(self):
+        self.assertIsNone(authenticate(username='user@cs.local', password='x'))
+        self.assertIsNone(authenticate(username='nobody', password='x'))
+
+    def test_username_wins_over_email(self):
+        CSUser.objects.filter(username='user').update(email='third@cs.local')
+        CSUser.objects.create_user(username='third@cs.local', email='', password='third')
+        self.assertEqual(authenticate(username='third@cs.local', password='third').username, 'third@cs.local')
+
+    def test_email_unique_ignoring_case(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CSUser.objects.create_user(username='copy', email='USER@cs.local', password='copy')
+
+    def test_email_lookup_uses_index(self):
+        plan = CSUser.objects.annotate(normalized_email=NormalizedEmail('email')).filter(
+            Q(username='user') | Q(normalized_email='user@cs.local')).explain()
+        self.assertNotIn('SCAN', plan)
+        self.assertIn('auth_app_csuser_email_ci_uniq', plan)
+
+    def test_edit_form_rejects_taken_email(self):
+        user = CSUser.objects.get(username='blank')
+        form = CSUserEditForm({'username': 'blank', 'email': 'OTHER@cs.local'}, instance=user)
+        self.assertFalse(form.is_valid())
+        self.assertIn('email', form.errors)
+
+
+class TestUserAccess(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CSUser.objects.create_user(username='user', email='user@cs.local', password='user')
+        group = Group.objects.create(name='editors')
+        group.permissions.add(Permission.objects.get(codename='change_stat'))
+        cls.user.groups.add(group)
+        cls.user.user_permissions.add(Permission.objects.get(codename='add_stat'))
+
+    def test_in_group_one_query(self):
+        user = CSUser.objects.get(username='user')
+        nav = Template('{% load my_tags %}' + ''.join(
+            f'{{% if user|in_group:"group{i},editors" %}}{i}{{% endif %}}' for i in range(20)))
+        with self.assertNumQueries(1):
+            rendered = nav.render(Context({'user': user}))
+        self.assertEqual(rendered, ''.join(str(i) for i in range(20)))
+
+    def test_in_group_anonymous(self):
+        self.assertFalse(in_group(AnonymousUser(), 'editors'))
+
+    def test_permissions_one_query(self):
+        user = CSUser.objects.get(username='user')
+        access = get_user_access(user)
+        with self.assertNumQueries(1):
+            self.assertTrue(access.has_perms(['stat_app.add_stat', 'stat_app.change_stat']))
+            self.assertFalse(access.has_perm('stat_app.delete_stat'))
+            self.assertTrue(user.has_perm('stat_app.change_stat'))
+
+    @override_settings(PREFETCH_USER_ACCESS=True)
+    def test_prefetch_in_middleware(self):
+        self.client.login(username='user', password='user')
+        request = self.client.get('/auth/profile/').wsgi_request
+        with self.assertNumQueries(0):
+            self.assertTrue(request.user_access.in_group('editors'))
+            self.assertTrue(request.user_access.has_perm('stat_app.add_stat'))
+
+
+class TestLazyProfile(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        CSUser.objects.create_user(username='user', email='user@cs.local', password='user')
+
+    def profile_queries(self, queries):
+        return [query['sql'] for query in queries if 'auth_app_csuserprofile' in query['sql']]
+
+    def test_login_does_not_touch_profile(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.client.login(username='user', password='user'))
+        self.assertEqual(self.profile_queries(queries), [])
+
+    def test_profile_created_on_first_access(self):
+        self.assertFalse(CSUserProfile.objects.exists())
+        self.client.login(username='user', password='user')
+        response = self.client.get('/auth/edit/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(CSUserProfile.objects.count(), 1)
+
+    def test_unchanged_edit_does_not_write(self):
+        self.client.login(username='user', password='user')
+        self.client.get('/auth/edit/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/auth/edit/', {'username': 'user', 'first_name': '', 'email': 'user@cs.local'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE')])
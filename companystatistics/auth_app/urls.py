@@ -10,6 +10,8 @@ router = routers.DefaultRouter()
 router.register(r'users', views.CSUserViewSet)
 
 urlpatterns = [
+    path('api/token/', views.APITokenView.as_view(), name='api_token'),
+    path('api/token/revoke/', views.APITokenRevokeView.as_view(), name='api_token_revoke'),
     path('api/', include(router.urls)),
 
     path('login/', views.UserLoginView.as_view(), name='login'),
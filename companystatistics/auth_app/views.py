@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import PasswordResetView, PasswordResetConfirmView, PasswordChangeView
@@ -6,11 +7,15 @@ from django.shortcuts import render, HttpResponseRedirect
 from django.urls import reverse, reverse_lazy
 from django.utils.decorators import method_decorator
 from django.views import View
-from rest_framework import viewsets, permissions, generics
+from django.core import signing
+from rest_framework import viewsets, permissions, generics, status
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from .authentication import issue_api_token, revoke_api_token
 from .forms import CSUserLoginForm, CSUserEditForm, CSUserProfileEditForm
 from .models import CSUser, CSUserProfile
-from .serializers import CSUserSerializer
+from .serializers import CSUserSerializer, APITokenSerializer, APITokenRevokeSerializer
 
 
 class UserLoginView(View):
@@ -78,7 +83,7 @@ class UserEditView(View):
     def get(self, request, *args, **kwargs):
         edit_form = self.edit_form(instance=request.user)
         profile_form = self.profile_form(
-            instance=request.user.csuserprofile
+            instance=request.user.profile
         )
 
         context = {
@@ -91,9 +96,12 @@ class UserEditView(View):
 
     def post(self, request, *args, **kwargs):
         edit_form = self.edit_form(request.POST, request.FILES, instance=request.user)
-        profile_form = self.profile_form(request.POST, instance=request.user.csuserprofile)
+        profile_form = self.profile_form(request.POST, instance=request.user.profile)
         if edit_form.is_valid() and profile_form.is_valid():
-            edit_form.save()
+            if edit_form.has_changed():
+                edit_form.save()
+            if profile_form.has_changed():
+                profile_form.save()
             return HttpResponseRedirect(reverse('auth_app:edit'))
 
         context = {
@@ -115,7 +123,7 @@ class UserProfileView(View):
     def get(self, request, *args, **kwargs):
         edit_form = self.edit_form(instance=request.user)
         profile_form = self.profile_form(
-            instance=request.user.csuserprofile
+            instance=request.user.profile
         )
 
         context = {
@@ -146,3 +154,34 @@ class CSUserViewSet(viewsets.ModelViewSet):
     queryset = CSUser.objects.all().order_by('-date_joined')
     serializer_class = CSUserSerializer
     permission_classes = [permissions.IsAuthenticated]
+
+
+class APITokenView(APIView):
+    """
+    API endpoint that exchanges username and password for a signed API token.
+    """
+    permission_classes = [permissions.AllowAny]
+
+    def post(self, request, *args, **kwargs):
+        serializer = APITokenSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user = authenticate(request, **serializer.validated_data)
+        if not user:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        return Response({'token': issue_api_token(user), 'expires_in': settings.API_TOKEN_MAX_AGE})
+
+
+class APITokenRevokeView(APIView):
+    """
+    API endpoint that revokes an API token before it expires.
+    """
+    permission_classes = [permissions.AllowAny]
+
+    def post(self, request, *args, **kwargs):
+        serializer = APITokenRevokeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            revoke_api_token(serializer.validated_data['token'])
+        except signing.BadSignature:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,175 @@
+import datetime
+import json
+import os
+import subprocess
+import time
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver, get_resolver, reverse
+
+from auth_app.authentication import issue_api_token
+from auth_app.models import CSUser
+from stat_app.generating import generate
+from stat_app.models import Department, Stat, StatTitle
+
+RESULTS_PATH = os.environ.get('BENCHMARK_RESULTS',
+                              os.path.join(os.path.dirname(__file__), 'results', 'budgets.jsonl'))
+
+# (companies, departments, stat titles, stats) of each dataset
+DATASETS = {
+    'small': (1, 2, 2, 5),
+    'large': (3, 6, 5, 60),
+}
+
+# URL name: (method, path of the context, data of the context or None, query budget)
+CASES = {
+    'department_list': ('get', lambda c: reverse('department_list'), None, 4),
+    'stat_app:department_list_company': (
+        'get', lambda c: reverse('stat_app:department_list_company', args=[c['company'].slug]), None, 5),
+    'stat_app:department_detail': (
+        'get', lambda c: reverse('stat_app:department_detail', args=[c['department'].slug]), None, 7),
+    'stat_app:stat_title_create': (
+        'get', lambda c: reverse('stat_app:stat_title_create', args=[c['department'].id]), None, 3),
+    'stat_app:stat_create': ('get', lambda c: reverse('stat_app:stat_create', args=[c['stat_title'].id]), None, 3),
+    'stat_app:stat_edit': ('get', lambda c: reverse('stat_app:stat_edit', args=[c['stat'].id]), None, 4),
+    'stat_app:api-data': ('get', lambda c: f'{reverse("stat_app:api-data")}?department={c["department"].id}',
+                          None, 3),
+    'stat_app:api-changes': ('get', lambda c: reverse('stat_app:api-changes'), None, 4),
+    'stat_app:api-live': ('get', lambda c: f'{reverse("stat_app:api-live")}?department={c["department"].id}',
+                          None, 2),
+    'stat_app:api-batch': ('post', lambda c: reverse('stat_app:api-batch'), lambda c: {'requests': [
+        {'path': reverse('stat_app:stat-detail', args=[c['stat'].id])},
+        {'path': reverse('stat_app:company-list')},
+    ]}, 6),
+    'stat_app:api-dashboard': ('get', lambda c: f'{reverse("stat_app:api-dashboard", args=[c["company"].slug])}'
+                                                '?date_from=2015-01-01&date_to=2015-12-31', None, 7),
+    'stat_app:api-root': ('get', lambda c: reverse('stat_app:api-root'), None, 2),
+    'stat_app:company-list': ('get', lambda c: reverse('stat_app:company-list'), None, 5),
+    'stat_app:company-detail': ('get', lambda c: reverse('stat_app:company-detail', args=[c['company'].id]),
+                                None, 4),
+    'stat_app:company-tree': ('post', lambda c: reverse('stat_app:company-tree'), lambda c: {'companies': [
+        {'slug': c['company'].slug, 'title': c['company'].title, 'departments': [
+            {'slug': c['department'].slug, 'title': c['department'].title,
+             'stat_titles': [{'title': 'Новая форма'}]}]}]}, 11),
+    'stat_app:department-list': ('get', lambda c: reverse('stat_app:department-list'), None, 5),
+    'stat_app:department-detail': (
+        'get', lambda c: reverse('stat_app:department-detail', args=[c['department'].id]), None, 4),
+    'stat_app:stattitle-list': ('get', lambda c: reverse('stat_app:stattitle-list'), None, 5),
+    'stat_app:stattitle-detail': (
+        'get', lambda c: reverse('stat_app:stattitle-detail', args=[c['stat_title'].id]), None, 4),
+    'stat_app:stat-list': ('get', lambda c: f'{reverse("stat_app:stat-list")}?title={c["stat_title"].id}',
+                           None, 4),
+    'stat_app:stat-detail': ('get', lambda c: reverse('stat_app:stat-detail', args=[c['stat'].id]), None, 3),
+    'stat_app:stat-bulk': ('patch', lambda c: reverse('stat_app:stat-bulk'),
+                           lambda c: [{'id': c['stat'].id, 'amount': 5}], 9),
+    'auth_app:api_token': ('post', lambda c: reverse('auth_app:api_token'),
+                           lambda c: {'username': 'editor', 'password': 'editor'}, 5),
+    'auth_app:api_token_revoke': ('post', lambda c: reverse('auth_app:api_token_revoke'),
+                                  lambda c: {'token': c['token']}, 4),
+    'auth_app:api-root': ('get', lambda c: reverse('auth_app:api-root'), None, 2),
+    'auth_app:csuser-list': ('get', lambda c: reverse('auth_app:csuser-list'), None, 4),
+    'auth_app:csuser-detail': ('get', lambda c: reverse('auth_app:csuser-detail', args=[c['user'].id]), None, 3),
+    'auth_app:login': ('get', lambda c: reverse('auth_app:login'), None, 2),
+    'auth_app:logout': ('get', lambda c: reverse('auth_app:logout'), None, 4),
+    'auth_app:edit': ('get', lambda c: reverse('auth_app:edit'), None, 4),
+    'auth_app:profile': ('get', lambda c: reverse('auth_app:profile'), None, 4),
+}
+
+
+def url_names(patterns, namespace=None):
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            if pattern.namespace in ('stat_app', 'auth_app'):
+                yield from url_names(pattern.url_patterns, pattern.namespace)
+        elif isinstance(pattern, URLPattern) and pattern.name and namespace:
+            yield f'{namespace}:{pattern.name}'
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                              universal_newlines=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        return ''
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], LIVE_UPDATES=True)
+class QueryBudgetBenchmark(TestCase):
+    """
+    Queries and wall time of every view of stat_app and auth_app over a small
+    and a large generated dataset. Fails when a view exceeds its query budget
+    or makes more queries on the large one. Results are appended to
+    BENCHMARK_RESULTS (benchmarks/results/budgets.jsonl by default).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.editor = CSUser.objects.create_user(username='editor', password='editor', is_staff=True)
+
+    def context(self):
+        department = Department.objects.filter(slug__startswith='bench-').first()
+        stat_title = StatTitle.objects.filter(department=department).first()
+        return {
+            'company': department.company,
+            'department': department,
+            'stat_title': stat_title,
+            'stat': Stat.objects.filter(title=stat_title).first(),
+            'user': self.editor,
+            'token': issue_api_token(self.editor),
+        }
+
+    def measure(self, method, path, data):
+        cache.clear()
+        self.client.force_login(self.editor)
+        with transaction.atomic(), CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = getattr(self.client, method)(path, data, content_type='application/json') \
+                if data is not None else getattr(self.client, method)(path)
+            seconds = time.perf_counter() - start
+            response.close()
+            # every case sees the same data
+            transaction.set_rollback(True)
+        self.assertLess(response.status_code, 400, path)
+        queries = [query for query in captured if 'SAVEPOINT' not in query['sql']]
+        return len(queries), seconds
+
+    def run_dataset(self, sizes):
+        with transaction.atomic():
+            generate(self.editor, *sizes, prefix='bench')
+            context = self.context()
+            results = {}
+            for name, (method, path, data, _) in CASES.items():
+                results[name] = self.measure(method, path(context), data(context) if data else None)
+            transaction.set_rollback(True)
+        return results
+
+    def test_budgets(self):
+        self.assertEqual(set(url_names(get_resolver().url_patterns)) - set(CASES), set(),
+                         'views without a query budget')
+
+        results = {name: self.run_dataset(sizes) for name, sizes in DATASETS.items()}
+
+        print(f'\n{"view":<36} {"budget":>6} ' + ' '.join(f'{name:>18}' for name in DATASETS))
+        for name, (_, _, _, budget) in CASES.items():
+            measured = [results[dataset][name] for dataset in DATASETS]
+            timings = ' '.join(f'{queries:>5} q {seconds * 1000:>8.1f} ms' for queries, seconds in measured)
+            print(f'{name:<36} {budget:>6} {timings}')
+
+        os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+        with open(RESULTS_PATH, 'a') as f:
+            f.write(json.dumps({
+                'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                'revision': git_revision(),
+                'datasets': DATASETS,
+                'results': {dataset: {name: {'queries': queries, 'ms': round(seconds * 1000, 2)}
+                                      for name, (queries, seconds) in views.items()}
+                            for dataset, views in results.items()},
+            }) + '\n')
+
+        for name, (_, _, _, budget) in CASES.items():
+            small, large = results['small'][name][0], results['large'][name][0]
+            self.assertLessEqual(large, small, f'{name} queries grow with the data')
+            self.assertLessEqual(large, budget, f'{name} is over its query budget')
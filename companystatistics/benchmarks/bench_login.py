@@ -0,0 +1,60 @@
+import time
+
+from django.contrib.auth import authenticate
+from django.contrib.auth.hashers import MD5PasswordHasher
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from auth_app.models import CSUser
+
+
+class CountingHasher(MD5PasswordHasher):
+    algorithm = 'counting_md5'
+    calls = 0
+
+    def encode(self, password, salt):
+        CountingHasher.calls += 1
+        return super().encode(password, salt)
+
+
+@override_settings(PASSWORD_HASHERS=['benchmarks.bench_login.CountingHasher'])
+class LoginBenchmark(TestCase):
+    """
+    Login throughput, queries and hasher runs per login by username and by e-mail.
+
+    A cheap hasher is used so the lookup cost is not hidden by PBKDF2.
+    """
+    users = 10000
+    logins = 2000
+
+    @classmethod
+    def setUpTestData(cls):
+        template = CSUser()
+        template.set_password('password')
+        CSUser.objects.bulk_create([
+            CSUser(username=f'user{i}', email=f'user{i}@cs.local', password=template.password)
+            for i in range(cls.users)
+        ])
+
+    def measure(self, username, password):
+        CountingHasher.calls = 0
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for i in range(self.logins):
+                authenticate(username=username(i), password=password)
+            seconds = time.perf_counter() - start
+        return self.logins / seconds, len(queries) / self.logins, CountingHasher.calls / self.logins
+
+    def test_login(self):
+        results = {
+            'username': self.measure(lambda i: f'user{i}', 'password'),
+            'e-mail': self.measure(lambda i: f'USER{i}@cs.local', 'password'),
+            'wrong password': self.measure(lambda i: f'user{i}@cs.local', 'wrong'),
+            'unknown user': self.measure(lambda i: f'nobody{i}', 'password'),
+        }
+        print(f'\n{self.users} users, {self.logins} logins each')
+        for name, (per_second, queries, hashes) in results.items():
+            print(f'{name:<15} {per_second:>10.0f} logins/s {queries:>5.1f} queries {hashes:>5.1f} hashes')
+            self.assertEqual(queries, 1, name)
+            self.assertEqual(hashes, 1, name)
@@ -0,0 +1,42 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from auth_app.models import CSUser
+
+
+class ProfileQueriesBenchmark(TestCase):
+    """
+    Queries per login and per UserEditView.post, and how many of them touch the profile.
+    """
+    budgets = {
+        'login': 6,
+        'edit, unchanged': 5,
+        'edit, changed': 6,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        CSUser.objects.create_user(username='user', email='user@cs.local', password='user')
+
+    def measure(self, action):
+        with CaptureQueriesContext(connection) as captured:
+            action()
+        queries = [query for query in captured if 'SAVEPOINT' not in query['sql']]
+        profile = [query for query in queries if 'auth_app_csuserprofile' in query['sql']]
+        return len(queries), len(profile)
+
+    def test_queries(self):
+        results = {'login': self.measure(lambda: self.client.post('/auth/login/', {'username': 'user',
+                                                                                   'password': 'user'}))}
+        self.client.get('/auth/edit/')
+        data = {'username': 'user', 'first_name': '', 'email': 'user@cs.local'}
+        results['edit, unchanged'] = self.measure(lambda: self.client.post('/auth/edit/', data))
+        data['first_name'] = 'Имя'
+        results['edit, changed'] = self.measure(lambda: self.client.post('/auth/edit/', data))
+
+        print()
+        for name, (queries, profile) in results.items():
+            print(f'{name:<16} {queries:>3} queries, {profile} on the profile')
+            self.assertLessEqual(queries, self.budgets[name], name)
+        self.assertEqual(results['login'][1], 0)
@@ -0,0 +1,45 @@
+import datetime
+import time
+from decimal import Decimal
+
+from django.test import SimpleTestCase
+from rest_framework.renderers import JSONRenderer
+
+from stat_app.renderers import SERIES_RENDERER_CLASSES, to_stats_dict
+
+
+class SeriesRendererBenchmark(SimpleTestCase):
+    """
+    Encode time and payload size of the series formats against the chart JSON.
+    """
+    points = 100000
+    titles = 100
+
+    def setUp(self):
+        start = datetime.date(2010, 1, 1)
+        per_title = self.points // self.titles
+        self.series = {'titles': [], 'dates': [], 'amounts': []}
+        for title_id in range(1, self.titles + 1):
+            for day in range(per_title):
+                self.series['titles'].append(title_id)
+                self.series['dates'].append(start + datetime.timedelta(days=day))
+                self.series['amounts'].append(Decimal(title_id * day % 100000) / 100)
+
+    def measure(self, encode):
+        start = time.perf_counter()
+        payload = encode()
+        return time.perf_counter() - start, len(payload)
+
+    def test_encode(self):
+        results = {'json (stats_dict)': self.measure(
+            lambda: JSONRenderer().render({'stats_dict': to_stats_dict(self.series)}))}
+        for renderer_class in SERIES_RENDERER_CLASSES[1:]:
+            renderer = renderer_class()
+            results[renderer.format] = self.measure(lambda: renderer.render(self.series))
+
+        print(f'\n{self.points} points, {self.titles} stat titles')
+        for name, (seconds, size) in results.items():
+            print(f'{name:<20} {seconds * 1000:>8.1f} ms {size / 1024:>10.1f} KiB')
+        json_size = results['json (stats_dict)'][1]
+        for name, (seconds, size) in results.items():
+            self.assertLessEqual(size, json_size, name)
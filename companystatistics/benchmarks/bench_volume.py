@@ -0,0 +1,44 @@
+import time
+
+from django.test import TestCase
+from django.urls import reverse
+
+from auth_app.models import CSUser
+from stat_app.generating import generate
+from stat_app.models import Department
+
+
+class VolumeBenchmark(TestCase):
+    """
+    Response times of the department page, its chart data and the company
+    dashboard on a generated org.
+    """
+    departments = 10
+    titles = 10
+    stats = 1000
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = CSUser.objects.create_user(username='editor', password='editor', is_staff=True)
+        generate(owner, departments=cls.departments, titles=cls.titles, stats=cls.stats)
+
+    def measure(self, url):
+        start = time.perf_counter()
+        response = self.client.get(url)
+        seconds = time.perf_counter() - start
+        self.assertEqual(response.status_code, 200, url)
+        return seconds
+
+    def test_pages(self):
+        self.client.login(username='editor', password='editor')
+        department = Department.objects.filter(slug__startswith='gen-').first()
+        urls = {
+            'department page': reverse('stat_app:department_detail', args=[department.slug]),
+            'chart data': f'{reverse("stat_app:api-data")}?department={department.id}',
+            'dashboard, 1 year': f'{reverse("stat_app:api-dashboard", args=["gen-0"])}'
+                                 f'?date_from=2015-01-01&date_to=2015-12-31',
+        }
+        print(f'\n{self.departments * self.titles * self.stats} stats, '
+              f'{self.titles * self.stats} in the department')
+        for name, url in urls.items():
+            print(f'{name:<20} {self.measure(url) * 1000:>8.1f} ms')
@@ -45,11 +45,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main_app.middleware.MetricsMiddleware',
+    'main_app.middleware.QueryLogMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'auth_app.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -86,6 +88,20 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# у каждого процесса свой locmem кэш, при нескольких процессах нужен общий (memcached и т.п.)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# как долго хранятся фрагменты страниц со структурой компаний (сек.)
+ORG_CACHE_TIMEOUT = 60 * 5
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -145,13 +161,119 @@ EMAIL_FILE_PATH = 'tmp/email-messages/'
 # EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 AUTHENTICATION_BACKENDS = [
-    'django.contrib.auth.backends.ModelBackend',
-    'auth_app.authentication.EmailAuthBackend',
+    'auth_app.authentication.UsernameOrEmailBackend',
 ]
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'auth_app.authentication.APITokenAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10
 }
+
+# подписанные API токены: время жизни и как долго кэшируется список отозванных (сек.)
+API_TOKEN_MAX_AGE = 60 * 60 * 24
+API_TOKEN_REVOCATION_CACHE_TIMEOUT = 60
+
+# загружать группы и права пользователя в начале каждого запроса, а не при первой проверке
+PREFETCH_USER_ACCESS = False
+
+# сколько данных изменяется или удаляется одним запросом при массовых операциях API
+STAT_BULK_BATCH_SIZE = 1000
+
+# загруженные файлы (файлы импорта данных и отчеты об отклоненных строках)
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# импорт данных из CSV/XLSX в админке: сколько строк записывается за раз, выполнять ли в фоновом потоке
+# и через сколько секунд без хода загрузки она считается прерванной (поток погиб с процессом сервера)
+STAT_IMPORT_BATCH_SIZE = 5000
+STAT_IMPORT_IN_BACKGROUND = True
+STAT_IMPORT_STALE_AFTER = 600
+
+# лента изменений /stat/api/changes/: максимум записей на страницу и задержка (сек.),
+# за которую успевают завершиться транзакции, начатые раньше. Изменения транзакций
+# дольше задержки (массовые правки, загрузки) лента может пропустить
+CHANGE_FEED_PAGE_SIZE = 1000
+CHANGE_FEED_LAG = 5
+
+# живые обновления графиков /stat/api/live/: выключены по умолчанию, так как каждый открытый
+# поток занимает поток сервера, и включаются только с многопоточными или асинхронными
+# воркерами (gunicorn --worker-class gthread или gevent). Класс рассылки событий
+# (по умолчанию только внутри процесса), очередь событий на клиента,
+# интервал keepalive, длительность потока и пауза перед переподключением (сек.)
+LIVE_UPDATES = False
+STAT_BROADCASTER = 'stat_app.live.LocalBroadcaster'
+LIVE_QUEUE_SIZE = 100
+LIVE_KEEPALIVE = 15
+LIVE_STREAM_TIMEOUT = 30
+LIVE_RETRY = 3
+
+# сводка компании /stat/api/companies/<slug>/dashboard/: период по умолчанию и
+# максимальный период (дней), как долго хранится в кэше (сек.)
+DASHBOARD_PERIOD_DAYS = 30
+DASHBOARD_MAX_DAYS = 366
+DASHBOARD_CACHE_TIMEOUT = 60 * 5
+
+# пакетные запросы /stat/api/batch/: максимум запросов в пакете и потоков
+# для параллельного чтения
+BATCH_MAX_REQUESTS = 20
+BATCH_MAX_WORKERS = 4
+
+# метрики /metrics в формате Prometheus: классы, которые собирают метрики из базы
+# при каждом запросе. Процессы gunicorn пишут метрики в файлы каталога из переменной
+# окружения PROMETHEUS_MULTIPROC_DIR, без неё видны метрики только одного процесса
+METRICS_COLLECTORS = ['stat_app.metrics.ImportQueueCollector']
+
+# журнал медленных запросов к базе: запросы дольше порога (сек., None отключает журнал)
+# и случайная доля остальных, с планом EXPLAIN для медленных SELECT. Отчёт: manage.py slow_queries.
+# Файл журнала ротируется по размеру (байт) с заданным числом старых копий
+SLOW_QUERY_THRESHOLD = 0.2
+SLOW_QUERY_SAMPLE_RATE = 0.001
+SLOW_QUERY_EXPLAIN = False
+SLOW_QUERY_LOG = os.path.join(BASE_DIR, 'slow_queries.log')
+SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUP_COUNT = 5
+
+# тесты выполняются с выключенным журналом медленных запросов, чтобы не писать его в каталог проекта
+TEST_RUNNER = 'main_app.testing.TestRunner'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'slow_queries': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': SLOW_QUERY_LOG,
+            'maxBytes': SLOW_QUERY_LOG_MAX_BYTES,
+            'backupCount': SLOW_QUERY_LOG_BACKUP_COUNT,
+            'formatter': 'message',
+            'delay': True,
+        },
+    },
+    'loggers': {
+        'main_app.querylog': {
+            'handlers': ['slow_queries'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+# профилирование памяти через tracemalloc, замедляет работу: пиковая память каждого
+# запроса в /metrics и разница снимков кучи /memory/ для персонала; кадров в трассировке
+# и максимум строк в ответе /memory/
+MEMORY_PROFILING = False
+MEMORY_PROFILING_FRAMES = 1
+MEMORY_SNAPSHOT_MAX_LIMIT = 200
+
+# manage.py loadtest создаёт пользователей и данные в базе из настроек и запускается
+# только если база помечена как тестовая (или с --i-know)
+LOADTEST_DATABASE = False
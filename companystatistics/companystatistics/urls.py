@@ -16,6 +16,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from main_app.views import memory, metrics
 from stat_app.views import DepartmentListView
 
 urlpatterns = [
@@ -23,6 +24,8 @@ urlpatterns = [
     path('auth/', include('auth_app.urls', namespace='auth_app')),
     path('stat/', include('stat_app.urls', namespace='stat_app')),
     path('', DepartmentListView.as_view(), name='department_list'),
+    path('metrics', metrics, name='metrics'),
+    path('memory/', memory, name='memory'),
 
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
 ]
@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class MainAppConfig(AppConfig):
     name = 'main_app'
+
+    def ready(self):
+        from .memory import start_profiling
+        from .querylog import install_query_logger
+        connection_created.connect(install_query_logger)
+        start_profiling()
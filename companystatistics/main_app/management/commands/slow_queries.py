@@ -0,0 +1,91 @@
+import json
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+SORT_KEYS = {
+    'total': lambda statement: statement['total_ms'],
+    'count': lambda statement: statement['count'],
+    'mean': lambda statement: statement['mean_ms'],
+    'max': lambda statement: statement['max_ms'],
+}
+
+
+def aggregate(entries):
+    """
+    Groups log entries by normalized statement. Sampled entries count as
+    1 / sample_rate statements each.
+    """
+    statements = {}
+    for entry in entries:
+        weight = 1 / entry['sample_rate'] if entry.get('sample_rate') else 1
+        statement = statements.setdefault(entry['statement'], {
+            'statement': entry['statement'],
+            'sql': entry['sql'],
+            'count': 0,
+            'total_ms': 0,
+            'max_ms': 0,
+            'views': Counter(),
+            'frames': Counter(),
+            'explain': None,
+        })
+        statement['count'] += weight
+        statement['total_ms'] += weight * entry['ms']
+        statement['max_ms'] = max(statement['max_ms'], entry['ms'])
+        statement['views'][entry['view']] += 1
+        statement['frames'][entry['frame']] += 1
+        if entry.get('explain'):
+            statement['explain'] = entry['explain']
+    for statement in statements.values():
+        statement['count'] = round(statement['count'])
+        statement['mean_ms'] = round(statement['total_ms'] / statement['count'], 3) if statement['count'] else 0
+        statement['total_ms'] = round(statement['total_ms'], 3)
+        statement['views'] = statement['views'].most_common(3)
+        statement['frames'] = statement['frames'].most_common(3)
+    return list(statements.values())
+
+
+class Command(BaseCommand):
+    help = ('Aggregates the slow-query log into the top statements by total, count, mean or max time, '
+            'with the views and the app code running them and their latest EXPLAIN plan.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', help='the log file, SLOW_QUERY_LOG by default')
+        parser.add_argument('--top', type=int, default=10)
+        parser.add_argument('--sort', choices=sorted(SORT_KEYS), default='total')
+        parser.add_argument('--sampled', action='store_true',
+                            help='report the random sample of all statements instead of the slow ones')
+        parser.add_argument('--json', action='store_true', help='print the report as JSON')
+
+    def handle(self, *args, **options):
+        entries, skipped = [], 0
+        try:
+            with open(options['log'] or settings.SLOW_QUERY_LOG, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        skipped += 1
+                        continue
+                    if entry['slow'] != options['sampled']:
+                        entries.append(entry)
+        except OSError as e:
+            raise CommandError(e)
+        if skipped:
+            self.stderr.write(f'Skipped {skipped} lines that are not JSON.')
+
+        statements = sorted(aggregate(entries), key=SORT_KEYS[options['sort']], reverse=True)[:options['top']]
+        if options['json']:
+            self.stdout.write(json.dumps(statements, indent=2, ensure_ascii=False))
+            return
+        for rank, statement in enumerate(statements, 1):
+            self.stdout.write(f'#{rank} {statement["statement"]}  count {statement["count"]}  '
+                              f'total {statement["total_ms"]:.1f} ms  mean {statement["mean_ms"]:.1f} ms  '
+                              f'max {statement["max_ms"]:.1f} ms')
+            self.stdout.write(f'    {statement["sql"]}')
+            self.stdout.write('    views: ' + ', '.join(f'{view} ({count})' for view, count in statement['views']))
+            self.stdout.write('    at: ' + ', '.join(f'{frame} ({count})' for frame, count in statement['frames']))
+            if statement['explain']:
+                for line in statement['explain'].splitlines():
+                    self.stdout.write(f'    | {line}')
@@ -0,0 +1,95 @@
+"""
+Opt-in heap profiling with tracemalloc. With MEMORY_PROFILING, the metrics
+middleware observes the peak allocation of each request and /memory/
+diffs heap snapshots of the worker process.
+"""
+import datetime
+import os
+import threading
+import tracemalloc
+
+from django.conf import settings
+
+# allocations of the profiling itself and of imports
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+]
+
+lock = threading.Lock()
+# the snapshot the next one is compared to, and when it was taken
+baseline = {'snapshot': None, 'time': None}
+
+
+def start_profiling():
+    if settings.MEMORY_PROFILING and not tracemalloc.is_tracing():
+        tracemalloc.start(settings.MEMORY_PROFILING_FRAMES)
+
+
+class PeakMemory:
+    """
+    Peak of the traced memory over the block, above the memory at its start.
+    The peak is per process, so with threads serving requests concurrently
+    it includes their allocations too.
+
+    Before Python 3.9 there is no tracemalloc.reset_peak(), so a block that
+    stays under the earlier peak of the process is measured by the memory it
+    still holds at its end, a lower bound.
+    """
+
+    def __init__(self):
+        self.bytes = None
+
+    def __enter__(self):
+        self.tracing = tracemalloc.is_tracing()
+        if self.tracing:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.start, self.start_peak = tracemalloc.get_traced_memory()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.tracing and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.bytes = max((peak if peak > self.start_peak else current) - self.start, 0)
+
+
+def source_name(filename):
+    if filename.startswith(settings.BASE_DIR + os.sep):
+        return os.path.relpath(filename, settings.BASE_DIR)
+    return filename
+
+
+def diff_snapshot(group_by='lineno', limit=20):
+    """
+    Takes a heap snapshot and returns the `limit` file lines or files whose
+    allocations grew the most since the previous snapshot of the process,
+    or the largest ones on the first call. The snapshot is the next baseline.
+    """
+    snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+    now = datetime.datetime.now()
+    with lock:
+        previous, since = baseline['snapshot'], baseline['time']
+        baseline.update(snapshot=snapshot, time=now)
+
+    if previous is None:
+        stats = snapshot.statistics(group_by)
+    else:
+        stats = snapshot.compare_to(previous, group_by)
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'pid': os.getpid(),
+        'time': now.isoformat(timespec='seconds'),
+        'since': since.isoformat(timespec='seconds') if since else None,
+        'traced': {'current': current, 'peak': peak},
+        'stats': [{
+            'file': source_name(stat.traceback[0].filename),
+            'line': stat.traceback[0].lineno if group_by == 'lineno' else None,
+            'size': stat.size,
+            'size_diff': getattr(stat, 'size_diff', stat.size),
+            'count': stat.count,
+            'count_diff': getattr(stat, 'count_diff', stat.count),
+        } for stat in stats[:limit]],
+    }
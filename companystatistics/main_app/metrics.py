@@ -0,0 +1,93 @@
+"""
+Prometheus metrics of the app. With PROMETHEUS_MULTIPROC_DIR set in the
+environment, every worker process writes its samples to files there and
+/metrics sums them up, otherwise /metrics shows this process only.
+"""
+import os
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess
+
+# anything else would be a label value per client's whim
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+REQUEST_LATENCY = Histogram('django_http_request_duration_seconds',
+                            'Time to the response of a request, by URL name and method.',
+                            ['view', 'method'])
+REQUEST_QUERIES = Histogram('django_http_request_queries',
+                            'Database queries of a request, by URL name and method.',
+                            ['view', 'method'],
+                            buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, 233, 377, float('inf')))
+REQUEST_QUERY_TIME = Histogram('django_http_request_query_duration_seconds',
+                               'Time of the database queries of a request, by URL name and method.',
+                               ['view', 'method'])
+# observed with MEMORY_PROFILING only
+REQUEST_PEAK_MEMORY = Histogram('django_http_request_peak_memory_bytes',
+                                'Peak memory allocated by a request, by URL name and method.',
+                                ['view', 'method'],
+                                buckets=tuple(4 ** power for power in range(8, 16)) + (float('inf'),))
+
+CACHE_LOOKUPS = Counter('cache_lookups_total', 'Lookups of a cache.', ['cache'])
+CACHE_MISSES = Counter('cache_misses_total', 'Lookups of a cache that found nothing.', ['cache'])
+
+INGESTED_ROWS = Counter('stat_ingested_rows_total', 'Stats inserted in bulk, by source.', ['source'])
+INGEST_TIME = Counter('stat_ingest_duration_seconds_total', 'Time of the bulk stat inserts, by source.',
+                      ['source'])
+
+
+class QueryTimer:
+    """
+    Database execute wrapper counting the queries and their time.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+def observe_request(request, seconds, queries, memory):
+    match = request.resolver_match
+    labels = (match.view_name if match else 'unresolved',
+              request.method if request.method in METHODS else 'other')
+    REQUEST_LATENCY.labels(*labels).observe(seconds)
+    REQUEST_QUERIES.labels(*labels).observe(queries.count)
+    REQUEST_QUERY_TIME.labels(*labels).observe(queries.seconds)
+    if memory.bytes is not None:
+        REQUEST_PEAK_MEMORY.labels(*labels).observe(memory.bytes)
+
+
+def record_cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache).inc()
+    if not hit:
+        CACHE_MISSES.labels(cache).inc()
+
+
+def record_ingest(source, rows, seconds):
+    INGESTED_ROWS.labels(source).inc(rows)
+    INGEST_TIME.labels(source).inc(seconds)
+
+
+def render_metrics():
+    """
+    The metrics of all the worker processes, then those of METRICS_COLLECTORS,
+    in the Prometheus text format.
+    """
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    # collected per scrape, e.g. from the database, so the same for every process
+    scraped = CollectorRegistry()
+    for path in settings.METRICS_COLLECTORS:
+        scraped.register(import_string(path)())
+    return generate_latest(registry) + generate_latest(scraped)
@@ -0,0 +1,42 @@
+import time
+
+from django.db import connection
+
+from .memory import PeakMemory
+from .metrics import QueryTimer, observe_request
+from .querylog import set_request
+
+
+class MetricsMiddleware:
+    """
+    Observes the latency, the query count, the query time and, with
+    MEMORY_PROFILING, the peak memory of each request per URL name and
+    method. Goes first, to measure the other middleware too.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries), PeakMemory() as memory:
+            response = self.get_response(request)
+        observe_request(request, time.perf_counter() - start, queries, memory)
+        return response
+
+
+class QueryLogMiddleware:
+    """
+    Lets the slow-query log name the view of the request running a statement.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        set_request(request)
+        try:
+            return self.get_response(request)
+        finally:
+            set_request(None)
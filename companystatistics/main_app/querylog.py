@@ -0,0 +1,130 @@
+"""
+Slow-query log: statements over SLOW_QUERY_THRESHOLD, and a random
+SLOW_QUERY_SAMPLE_RATE of the others, are logged as JSON lines to the
+`main_app.querylog` logger with the calling view and app code line.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import closing
+
+from django.conf import settings
+from django.db import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+# the first frame of these apps is logged as the caller
+APP_DIRS = [os.path.join(settings.BASE_DIR, app) + os.sep for app in ('stat_app', 'auth_app')]
+
+# the request each thread serves, set by QueryLogMiddleware
+local = threading.local()
+
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'(?<![\w."])-?\d+(?:\.\d+)?\b')
+PLACEHOLDERS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+ROWS = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+SPACES = re.compile(r'\s+')
+
+
+def normalize(sql):
+    """
+    The statement with its literals and parameters as `?` and lists of them,
+    e.g. of IN or VALUES, as `(...)`, so its runs with other values match.
+    """
+    sql = STRING.sub('?', sql.replace('%s', '?'))
+    sql = NUMBER.sub('?', sql)
+    sql = ROWS.sub('(...)', PLACEHOLDERS.sub('(...)', sql))
+    return SPACES.sub(' ', sql).strip()
+
+
+def fingerprint(value):
+    return hashlib.md5(value.encode()).hexdigest()[:12]
+
+
+def set_request(request):
+    local.request = request
+
+
+def get_view():
+    request = getattr(local, 'request', None)
+    if request is None:
+        return None
+    match = request.resolver_match
+    return match.view_name if match else request.path
+
+
+def get_app_frame():
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if any(filename.startswith(app_dir) for app_dir in APP_DIRS):
+            return f'{os.path.relpath(filename, settings.BASE_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+def explain(connection, sql, params):
+    """
+    The plan of a SELECT in the format of QuerySet.explain(), run on a cursor
+    of its own, so it neither replaces the results nor is logged itself.
+    """
+    if not connection.features.supports_explaining_query_execution:
+        return None
+    try:
+        with closing(connection.create_cursor()) as cursor:
+            cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}', params)
+            return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+    except DatabaseError as e:
+        return f'EXPLAIN failed: {e}'
+
+
+class QueryLogger:
+    """
+    Database execute wrapper of the slow-query log. Failed statements raise
+    before they are timed, and are not logged.
+    """
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        result = execute(sql, params, many, context)
+        seconds = time.perf_counter() - start
+        threshold = settings.SLOW_QUERY_THRESHOLD
+        if threshold is None:
+            return result
+        slow = seconds >= threshold
+        if slow or random.random() < settings.SLOW_QUERY_SAMPLE_RATE:
+            self.log(sql, params, many, context['connection'], seconds, slow)
+        return result
+
+    def log(self, sql, params, many, connection, seconds, slow):
+        statement = normalize(sql)
+        entry = {
+            'time': datetime.datetime.now().isoformat(timespec='milliseconds'),
+            'database': connection.alias,
+            'ms': round(seconds * 1000, 3),
+            'slow': slow,
+            'statement': fingerprint(statement),
+            'sql': statement,
+            # whether the same values come again, without logging them
+            'params': None if many else fingerprint(repr(params)),
+            'view': get_view(),
+            'frame': get_app_frame(),
+        }
+        if not slow:
+            # each sampled entry stands for 1 / sample_rate statements
+            entry['sample_rate'] = settings.SLOW_QUERY_SAMPLE_RATE
+        elif settings.SLOW_QUERY_EXPLAIN and not many and statement.upper().startswith('SELECT'):
+            entry['explain'] = explain(connection, sql, params)
+        logger.info(json.dumps(entry, ensure_ascii=False))
+
+
+def install_query_logger(sender, connection, **kwargs):
+    if not any(isinstance(wrapper, QueryLogger) for wrapper in connection.execute_wrappers):
+        connection.execute_wrappers.append(QueryLogger())
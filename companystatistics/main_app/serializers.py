@@ -0,0 +1,7 @@
+from django.conf import settings
+from rest_framework import serializers
+
+
+class MemoryQuerySerializer(serializers.Serializer):
+    group_by = serializers.ChoiceField(['lineno', 'filename'], default='lineno')
+    limit = serializers.IntegerField(min_value=1, max_value=settings.MEMORY_SNAPSHOT_MAX_LIMIT, default=20)
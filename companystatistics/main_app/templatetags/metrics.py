@@ -0,0 +1,38 @@
+from django import template
+from django.templatetags.cache import CacheNode, do_cache
+
+from ..metrics import record_cache_lookup
+
+register = template.Library()
+
+LOOKUP = '_metered_cache_lookup'
+
+
+class MeteredCacheNode(CacheNode):
+
+    def render(self, context):
+        lookup = {'hit': True}
+        with context.push({LOOKUP: lookup}):
+            rendered = super().render(context)
+        record_cache_lookup(self.fragment_name, lookup['hit'])
+        return rendered
+
+
+class MissNode(template.Node):
+    # last in the fragment, which is only rendered on a miss
+
+    def render(self, context):
+        context[LOOKUP]['hit'] = False
+        return ''
+
+
+@register.tag('metered_cache')
+def do_metered_cache(parser, token):
+    """
+    {% cache %} that counts its lookups and misses per fragment name,
+    closed by {% endcache %} too.
+    """
+    node = do_cache(parser, token)
+    node.nodelist.append(MissNode())
+    return MeteredCacheNode(node.nodelist, node.expire_time_var, node.fragment_name, node.vary_on,
+                            node.cache_name)
@@ -1,3 +1,248 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from prometheus_client import REGISTRY, Counter
+from prometheus_client.values import MultiProcessValue
+
+from auth_app.models import CSUser
+from stat_app.models import Company, Department, StatImport, StatTitle
+
+from . import memory
+from .querylog import get_view, normalize
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.editor = CSUser.objects.create_user(username='editor', password='editor', is_staff=True)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.editor)
+
+    def test_request_metrics(self):
+        labels = {'view': 'department_list', 'method': 'GET'}
+        requests = sample('django_http_request_duration_seconds_count', **labels)
+        queries = sample('django_http_request_queries_sum', **labels)
+
+        self.client.get(reverse('department_list'))
+
+        self.assertEqual(sample('django_http_request_duration_seconds_count', **labels), requests + 1)
+        self.assertGreater(sample('django_http_request_queries_sum', **labels), queries)
+        self.assertEqual(sample('django_http_request_query_duration_seconds_count', **labels), requests + 1)
+
+    def test_unresolved_requests_share_a_label(self):
+        labels = {'view': 'unresolved', 'method': 'GET'}
+        requests = sample('django_http_request_duration_seconds_count', **labels)
+
+        self.client.get('/nowhere/')
+        self.client.get('/elsewhere/')
+
+        self.assertEqual(sample('django_http_request_duration_seconds_count', **labels), requests + 2)
+
+    def test_fragment_cache_hits(self):
+        lookups = sample('cache_lookups_total', cache='company_sidebar')
+        misses = sample('cache_misses_total', cache='company_sidebar')
+
+        first = self.client.get(reverse('department_list'))
+        second = self.client.get(reverse('department_list'))
+
+        self.assertEqual(sample('cache_lookups_total', cache='company_sidebar'), lookups + 2)
+        self.assertEqual(sample('cache_misses_total', cache='company_sidebar'), misses + 1)
+        self.assertEqual(first.content, second.content)
+
+    def test_endpoint(self):
+        StatImport.objects.create(owner=self.editor, file='imports/stats.csv')
+        self.client.get(reverse('department_list'))
+        self.client.logout()
+
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        content = response.content.decode()
+        self.assertIn('django_http_request_duration_seconds_bucket{', content)
+        self.assertIn('stat_import_jobs{status="pending"} 1.0', content)
+        self.assertIn('stat_import_jobs{status="running"} 0.0', content)
+
+    def test_worker_processes_are_summed(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+            for pid in (101, 102):
+                with mock.patch('prometheus_client.values.ValueClass', MultiProcessValue(lambda pid=pid: pid)):
+                    rows = Counter('stat_ingested_rows_total', '', ['source'], registry=None)
+                    rows.labels('import').inc(10)
+
+            response = self.client.get(reverse('metrics'))
+
+        self.assertIn('stat_ingested_rows_total{source="import"} 20.0', response.content.decode())
+
+
+class QueryLogTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.editor = CSUser.objects.create_user(username='editor', password='editor', is_staff=True)
+        company = Company.objects.create(title='Компания', slug='company')
+        cls.department = Department.objects.create(company=company, title='Отдел', slug='department')
+        StatTitle.objects.create(department=cls.department, title='Форма')
+
+    def setUp(self):
+        self.client.force_login(self.editor)
+
+    def get_entries(self, path):
+        with self.assertLogs('main_app.querylog') as logs:
+            self.client.get(path)
+        return [json.loads(record.getMessage()) for record in logs.records]
+
+    def test_normalize(self):
+        self.assertEqual(normalize('SELECT "t"."id" FROM "t" WHERE "t"."id" IN (%s, %s) AND "t"."a" = \'x\'  LIMIT 21'),
+                         'SELECT "t"."id" FROM "t" WHERE "t"."id" IN (...) AND "t"."a" = ? LIMIT ?')
+        self.assertEqual(normalize('INSERT INTO "t" ("a", "b") VALUES (%s, %s), (%s, %s)'),
+                         'INSERT INTO "t" ("a", "b") VALUES (...)')
+
+    @override_settings(SLOW_QUERY_THRESHOLD=0, SLOW_QUERY_EXPLAIN=True)
+    def test_slow_queries(self):
+        entries = self.get_entries(reverse('stat_app:api-data') + f'?department={self.department.id}')
+
+        entry = next(entry for entry in entries if '"stat_app_stat"' in entry['sql'])
+        self.assertTrue(entry['slow'])
+        self.assertEqual(entry['view'], 'stat_app:api-data')
+        self.assertRegex(entry['frame'], r'^stat_app/')
+        self.assertNotIn(str(self.department.id), entry['sql'].split('WHERE')[-1])
+        self.assertTrue(entry['explain'])
+        self.assertNotIn('sample_rate', entry)
+        self.assertIsNone(get_view())
+
+    @override_settings(SLOW_QUERY_THRESHOLD=60, SLOW_QUERY_SAMPLE_RATE=1)
+    def test_sampled_queries(self):
+        entries = self.get_entries(reverse('department_list'))
+
+        self.assertTrue(entries)
+        for entry in entries:
+            self.assertFalse(entry['slow'])
+            self.assertEqual(entry['sample_rate'], 1)
+            self.assertNotIn('explain', entry)
+
+    @override_settings(SLOW_QUERY_SAMPLE_RATE=1)
+    def test_disabled(self):
+        self.assertIsNone(settings.SLOW_QUERY_THRESHOLD)
+        with mock.patch('main_app.querylog.logger') as logger:
+            self.client.get(reverse('department_list'))
+        logger.info.assert_not_called()
+
+    def test_report(self):
+        entry = {'statement': 'a', 'sql': 'SELECT ?', 'view': 'stat_app:api-data', 'frame': 'stat_app/views.py:1 in f',
+                 'slow': True}
+        lines = [
+            dict(entry, ms=300),
+            dict(entry, ms=500, explain='SCAN TABLE stat_app_stat'),
+            dict(entry, statement='b', sql='SELECT ? + ?', ms=700),
+            dict(entry, statement='c', ms=2, slow=False, sample_rate=0.01),
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.log', delete=False) as f:
+            f.write(''.join(json.dumps(line) + '\n' for line in lines) + 'not json\n')
+        self.addCleanup(os.remove, f.name)
+
+        out = io.StringIO()
+        call_command('slow_queries', log=f.name, json=True, stdout=out, stderr=io.StringIO())
+        report = json.loads(out.getvalue())
+        self.assertEqual([statement['statement'] for statement in report], ['a', 'b'])
+        self.assertEqual(report[0]['count'], 2)
+        self.assertEqual(report[0]['total_ms'], 800)
+        self.assertEqual(report[0]['max_ms'], 500)
+        self.assertEqual(report[0]['explain'], 'SCAN TABLE stat_app_stat')
+
+        out = io.StringIO()
+        call_command('slow_queries', log=f.name, sort='max', top=1, stdout=out, stderr=io.StringIO())
+        self.assertIn('#1 b', out.getvalue())
+        self.assertNotIn('#2', out.getvalue())
+
+        out = io.StringIO()
+        call_command('slow_queries', log=f.name, sampled=True, json=True, stdout=out, stderr=io.StringIO())
+        self.assertEqual(json.loads(out.getvalue())[0]['count'], 100)
+
+
+class MemoryProfilingTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = CSUser.objects.create_user(username='admin', password='admin', is_staff=True)
+        cls.editor = CSUser.objects.create_user(username='editor', password='editor')
+
+    def setUp(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.addCleanup(tracemalloc.stop)
+        self.addCleanup(memory.baseline.update, snapshot=None, time=None)
+        self.client.force_login(self.admin)
+
+    def test_request_peak_memory(self):
+        labels = {'view': 'department_list', 'method': 'GET'}
+        requests = sample('django_http_request_peak_memory_bytes_count', **labels)
+
+        self.client.get(reverse('department_list'))
+
+        self.assertEqual(sample('django_http_request_peak_memory_bytes_count', **labels), requests + 1)
+
+    @skipIf(not hasattr(tracemalloc, 'reset_peak'), 'tracemalloc.reset_peak() is new in Python 3.9')
+    def test_peak_memory(self):
+        with memory.PeakMemory() as peak:
+            bytearray(1024 * 1024)
+        self.assertGreaterEqual(peak.bytes, 1024 * 1024)
+
+    def test_peak_memory_without_reset_peak(self):
+        # tracemalloc before Python 3.9
+        old_tracemalloc = SimpleNamespace(is_tracing=tracemalloc.is_tracing,
+                                          get_traced_memory=tracemalloc.get_traced_memory)
+        with mock.patch.object(memory, 'tracemalloc', old_tracemalloc):
+            with memory.PeakMemory() as peak:
+                held = bytearray(1024 * 1024)
+        self.assertGreaterEqual(peak.bytes, 1024 * 1024)
+        del held
+
+    def test_snapshot_diff(self):
+        first = self.client.get(reverse('memory'), {'limit': 5}).json()
+        self.assertIsNone(first['since'])
+        self.assertEqual(len(first['stats']), 5)
+
+        held = [bytearray(1024) for _ in range(1000)]
+        second = self.client.get(reverse('memory')).json()
+
+        self.assertEqual(second['since'], first['time'])
+        top = second['stats'][0]
+        self.assertEqual(top['file'], 'main_app/tests.py')
+        self.assertGreaterEqual(top['count_diff'], 1000)
+        self.assertGreaterEqual(top['size_diff'], 1024 * 1000)
+        self.assertEqual(second['pid'], os.getpid())
+        del held
+
+    def test_group_by_file(self):
+        response = self.client.get(reverse('memory'), {'group_by': 'filename'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()['stats'][0]['line'])
+        self.assertEqual(self.client.get(reverse('memory'), {'group_by': 'traceback'}).status_code, 400)
+
+    def test_staff_only(self):
+        self.client.force_login(self.editor)
+        self.assertEqual(self.client.get(reverse('memory')).status_code, 403)
+
+    def test_off(self):
+        tracemalloc.stop()
+        self.assertEqual(self.client.get(reverse('memory')).status_code, 409)
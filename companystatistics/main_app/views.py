@@ -1 +1,30 @@
-from django.shortcuts import render
+import tracemalloc
+
+from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST
+from rest_framework import permissions, status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+
+from .memory import diff_snapshot
+from .metrics import render_metrics
+from .serializers import MemoryQuerySerializer
+
+
+def metrics(request):
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def memory(request):
+    """
+    Heap allocations of the worker process that grew the most since the
+    previous call, by file line or file (`group_by=lineno|filename`).
+    """
+    if not tracemalloc.is_tracing():
+        return Response({'detail': 'Memory profiling is off, see MEMORY_PROFILING.'},
+                        status=status.HTTP_409_CONFLICT)
+    query = MemoryQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    return Response(diff_snapshot(**query.validated_data))
@@ -1,5 +1,14 @@
 from django.contrib import admin
-from .models import Company, Department, StatTitle, Stat
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404, JsonResponse
+from django.shortcuts import get_object_or_404, redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils.html import format_html
+
+from .forms import StatImportForm
+from .importing import start_import
+from .models import Company, Department, StatTitle, Stat, StatImport
 
 
 class DepartmentInline(admin.StackedInline):
@@ -31,3 +40,83 @@ class StatAdmin(admin.ModelAdmin):
     list_display = ['owner', 'title', 'amount', 'date', 'created', 'updated']
     list_filter = ['title', 'date']
     search_fields = ['title', 'date']
+
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='stat_app_stat_import'),
+            path('import/<int:pk>/', self.admin_site.admin_view(self.import_progress_view),
+                 name='stat_app_stat_import_progress'),
+            path('import/<int:pk>/status/', self.admin_site.admin_view(self.import_status_view),
+                 name='stat_app_stat_import_status'),
+            path('import/<int:pk>/rejected/', self.admin_site.admin_view(self.import_rejected_view),
+                 name='stat_app_stat_import_rejected'),
+        ] + super().get_urls()
+
+    def get_import(self, request, pk):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        StatImport.objects.fail_stale()
+        return get_object_or_404(StatImport, pk=pk)
+
+    def import_view(self, request):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = StatImportForm(request.POST or None, request.FILES or None)
+        if form.is_valid():
+            stat_import = form.save(commit=False)
+            stat_import.owner = request.user
+            stat_import.save()
+            start_import(stat_import)
+            return redirect('admin:stat_app_stat_import_progress', stat_import.pk)
+        context = dict(self.admin_site.each_context(request), opts=self.model._meta, form=form,
+                       title='Загрузка данных из файла')
+        return TemplateResponse(request, 'admin/stat_app/stat/import.html', context)
+
+    def import_progress_view(self, request, pk):
+        stat_import = self.get_import(request, pk)
+        context = dict(self.admin_site.each_context(request), opts=self.model._meta, stat_import=stat_import,
+                       title=f'Загрузка {stat_import}')
+        return TemplateResponse(request, 'admin/stat_app/stat/import_progress.html', context)
+
+    def import_status_view(self, request, pk):
+        stat_import = self.get_import(request, pk)
+        return JsonResponse({
+            'status': stat_import.status,
+            'status_display': stat_import.get_status_display(),
+            'progress': stat_import.progress,
+            'processed': stat_import.processed,
+            'inserted': stat_import.inserted,
+            'rejected': stat_import.rejected,
+            'error': stat_import.error,
+            'rejected_report': reverse('admin:stat_app_stat_import_rejected', args=[pk])
+            if stat_import.rejected_report else None,
+        })
+
+    def import_rejected_view(self, request, pk):
+        stat_import = self.get_import(request, pk)
+        if not stat_import.rejected_report:
+            raise Http404
+        return FileResponse(stat_import.rejected_report.open('rb'), as_attachment=True,
+                            filename=f'{stat_import}-rejected.csv')
+
+
+@admin.register(StatImport)
+class StatImportAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'owner', 'status', 'progress', 'inserted', 'rejected', 'created', 'finished',
+                    'progress_link']
+    list_filter = ['status']
+    readonly_fields = ['owner', 'file', 'status', 'progress', 'processed', 'inserted', 'rejected',
+                       'error', 'created', 'updated', 'finished']
+    exclude = ['rejected_report']
+
+    def has_add_permission(self, request):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        StatImport.objects.fail_stale()
+        return super().changelist_view(request, extra_context)
+
+    def progress_link(self, obj):
+        return format_html('<a href="{}">Ход загрузки</a>',
+                           reverse('admin:stat_app_stat_import_progress', args=[obj.pk]))
+    progress_link.short_description = 'ход загрузки'
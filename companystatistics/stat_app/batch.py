@@ -0,0 +1,91 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connection, transaction
+from django.urls import Resolver404, resolve
+from rest_framework import status
+
+# a failed sub-request of an atomic batch rolls back the others
+FAILED_DEPENDENCY = 424
+
+# streams cannot be batched, nor batches nested
+EXCLUDED_URL_NAMES = {'api-live', 'api-batch'}
+
+# headers of the batch request that do not apply to its sub-requests
+SKIPPED_META = {'CONTENT_TYPE', 'CONTENT_LENGTH', 'QUERY_STRING', 'PATH_INFO', 'REQUEST_METHOD',
+                'HTTP_ACCEPT', 'wsgi.input'}
+
+
+def make_request(request, method, path, body):
+    """
+    Builds a sub-request with the headers of the batch request, authenticated
+    as its user without running the authentication again.
+    """
+    url = urlsplit(path)
+    content = json.dumps(body).encode() if body is not None else b''
+    environ = {key: value for key, value in request.META.items() if key not in SKIPPED_META}
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': url.path,
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(content)),
+        'HTTP_ACCEPT': 'application/json',
+        'wsgi.input': BytesIO(content),
+    })
+    sub_request = WSGIRequest(environ)
+    sub_request.user = request.user
+    sub_request._force_auth_user = request.user
+    sub_request._force_auth_token = request.auth
+    return sub_request
+
+
+def run_one(request, prefix, item):
+    path = urlsplit(item['path']).path
+    if not path.startswith(prefix):
+        return {'status': status.HTTP_400_BAD_REQUEST, 'data': {'detail': f'Not an API path: {path}'}}
+    try:
+        match = resolve(path)
+    except Resolver404:
+        return {'status': status.HTTP_404_NOT_FOUND, 'data': {'detail': 'Not found.'}}
+    if match.url_name in EXCLUDED_URL_NAMES:
+        return {'status': status.HTTP_400_BAD_REQUEST, 'data': {'detail': f'Not a batchable path: {path}'}}
+    response = match.func(make_request(request, item['method'], item['path'], item.get('body')),
+                          *match.args, **match.kwargs)
+    return {'status': response.status_code, 'data': getattr(response, 'data', None)}
+
+
+def run_in_thread(request, prefix, item):
+    try:
+        return run_one(request, prefix, item)
+    finally:
+        # worker threads get connections of their own
+        connection.close()
+
+
+def run_batch(request, prefix, requests, atomic=False, parallel=False):
+    """
+    Runs the sub-requests in order, in one transaction with `atomic`, where
+    the first failure rolls back the others and skips the rest. Reads may
+    run on BATCH_MAX_WORKERS threads with `parallel`.
+    """
+    if parallel:
+        with ThreadPoolExecutor(max_workers=settings.BATCH_MAX_WORKERS) as executor:
+            return list(executor.map(lambda item: run_in_thread(request, prefix, item), requests))
+    if not atomic:
+        return [run_one(request, prefix, item) for item in requests]
+
+    results = []
+    with transaction.atomic():
+        for item in requests:
+            result = run_one(request, prefix, item)
+            results.append(result)
+            if result['status'] >= 400:
+                transaction.set_rollback(True)
+                break
+    results.extend({'status': FAILED_DEPENDENCY, 'data': None} for _ in requests[len(results):])
+    return results
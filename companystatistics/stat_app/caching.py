@@ -0,0 +1,33 @@
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+ORG_VERSION_CACHE_KEY = 'stat_app.org_version'
+
+
+def get_org_version():
+    """
+    Version of the org structure (companies, departments, stat titles),
+    part of the keys of fragments rendered from it.
+    """
+    version = cache.get(ORG_VERSION_CACHE_KEY)
+    if version is None:
+        version = bump_org_version()
+    return version
+
+
+def bump_org_version():
+    try:
+        return cache.incr(ORG_VERSION_CACHE_KEY)
+    except ValueError:
+        # start from the clock, so a lost key never brings back an old version
+        version = int(time.time() * 1000)
+        cache.set(ORG_VERSION_CACHE_KEY, version, None)
+        return version
+
+
+def invalidate_org_fragments():
+    # bump again on commit, in case a page was cached from the old rows meanwhile
+    bump_org_version()
+    transaction.on_commit(bump_org_version)
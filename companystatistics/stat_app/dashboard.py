@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+
+from main_app.metrics import record_cache_lookup
+
+from .models import ChangeLog, Department, Stat, StatTitle
+
+
+def get_data_version():
+    """
+    Id of the latest change log entry: every write of the org structure and
+    the stats, bulk ones included, records one.
+    """
+    return ChangeLog.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+
+def build_dashboard(company, date_from, date_to):
+    """
+    Departments of the company with their stat titles, latest values, totals
+    and daily sparklines over the period, in three queries whatever its size.
+    Rows that do not match the earlier queries, e.g. created in between or
+    with stale org keys, are left out.
+    """
+    departments = list(Department.objects.filter(company=company)
+                       .values('id', 'title', 'slug', 'overview', 'stat_title_count'))
+    stat_titles = {}
+    for department in departments:
+        department['stat_titles'] = []
+        stat_titles[department['id']] = department['stat_titles']
+    titles = {}
+    for stat_title in (StatTitle.objects.filter(department__company=company)
+                       .values('id', 'department_id', 'title', 'overview', 'stat_count',
+                               'last_amount', 'last_date')):
+        department_id = stat_title.pop('department_id')
+        last_amount = stat_title['last_amount']
+        stat_title.update(last_amount=None if last_amount is None else float(last_amount),
+                          last_date=None if stat_title['last_date'] is None else str(stat_title['last_date']),
+                          total=0.0, sparkline={'dates': [], 'amounts': []})
+        if department_id in stat_titles:
+            titles[stat_title['id']] = stat_title
+            stat_titles[department_id].append(stat_title)
+
+    # a stat title's stats all share its company, so the company date index covers the period
+    days = (Stat.objects.filter(company=company, date__range=(date_from, date_to))
+            .values('title_id', 'date').annotate(total=Sum('amount')).order_by('title_id', 'date'))
+    for day in days:
+        stat_title = titles.get(day['title_id'])
+        if stat_title is None:
+            continue
+        amount = float(day['total'])
+        stat_title['total'] += amount
+        stat_title['sparkline']['dates'].append(str(day['date']))
+        stat_title['sparkline']['amounts'].append(amount)
+
+    return {
+        'company': {'id': company.id, 'title': company.title, 'slug': company.slug,
+                    'department_count': company.department_count},
+        'period': {'date_from': str(date_from), 'date_to': str(date_to)},
+        'departments': departments,
+    }
+
+
+def get_dashboard(company, date_from, date_to):
+    """
+    Cached dashboard of the company, keyed by the data version, so any
+    change is seen on the next request. A transaction that commits after a
+    later one is only seen after DASHBOARD_CACHE_TIMEOUT, as its change log
+    entry does not raise the version.
+    """
+    version = get_data_version()
+    key = f'stat_app.dashboard.{company.id}.{date_from}.{date_to}.{version}'
+    dashboard = cache.get(key)
+    record_cache_lookup('dashboard', dashboard is not None)
+    if dashboard is None:
+        dashboard = build_dashboard(company, date_from, date_to)
+        dashboard['version'] = version
+        cache.set(key, dashboard, settings.DASHBOARD_CACHE_TIMEOUT)
+    return dashboard
@@ -0,0 +1,56 @@
+from rest_framework import filters, serializers
+
+
+class StatFilterSerializer(serializers.Serializer):
+    """
+    Validates the query parameters accepted by StatViewSet.
+    """
+    title = serializers.IntegerField(required=False)
+    department = serializers.IntegerField(required=False)
+    company = serializers.IntegerField(required=False)
+    owner = serializers.IntegerField(required=False)
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+    amount_min = serializers.DecimalField(max_digits=12, decimal_places=2, required=False)
+    amount_max = serializers.DecimalField(max_digits=12, decimal_places=2, required=False)
+    updated_since = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        date_from, date_to = attrs.get('date_from'), attrs.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            raise serializers.ValidationError('date_from must not be later than date_to.')
+        amount_min, amount_max = attrs.get('amount_min'), attrs.get('amount_max')
+        if amount_min is not None and amount_max is not None and amount_min > amount_max:
+            raise serializers.ValidationError('amount_min must not be greater than amount_max.')
+        if (amount_min is not None or amount_max is not None) and 'title' not in attrs:
+            # amounts are only indexed together with the stat title
+            raise serializers.ValidationError('amount_min and amount_max require title.')
+        return attrs
+
+
+class StatFilterBackend(filters.BaseFilterBackend):
+    """
+    Filters stats by the query parameters, each mapped to an indexed column.
+    """
+    lookups = {
+        'title': 'title_id',
+        'department': 'department_id',
+        'company': 'company_id',
+        'owner': 'owner_id',
+        'date_from': 'date__gte',
+        'date_to': 'date__lte',
+        'amount_min': 'amount__gte',
+        'amount_max': 'amount__lte',
+        'updated_since': 'updated__gte',
+    }
+
+    def filter_queryset(self, request, queryset, view):
+        params = {key: value for key, value in request.query_params.items() if key in self.lookups}
+        filter_serializer = StatFilterSerializer(data=params)
+        filter_serializer.is_valid(raise_exception=True)
+        validated_data = filter_serializer.validated_data
+        queryset = queryset.filter(**{self.lookups[key]: value for key, value in validated_data.items()})
+        if 'updated_since' in validated_data:
+            # walk the updated index instead of scanning by date
+            queryset = queryset.order_by('updated')
+        return queryset
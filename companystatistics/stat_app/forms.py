@@ -1,6 +1,7 @@
 from django import forms
 
-from .models import Stat, StatTitle
+from .importing import IMPORT_EXTENSIONS
+from .models import Stat, StatImport, StatTitle
 
 
 class StatForm(forms.ModelForm):
@@ -15,3 +16,20 @@ class StatTitleForm(forms.ModelForm):
     class Meta:
         model = StatTitle
         fields = ('title', 'overview',)
+
+
+class StatImportForm(forms.ModelForm):
+
+    class Meta:
+        model = StatImport
+        fields = ('file',)
+        help_texts = {
+            'file': 'Первая строка - заголовки: title_id или department (slug отдела) и title, '
+                    'а также amount и date.',
+        }
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if not file.name.lower().endswith(tuple(IMPORT_EXTENSIONS)):
+            raise forms.ValidationError('Поддерживаются файлы: %s.' % ', '.join(IMPORT_EXTENSIONS))
+        return file
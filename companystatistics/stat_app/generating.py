@@ -0,0 +1,132 @@
+"""
+Deterministic synthetic orgs and stat series for scale tests, benchmarks
+and load tests. The same arguments and seed always give the same rows.
+"""
+import datetime
+import math
+import random
+import time
+
+from django.db import transaction
+
+from main_app.metrics import record_ingest
+
+from .caching import invalidate_org_fragments
+from .models import ChangeLog, Company, Department, Stat, StatTitle
+
+START_DATE = datetime.date(2015, 1, 1)
+
+# Stat.amount has 12 digits, 2 of them decimal places
+MAX_AMOUNT = 10 ** 10 - 1
+
+
+def series_shape(rng):
+    """
+    Random level, linear trend, yearly and weekly seasonality, noise and
+    gaps of one stat title's series.
+    """
+    return {
+        'level': rng.lognormvariate(7, 1),
+        'trend': rng.gauss(0, 0.0005),
+        'yearly': rng.uniform(0, 0.3),
+        'weekly': rng.uniform(0, 0.2),
+        'phase': rng.uniform(0, 2 * math.pi),
+        'noise': rng.uniform(0.02, 0.15),
+        'gaps': rng.uniform(0, 0.1),
+        'outages': rng.uniform(0, 0.005),
+    }
+
+
+def generate_series(rng, count, start=START_DATE):
+    """
+    Yields `count` (date, amount) points as ISO date and decimal strings,
+    one a day from `start`, skipping single days and whole outages of a
+    week to a month.
+    """
+    shape = series_shape(rng)
+    day = 0
+    while count > 0:
+        if rng.random() < shape['outages']:
+            day += rng.randint(7, 30)
+        elif rng.random() >= shape['gaps']:
+            amount = (shape['level'] * max(1 + shape['trend'] * day, 0)
+                      * (1 + shape['yearly'] * math.sin(2 * math.pi * day / 365.25 + shape['phase']))
+                      * (1 + shape['weekly'] * math.sin(2 * math.pi * day / 7))
+                      * (1 + rng.gauss(0, shape['noise'])))
+            yield (start + datetime.timedelta(days=day)).isoformat(), f'{min(max(amount, 0), MAX_AMOUNT):.2f}'
+            count -= 1
+        day += 1
+
+
+def generate_org(companies, departments, titles, prefix='gen'):
+    """
+    Creates `companies` companies of `departments` departments of `titles`
+    stat titles each, returns the stat titles.
+    """
+    if Company.objects.filter(slug__startswith=f'{prefix}-').exists():
+        raise ValueError(f'Companies prefixed {prefix}- exist already.')
+    Company.objects.bulk_create([Company(title=f'Компания {c}', slug=f'{prefix}-{c}') for c in range(companies)])
+    company_ids = list(Company.objects.filter(slug__startswith=f'{prefix}-').order_by('pk')
+                       .values_list('pk', flat=True))
+    Department.objects.bulk_create([
+        Department(company_id=company_id, title=f'Отдел {d}', slug=f'{prefix}-{c}-{d}')
+        for c, company_id in enumerate(company_ids) for d in range(departments)])
+    departments = list(Department.objects.filter(company_id__in=company_ids).order_by('pk'))
+    StatTitle.objects.bulk_create([StatTitle(department=department, title=f'Форма {t}')
+                                   for department in departments for t in range(titles)])
+    stat_titles = list(StatTitle.objects.filter(department__in=departments).select_related('department')
+                       .order_by('pk'))
+
+    # bulk_create skips the counters and the change log
+    Company.objects.filter(pk__in=company_ids).recount()
+    Department.objects.filter(pk__in=[department.pk for department in departments]).recount()
+    ChangeLog.objects.record(Company, company_ids)
+    ChangeLog.objects.record(Department, [department.pk for department in departments])
+    ChangeLog.objects.record(StatTitle, [stat_title.pk for stat_title in stat_titles])
+    invalidate_org_fragments()
+    return stat_titles
+
+
+def generate_stats(stat_titles, owner, stats, seed=0, start=START_DATE, transaction_size=200000):
+    """
+    Inserts `stats` stats of each stat title, returns their number. Each
+    series has its own random generator, so it does not depend on the
+    other stat titles. At most `transaction_size` rows are held in memory,
+    however long a series.
+    """
+    last_pk = Stat.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    inserted = 0
+    rows = []
+    for number, stat_title in enumerate(stat_titles):
+        keys = (owner.pk, stat_title.pk, stat_title.department_id, stat_title.department.company_id)
+        rng = random.Random(f'{seed}-{number}')
+        for date, amount in generate_series(rng, stats, start):
+            rows.append(keys + (amount, date))
+            if len(rows) >= transaction_size:
+                inserted += save_rows(rows)
+                rows = []
+    if rows:
+        inserted += save_rows(rows)
+
+    # the counters and the change log are not kept up by insert_rows
+    StatTitle.objects.filter(pk__in=[stat_title.pk for stat_title in stat_titles]).recount()
+    ChangeLog.objects.record_queryset(Stat.objects.filter(pk__gt=last_pk))
+    return inserted
+
+
+def save_rows(rows):
+    start = time.perf_counter()
+    with transaction.atomic():
+        Stat.objects.insert_rows(rows)
+    record_ingest('generate', len(rows), time.perf_counter() - start)
+    return len(rows)
+
+
+def generate(owner, companies=1, departments=1, titles=1, stats=10, seed=0, prefix='gen', **options):
+    """
+    Fixture factory: a synthetic org with `stats` stats per stat title.
+    Returns the stat titles and the number of stats.
+    """
+    with transaction.atomic():
+        stat_titles = generate_org(companies, departments, titles, prefix)
+    return stat_titles, generate_stats(stat_titles, owner, stats, seed, **options)
@@ -0,0 +1,258 @@
+import csv
+import datetime
+import decimal
+import logging
+import tempfile
+import threading
+import time
+
+from django import forms
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import connection, transaction
+from django.utils import timezone
+
+from main_app.metrics import record_ingest
+
+from .live import publish_reload
+from .models import ChangeLog, Stat, StatImport, StatTitle
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+logger = logging.getLogger(__name__)
+
+# Stat.amount has 12 digits, 2 of them decimal places
+MAX_AMOUNT = 10 ** 10
+
+IMPORT_EXTENSIONS = ['.csv'] + (['.xlsx'] if openpyxl is not None else [])
+
+
+def column_name(value):
+    return str(value or '').strip().lower()
+
+
+def decode_line(line):
+    # files saved by Excel are often in cp1251
+    try:
+        return line.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return line.decode('cp1251')
+
+
+class CSVReader:
+    """
+    Reads rows of a CSV file line by line as (line number, dict), `;` or `,` separated.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.size = f.size
+        self.position = 0
+
+    def lines(self):
+        for line in self.f:
+            self.position += len(line)
+            yield decode_line(line)
+
+    def __iter__(self):
+        lines = self.lines()
+        header = next(lines, '')
+        delimiter = ';' if header.count(';') > header.count(',') else ','
+        self.columns = [column_name(name) for name in next(csv.reader([header], delimiter=delimiter), [])]
+        reader = csv.reader(lines, delimiter=delimiter)
+        for values in reader:
+            if any(values):
+                yield reader.line_num + 1, dict(zip(self.columns, values))
+
+    def progress(self):
+        return 100 * self.position // self.size if self.size else 100
+
+
+class XLSXReader:
+    """
+    Reads rows of the first sheet of an XLSX file as (row number, dict),
+    without loading the whole workbook.
+    """
+
+    def __init__(self, f):
+        self.workbook = openpyxl.load_workbook(f, read_only=True, data_only=True)
+        self.sheet = self.workbook.active
+        self.total = self.sheet.max_row or 0
+        self.position = 0
+
+    def __iter__(self):
+        try:
+            rows = self.sheet.iter_rows(values_only=True)
+            self.columns = [column_name(name) for name in next(rows, ())]
+            for values in rows:
+                self.position += 1
+                if any(value is not None for value in values):
+                    yield self.position + 1, dict(zip(self.columns, values))
+        finally:
+            self.workbook.close()
+
+    def progress(self):
+        return 100 * self.position // self.total if self.total else 100
+
+
+def open_reader(f, name):
+    if name.lower().endswith('.xlsx'):
+        return XLSXReader(f)
+    return CSVReader(f)
+
+
+class StatRowParser:
+    """
+    Validates import rows: the stat title by `title_id`, or by `department`
+    (slug) and `title`, and `amount` and `date` in ISO or local format.
+
+    Stat titles are loaded once, so rows are resolved without queries. Pass
+    the `stat_titles` of another parser to skip loading them again, e.g. in
+    a worker process.
+    """
+    amount_field = forms.DecimalField(max_digits=12, decimal_places=2, localize=True)
+    date_field = forms.DateField()
+
+    def __init__(self, stat_titles=None):
+        if stat_titles is None:
+            stat_titles = list(StatTitle.objects.values_list('pk', 'title', 'department_id', 'department__slug',
+                                                             'department__company_id'))
+        self.stat_titles = stat_titles
+        self.by_id, self.by_name = {}, {}
+        for pk, title, department_id, department_slug, company_id in stat_titles:
+            self.by_id[pk] = self.by_name[department_slug, title.lower()] = (pk, department_id, company_id)
+
+    def parse(self, row):
+        """
+        Returns the stat title, department and company ids, amount and date of a row.
+        """
+        title_id = row.get('title_id')
+        if title_id not in (None, ''):
+            try:
+                keys = self.by_id.get(int(float(title_id)))
+            except ValueError:
+                keys = None
+        else:
+            department = str(row.get('department') or '').strip()
+            title = str(row.get('title') or '').strip().lower()
+            keys = self.by_name.get((department, title))
+        if keys is None:
+            raise ValidationError('Форма не найдена.')
+        return keys + (self.parse_amount(row.get('amount')), self.parse_date(row.get('date')))
+
+    def parse_amount(self, value):
+        # plain decimals skip the localized form field, which is slow on large files
+        if isinstance(value, str):
+            try:
+                amount = decimal.Decimal(value)
+            except decimal.InvalidOperation:
+                pass
+            else:
+                if amount.is_finite() and amount.as_tuple().exponent >= -2 and abs(amount) < MAX_AMOUNT:
+                    return amount
+        return self.amount_field.clean(value)
+
+    def parse_date(self, value):
+        if isinstance(value, str) and len(value) == 10:
+            try:
+                return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                pass
+        return self.date_field.clean(value)
+
+
+def run_import(stat_import):
+    """
+    Loads the rows of a StatImport in batches, keeping its counts and
+    progress current. Rejected rows are written to a CSV report.
+    """
+    StatImport.objects.filter(pk=stat_import.pk).update(status=StatImport.RUNNING, updated=timezone.now())
+    batch_size = settings.STAT_IMPORT_BATCH_SIZE
+    processed = inserted = rejected = 0
+    with tempfile.TemporaryFile('w+', newline='', encoding='utf-8-sig') as report, \
+            stat_import.file.open('rb') as f:
+        try:
+            parser = StatRowParser()
+            reader = open_reader(f, stat_import.file.name)
+            writer = csv.writer(report, delimiter=';')
+            stats = []
+            for number, row in reader:
+                processed += 1
+                try:
+                    title_id, department_id, company_id, amount, date = parser.parse(row)
+                except ValidationError as e:
+                    if not rejected:
+                        writer.writerow(['строка', 'ошибка'] + reader.columns)
+                    rejected += 1
+                    writer.writerow([number, ' '.join(e.messages)] + list(row.values()))
+                else:
+                    stats.append(Stat(owner_id=stat_import.owner_id, title_id=title_id, department_id=department_id,
+                                      company_id=company_id, amount=amount, date=date))
+                if processed % batch_size == 0:
+                    inserted += len(stats)
+                    save_batch(stat_import, stats, processed=processed, inserted=inserted, rejected=rejected,
+                               progress=reader.progress())
+                    stats = []
+            inserted += len(stats)
+            save_batch(stat_import, stats, processed=processed, inserted=inserted, rejected=rejected,
+                       progress=100)
+            if rejected:
+                report.seek(0)
+                stat_import.rejected_report.save(f'{stat_import.pk}-rejected.csv', File(report), save=False)
+            stat_import.status = StatImport.DONE
+        except Exception as e:
+            logger.exception('Import %s failed', stat_import.pk)
+            stat_import.status = StatImport.FAILED
+            stat_import.error = str(e)
+        stat_import.finished = timezone.now()
+        stat_import.save(update_fields=['status', 'error', 'rejected_report', 'updated', 'finished'])
+    stat_import.refresh_from_db()
+    return stat_import
+
+
+def save_batch(stat_import, stats, **counts):
+    """
+    Inserts a batch with its counters and change log in one transaction, so
+    the batches committed before a failure are consistent too.
+    """
+    start = time.perf_counter()
+    with transaction.atomic():
+        last_pk = Stat.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        Stat.objects.bulk_create(stats)
+        StatImport.objects.filter(pk=stat_import.pk).update(updated=timezone.now(), **counts)
+        # bulk_create skips the counters kept by Stat.save() and the change log;
+        # they are bumped by the batch alone, without rescanning the older stats
+        added = {}
+        for stat in stats:
+            count, date, amount = added.get(stat.title_id, (0, None, None))
+            if date is None or stat.date >= date:
+                date, amount = stat.date, stat.amount
+            added[stat.title_id] = (count + 1, date, amount)
+        for title_id, (count, date, amount) in added.items():
+            StatTitle.objects.filter(pk=title_id).add_stats(count, date, amount)
+        ChangeLog.objects.record_queryset(Stat.objects.filter(pk__gt=last_pk))
+        publish_reload({stat.department_id for stat in stats})
+    record_ingest('import', len(stats), time.perf_counter() - start)
+
+
+def start_import(stat_import):
+    """
+    Runs the import in a background thread once the upload is committed,
+    or right away with STAT_IMPORT_IN_BACKGROUND off. Imports left behind
+    by a restarted worker are failed first.
+    """
+    StatImport.objects.fail_stale()
+    if not settings.STAT_IMPORT_IN_BACKGROUND:
+        return run_import(stat_import)
+
+    def run():
+        try:
+            run_import(stat_import)
+        finally:
+            connection.close()
+
+    transaction.on_commit(threading.Thread(target=run, daemon=True).start)
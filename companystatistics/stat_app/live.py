@@ -0,0 +1,143 @@
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+class Broadcaster:
+    """
+    Delivers live stat events published to a channel to its subscribers.
+
+    Set STAT_BROADCASTER to another subclass (e.g. over Redis pub/sub) when
+    the site runs in several processes.
+    """
+
+    def publish(self, channel, event):
+        raise NotImplementedError
+
+    def subscribe(self, channels):
+        """
+        Returns a subscription with `get(timeout)`, which returns the next
+        event or None, and `close()`.
+        """
+        raise NotImplementedError
+
+
+class LocalSubscription:
+
+    def __init__(self, broadcaster, channels):
+        self.broadcaster = broadcaster
+        self.channels = channels
+        self.queue = queue.Queue(maxsize=settings.LIVE_QUEUE_SIZE)
+
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broadcaster.unsubscribe(self)
+
+
+class LocalBroadcaster(Broadcaster):
+    """
+    Delivers events to subscribers in this process only.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+
+    def publish(self, channel, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                # a stalled client, it reloads the series on reconnect
+                pass
+
+    def subscribe(self, channels):
+        subscription = LocalSubscription(self, channels)
+        with self.lock:
+            for channel in channels:
+                self.subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                self.subscriptions[channel].discard(subscription)
+                if not self.subscriptions[channel]:
+                    del self.subscriptions[channel]
+
+
+@lru_cache(maxsize=None)
+def get_broadcaster():
+    return import_string(settings.STAT_BROADCASTER)()
+
+
+def department_channel(department_id):
+    return f'department:{department_id}'
+
+
+def title_channel(title_id):
+    return f'title:{title_id}'
+
+
+def publish_stat(stat, created):
+    """
+    Publishes a saved stat as a point of its charts once the transaction commits.
+    """
+    event = {'type': 'point', 'id': stat.pk, 'title': stat.title_id, 'department': stat.department_id,
+             'date': str(stat.date), 'amount': float(stat.amount), 'created': created}
+
+    def publish():
+        broadcaster = get_broadcaster()
+        broadcaster.publish(department_channel(stat.department_id), event)
+        broadcaster.publish(title_channel(stat.title_id), event)
+
+    transaction.on_commit(publish)
+
+
+def publish_reload(department_ids):
+    """
+    Asks the charts of the departments to reload their series, after bulk
+    changes that are too many to send point by point.
+    """
+    department_ids = set(department_ids)
+
+    def publish():
+        broadcaster = get_broadcaster()
+        for department_id in department_ids:
+            broadcaster.publish(department_channel(department_id),
+                                {'type': 'reload', 'department': department_id})
+
+    transaction.on_commit(publish)
+
+
+def event_stream(subscription):
+    """
+    Yields the events of the subscription as server-sent events, with
+    keepalive comments, and ends after LIVE_STREAM_TIMEOUT seconds so that
+    the browser reconnects.
+    """
+    try:
+        yield f'retry: {settings.LIVE_RETRY * 1000}\n\n'
+        ends = time.monotonic() + settings.LIVE_STREAM_TIMEOUT
+        while time.monotonic() < ends:
+            event = subscription.get(timeout=settings.LIVE_KEEPALIVE)
+            if event is None:
+                yield ': keepalive\n\n'
+            else:
+                yield f'event: {event["type"]}\ndata: {json.dumps(event)}\n\n'
+    finally:
+        subscription.close()
@@ -0,0 +1,143 @@
+"""
+Parsing side of the `load_stats` command, run in worker processes.
+
+Only the standard library is imported at module level, so a worker started
+with the `spawn` method can set up Django before the app modules are loaded.
+"""
+import csv
+import json
+import os
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+_parser = None
+
+
+def split_lines(path, chunk_size=CHUNK_SIZE, skip_header=False):
+    """
+    Splits a line based file into (path, start, end, first line number)
+    chunks that end on line breaks.
+    """
+    chunks = []
+    with open(path, 'rb') as f:
+        line_number = 1
+        if skip_header:
+            f.readline()
+            line_number = 2
+        start = f.tell()
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            block += f.readline()
+            chunks.append((path, start, start + len(block), line_number))
+            line_number += block.count(b'\n')
+            start += len(block)
+    return chunks
+
+
+def read_header(path):
+    from .importing import column_name, decode_line
+
+    with open(path, 'rb') as f:
+        header = decode_line(f.readline())
+    delimiter = ';' if header.count(';') > header.count(',') else ','
+    columns = [column_name(name) for name in next(csv.reader([header], delimiter=delimiter), [])]
+    return columns, delimiter
+
+
+def plan(paths, chunk_size=CHUNK_SIZE):
+    """
+    Returns the parse tasks of the files, CSV and NDJSON split into line
+    chunks, Parquet into row groups.
+    """
+    tasks = []
+    for path in paths:
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.csv':
+            columns, delimiter = read_header(path)
+            tasks.extend(('csv', chunk, columns, delimiter) for chunk in split_lines(path, chunk_size, True))
+        elif extension in ('.ndjson', '.jsonl'):
+            tasks.extend(('ndjson', chunk, None, None) for chunk in split_lines(path, chunk_size))
+        elif extension == '.parquet':
+            import pyarrow.parquet
+
+            row_groups = pyarrow.parquet.ParquetFile(path).num_row_groups
+            tasks.extend(('parquet', (path, row_group, None, None), None, None) for row_group in range(row_groups))
+        else:
+            raise ValueError(f'Unsupported file: {path}')
+    return tasks
+
+
+def init_worker(stat_titles):
+    global _parser
+    import django
+
+    django.setup()
+    from .importing import StatRowParser
+
+    _parser = StatRowParser(stat_titles)
+
+
+def read_lines(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start).splitlines()
+
+
+def normalize(row):
+    if not isinstance(row, dict):
+        return None
+    return {str(key).strip().lower(): value for key, value in row.items()}
+
+
+def read_rows(task):
+    """
+    Yields (line or row number, row dict) of a task.
+    """
+    kind, (path, start, end, line_number), columns, delimiter = task
+    if kind == 'csv':
+        from .importing import decode_line
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            lines = decode_line(f.read(end - start)).split('\n')
+        for number, values in enumerate(csv.reader(lines, delimiter=delimiter), start=line_number):
+            if any(values):
+                yield number, dict(zip(columns, values))
+    elif kind == 'ndjson':
+        for number, line in enumerate(read_lines(path, start, end), start=line_number):
+            if line.strip():
+                try:
+                    yield number, normalize(json.loads(line))
+                except ValueError:
+                    yield number, None
+    else:
+        import pyarrow.parquet
+
+        table = pyarrow.parquet.ParquetFile(path).read_row_group(start)
+        for number, row in enumerate(table.to_pylist()):
+            yield f'{start}:{number}', normalize(row)
+
+
+def parse_task(task):
+    """
+    Validates the rows of a task, returns (title, department, company, amount,
+    date) of the valid rows and (location, message) of the rejected ones.
+    """
+    from django.core.exceptions import ValidationError
+
+    path = task[1][0]
+    stats, rejected = [], []
+    for number, row in read_rows(task):
+        if row is None:
+            rejected.append((f'{path}:{number}', 'Строка не разобрана.'))
+            continue
+        try:
+            title_id, department_id, company_id, amount, date = _parser.parse(row)
+        except ValidationError as e:
+            rejected.append((f'{path}:{number}', ' '.join(e.messages)))
+        else:
+            # strings are cheaper to send to the writer and are what the database takes
+            stats.append((title_id, department_id, company_id, format(amount, 'f'), date.isoformat()))
+    return stats, rejected
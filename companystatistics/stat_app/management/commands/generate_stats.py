@@ -0,0 +1,47 @@
+import datetime
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from stat_app.generating import START_DATE, generate
+
+
+def iso_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class Command(BaseCommand):
+    help = ('Generates a synthetic org with seeded, reproducible stat series (trend, seasonality, '
+            'noise and gaps) for scale tests: companies x departments x stat titles x stats rows.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owner', required=True, help='username of the owner of the generated stats')
+        parser.add_argument('--companies', type=int, default=1)
+        parser.add_argument('--departments', type=int, default=10, help='per company')
+        parser.add_argument('--titles', type=int, default=10, help='per department')
+        parser.add_argument('--stats', type=int, default=10, help='per stat title, one a day')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='gen', help='of the company and department slugs')
+        parser.add_argument('--start', type=iso_date, default=START_DATE,
+                            help='first date of the series, YYYY-MM-DD')
+        parser.add_argument('--transaction-size', type=int, default=200000, help='rows per transaction')
+
+    def handle(self, *args, **options):
+        try:
+            owner = get_user_model().objects.get(username=options['owner'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f'User {options["owner"]} does not exist.')
+        started = time.monotonic()
+        try:
+            stat_titles, inserted = generate(
+                owner, options['companies'], options['departments'], options['titles'], options['stats'],
+                options['seed'], options['prefix'], start=options['start'],
+                transaction_size=options['transaction_size'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {len(stat_titles)} stat titles and {inserted} stats in {elapsed:.1f}s '
+            f'({inserted / elapsed if elapsed else 0:.0f} rows/s).'))
@@ -0,0 +1,33 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from stat_app.serializers import OrgTreeSerializer
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class Command(BaseCommand):
+    help = 'Creates or updates companies, departments and stat titles from a JSON or YAML tree.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='.json, or .yaml/.yml (needs PyYAML)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        with open(path, encoding='utf-8') as f:
+            if path.endswith(('.yaml', '.yml')):
+                if yaml is None:
+                    raise CommandError('Reading YAML needs PyYAML: pip install pyyaml')
+                data = yaml.safe_load(f)
+            else:
+                data = json.load(f)
+        serializer = OrgTreeSerializer(data=data)
+        if not serializer.is_valid():
+            raise CommandError(json.dumps(serializer.errors, ensure_ascii=False))
+        report = serializer.save()
+        for level, counts in report.items():
+            self.stdout.write(f'{level}: {counts["created"]} created, {counts["updated"]} updated')
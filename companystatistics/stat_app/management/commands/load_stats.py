@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from main_app.metrics import record_ingest
+from stat_app.importing import StatRowParser
+from stat_app.loading import CHUNK_SIZE, init_worker, parse_task, plan
+from stat_app.live import publish_reload
+from stat_app.models import ChangeLog, Stat, StatTitle
+
+
+class Command(BaseCommand):
+    help = ('Loads stats from CSV, NDJSON or Parquet files for backfills: the files are parsed '
+            'by a pool of processes, and one writer inserts them in large transactions. '
+            'The counters are recounted after the load. With --drop-indexes the stat indexes are '
+            'dropped during the load and rebuilt after it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='.csv, .ndjson/.jsonl or .parquet (needs pyarrow)')
+        parser.add_argument('--owner', required=True, help='username of the owner of the loaded stats')
+        parser.add_argument('--workers', type=int, default=(os.cpu_count() or 1) - 1,
+                            help='parsing processes besides the writer, 0 parses in the writer process')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='bytes of CSV or NDJSON parsed per task')
+        parser.add_argument('--transaction-size', type=int, default=200000,
+                            help='rows inserted per transaction')
+        parser.add_argument('--drop-indexes', action='store_true',
+                            help='drop the stat indexes during the load and rebuild them after it, '
+                                 'faster on an empty table but slows down reads of a live one')
+
+    def handle(self, *args, **options):
+        try:
+            owner = get_user_model().objects.get(username=options['owner'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f'User {options["owner"]} does not exist.')
+        try:
+            tasks = plan(options['paths'], options['chunk_size'])
+        except (OSError, ValueError, ImportError) as e:
+            raise CommandError(e)
+
+        stat_titles = StatRowParser().stat_titles
+        indexes = Stat._meta.indexes if options['drop_indexes'] else []
+        started = time.monotonic()
+        inserted = rejected = 0
+        title_ids = set()
+        last_pk = Stat.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        self.drop_indexes(indexes)
+        try:
+            stats = []
+            for task_stats, task_rejected in self.parse(tasks, stat_titles, options['workers']):
+                stats.extend(task_stats)
+                rejected += len(task_rejected)
+                if options['verbosity'] > 1:
+                    for location, message in task_rejected:
+                        self.stderr.write(f'{location}: {message}')
+                if len(stats) >= options['transaction_size']:
+                    inserted += self.write(stats, owner, title_ids)
+                    stats = []
+            inserted += self.write(stats, owner, title_ids)
+        finally:
+            self.create_indexes(indexes)
+        # the counters and the change log are not kept up during the load
+        StatTitle.objects.filter(pk__in=title_ids).recount()
+        ChangeLog.objects.record_queryset(Stat.objects.filter(pk__gt=last_pk))
+        publish_reload(StatTitle.objects.filter(pk__in=title_ids).values_list('department_id', flat=True))
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Loaded {inserted} stats, rejected {rejected} rows in {elapsed:.1f}s '
+            f'({inserted / elapsed if elapsed else 0:.0f} rows/s).'))
+
+    def parse(self, tasks, stat_titles, workers):
+        if workers < 1:
+            init_worker(stat_titles)
+            for task in tasks:
+                yield parse_task(task)
+            return
+        with multiprocessing.Pool(workers, init_worker, (stat_titles,)) as pool:
+            yield from pool.imap_unordered(parse_task, tasks)
+
+    def write(self, stats, owner, title_ids):
+        start = time.perf_counter()
+        with transaction.atomic():
+            Stat.objects.insert_rows([(owner.pk,) + stat for stat in stats])
+        record_ingest('load_stats', len(stats), time.perf_counter() - start)
+        title_ids.update(stat[0] for stat in stats)
+        return len(stats)
+
+    def drop_indexes(self, indexes):
+        if not indexes:
+            return
+        with connection.schema_editor() as schema_editor:
+            for index in indexes:
+                schema_editor.remove_index(Stat, index)
+
+    def create_indexes(self, indexes):
+        if not indexes:
+            return
+        with connection.schema_editor() as schema_editor:
+            for index in indexes:
+                schema_editor.add_index(Stat, index)
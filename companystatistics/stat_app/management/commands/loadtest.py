@@ -0,0 +1,267 @@
+import http.cookiejar
+import json
+import math
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from stat_app.generating import generate
+from stat_app.models import Company, Department, Stat, StatTitle
+
+PREFIX = 'loadtest'
+
+# (weight, journey) picked by each virtual user after logging in
+JOURNEYS = [
+    (3, 'department_list'),
+    (4, 'department_detail'),
+    (2, 'stat_create'),
+    (3, 'api_list'),
+]
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # a redirect is the answer timed, not the page it leads to
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def percentile(timings, p):
+    """
+    Nearest-rank percentile of sorted timings.
+    """
+    return timings[max(math.ceil(p / 100 * len(timings)) - 1, 0)]
+
+
+class VirtualUser:
+    """
+    A logged in browser session that times its requests per URL name.
+    """
+
+    def __init__(self, base_url, username, password, org, record, rng):
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self.org = org
+        self.record = record
+        self.rng = rng
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies), NoRedirect)
+
+    def request(self, name, path, data=None, expect=(200,)):
+        if data is not None:
+            data = urllib.parse.urlencode(dict(data, csrfmiddlewaretoken=self.csrf_token())).encode()
+        request = urllib.request.Request(self.base_url + path, data=data,
+                                         headers={'Referer': self.base_url + path})
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                response.read()
+                code = response.status
+        except urllib.error.HTTPError as e:
+            code = e.code
+        except OSError:
+            code = None
+        self.record(name, time.perf_counter() - start, code in expect)
+
+    def csrf_token(self):
+        return next((cookie.value for cookie in self.cookies if cookie.name == 'csrftoken'), '')
+
+    def login(self):
+        path = reverse('auth_app:login')
+        self.request('auth_app:login', path)
+        self.request('auth_app:login', path, {'username': self.username, 'password': self.password}, expect=(302,))
+
+    def run_journey(self, journey):
+        department_id, slug, title_ids = self.rng.choice(self.org)
+        if journey == 'department_list':
+            self.request('department_list', reverse('department_list'))
+        elif journey == 'department_detail':
+            self.request('stat_app:department_detail', reverse('stat_app:department_detail', args=[slug]))
+            self.request('stat_app:api-data', f'{reverse("stat_app:api-data")}?department={department_id}')
+        elif journey == 'stat_create':
+            path = reverse('stat_app:stat_create', args=[self.rng.choice(title_ids)])
+            self.request('stat_app:stat_create', path)
+            self.request('stat_app:stat_create', path,
+                         {'amount': f'{self.rng.uniform(0, 1000):.2f}', 'date': '2020-04-01'}, expect=(302,))
+        else:
+            self.request('stat_app:stat-list', f'{reverse("stat_app:stat-list")}?title={self.rng.choice(title_ids)}')
+
+
+class Command(BaseCommand):
+    help = ('Seeds a synthetic org and replays user journeys (login, department list, department page '
+            'with its chart data, stat create, API list) with concurrent virtual users against a '
+            'server started locally or --url, then prints throughput and p50/p95/p99 per URL name as JSON. '
+            'Seeds into the configured database, so it runs only with LOADTEST_DATABASE set in --settings '
+            'of a scratch one, or with --i-know. The virtual users get a random password and are deleted '
+            'with their stats afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='a running server, by default runserver is started on a free port')
+        parser.add_argument('--users', type=int, default=20, help='concurrent virtual users')
+        parser.add_argument('--duration', type=float, default=30, help='seconds of load after login')
+        parser.add_argument('--companies', type=int, default=2)
+        parser.add_argument('--departments', type=int, default=10, help='per company')
+        parser.add_argument('--titles', type=int, default=5, help='per department')
+        parser.add_argument('--stats', type=int, default=100, help='per stat title')
+        parser.add_argument('--seed', type=int, default=0, help='seed of the stat series and the journeys')
+        parser.add_argument('--output', help='write the JSON report to a file')
+        parser.add_argument('--clean', action='store_true', help='delete the seeded org afterwards too')
+        parser.add_argument('--i-know', action='store_true',
+                            help='seed into a database without LOADTEST_DATABASE set')
+
+    def handle(self, *args, **options):
+        if not (settings.LOADTEST_DATABASE or options['i_know']):
+            raise CommandError('The load test seeds users and stats into the configured database. Set '
+                               'LOADTEST_DATABASE = True in the settings of a scratch database, or pass --i-know.')
+        password = secrets.token_urlsafe(16)
+        server = None
+        try:
+            org = self.seed(options, password)
+            base_url = options['url']
+            if not base_url:
+                server, base_url = self.start_server()
+            report = self.run(base_url, org, password, options)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+            self.delete_users()
+            if options['clean']:
+                self.clean()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    def seed(self, options, password):
+        """
+        Creates the synthetic org unless a previous run left it, and the
+        virtual users, not staff, with `password`. Returns (department id,
+        slug, stat title ids) of its departments.
+        """
+        User = get_user_model()
+        if not Company.objects.filter(slug__startswith=f'{PREFIX}-').exists():
+            self.create_org(options)
+        template = User(username=PREFIX)
+        template.set_password(password)
+        self.delete_users()
+        User.objects.bulk_create([
+            User(username=f'{PREFIX}-{i}', email=f'{PREFIX}-{i}@cs.local', password=template.password)
+            for i in range(options['users'])
+        ])
+
+        title_ids = defaultdict(list)
+        for pk, department_id in StatTitle.objects.filter(department__slug__startswith=f'{PREFIX}-') \
+                .values_list('pk', 'department_id'):
+            title_ids[department_id].append(pk)
+        return [(pk, slug, title_ids[pk])
+                for pk, slug in Department.objects.filter(slug__startswith=f'{PREFIX}-').values_list('pk', 'slug')
+                if title_ids[pk]]
+
+    def create_org(self, options):
+        owner, _ = get_user_model().objects.get_or_create(username=f'{PREFIX}-owner')
+        generate(owner, options['companies'], options['departments'], options['titles'], options['stats'],
+                 options['seed'], PREFIX)
+
+    def delete_users(self):
+        # the owner of the seeded org is kept with it
+        users = get_user_model().objects.filter(username__startswith=f'{PREFIX}-').exclude(username=f'{PREFIX}-owner')
+        Stat.objects.filter(owner__in=users).delete()
+        users.delete()
+
+    def clean(self):
+        Company.objects.filter(slug__startswith=f'{PREFIX}-').delete()
+        get_user_model().objects.filter(username=f'{PREFIX}-owner').delete()
+
+    def start_server(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        command = [sys.executable, sys.argv[0], 'runserver', '--noreload', f'127.0.0.1:{port}']
+        if settings.SETTINGS_MODULE:
+            command.append(f'--settings={settings.SETTINGS_MODULE}')
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        started = time.monotonic()
+        while time.monotonic() - started < 30:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return server, f'http://127.0.0.1:{port}'
+            except OSError:
+                if server.poll() is not None:
+                    break
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError('The server did not start.')
+
+    def run(self, base_url, org, password, options):
+        if not org:
+            raise CommandError('The seeded org has no stat titles.')
+        timings, errors = defaultdict(list), defaultdict(int)
+        lock = threading.Lock()
+
+        def record(name, seconds, ok):
+            with lock:
+                timings[name].append(seconds)
+                if not ok:
+                    errors[name] += 1
+
+        weights, journeys = zip(*JOURNEYS)
+        started = {}
+
+        def start():
+            started['at'] = time.monotonic()
+
+        # the clock starts once everyone has logged in, so logins do not skew the throughput
+        logged_in = threading.Barrier(options['users'], action=start)
+
+        def work(i):
+            rng = random.Random(f'{options["seed"]}-{i}')
+            user = VirtualUser(base_url, f'{PREFIX}-{i}', password, org, record, rng)
+            user.login()
+            logged_in.wait()
+            ends = started['at'] + options['duration']
+            while time.monotonic() < ends:
+                user.run_journey(rng.choices(journeys, weights)[0])
+
+        with ThreadPoolExecutor(max_workers=options['users']) as executor:
+            list(executor.map(work, range(options['users'])))
+        elapsed = time.monotonic() - started['at']
+
+        urls = {}
+        for name in sorted(timings):
+            values = sorted(timings[name])
+            urls[name] = {
+                'requests': len(values),
+                'errors': errors[name],
+                'rps': round(len(values) / elapsed, 1),
+                'mean_ms': round(1000 * sum(values) / len(values), 1),
+                'p50_ms': round(1000 * percentile(values, 50), 1),
+                'p95_ms': round(1000 * percentile(values, 95), 1),
+                'p99_ms': round(1000 * percentile(values, 99), 1),
+            }
+        total = sum(url['requests'] for url in urls.values())
+        return {
+            'url': base_url,
+            'users': options['users'],
+            'duration': round(elapsed, 1),
+            'requests': total,
+            'errors': sum(errors.values()),
+            'rps': round(total / elapsed, 1),
+            'urls': urls,
+        }
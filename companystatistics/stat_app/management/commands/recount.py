@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from stat_app.caching import bump_org_version
+from stat_app.models import Company, Department, StatTitle
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the denormalized counters and latest values from the data.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            stat_titles = StatTitle.objects.recount()
+            departments = Department.objects.recount()
+            companies = Company.objects.recount()
+        bump_org_version()
+        self.stdout.write(self.style.SUCCESS(
+            f'Recounted {companies} companies, {departments} departments and {stat_titles} stat titles.'))
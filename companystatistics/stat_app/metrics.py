@@ -0,0 +1,21 @@
+from django.db.models import Count
+from prometheus_client.core import GaugeMetricFamily
+
+from .models import StatImport
+
+
+class ImportQueueCollector:
+    """
+    Stat imports waiting or loading, counted in the database on each scrape.
+    """
+
+    def collect(self):
+        StatImport.objects.fail_stale()
+        statuses = [StatImport.PENDING, StatImport.RUNNING]
+        counts = dict(StatImport.objects.filter(status__in=statuses).values_list('status')
+                      .annotate(count=Count('pk')).order_by())
+        jobs = GaugeMetricFamily('stat_import_jobs', 'Stat imports waiting or loading, by status.',
+                                 labels=['status'])
+        for status in statuses:
+            jobs.add_metric([status], counts.get(status, 0))
+        yield jobs
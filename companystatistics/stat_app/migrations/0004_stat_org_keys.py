@@ -0,0 +1,54 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:06
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def backfill_org_keys(apps, schema_editor):
+    Stat = apps.get_model('stat_app', 'Stat')
+    StatTitle = apps.get_model('stat_app', 'StatTitle')
+    stat_titles = StatTitle.objects.filter(pk=OuterRef('title_id'))
+    Stat.objects.update(
+        department_id=Subquery(stat_titles.values('department_id')[:1]),
+        company_id=Subquery(stat_titles.values('department__company_id')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stat_app', '0003_auto_20200421_1712'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stat',
+            name='company',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='stat_app.Company'),
+        ),
+        migrations.AddField(
+            model_name='stat',
+            name='department',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='stat_app.Department'),
+        ),
+        migrations.RunPython(backfill_org_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='stat',
+            name='company',
+            field=models.ForeignKey(db_index=False, editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='stat_app.Company'),
+        ),
+        migrations.AlterField(
+            model_name='stat',
+            name='department',
+            field=models.ForeignKey(db_index=False, editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='stat_app.Department'),
+        ),
+        migrations.AddIndex(
+            model_name='stat',
+            index=models.Index(fields=['company', 'date'], name='stat_company_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stat',
+            index=models.Index(fields=['department', 'date'], name='stat_department_date_idx'),
+        ),
+    ]
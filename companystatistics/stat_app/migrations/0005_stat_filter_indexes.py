@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stat_app', '0004_stat_org_keys'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stat',
+            index=models.Index(fields=['title', 'date'], name='stat_title_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stat',
+            index=models.Index(fields=['title', 'amount'], name='stat_title_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stat',
+            index=models.Index(fields=['date'], name='stat_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stat',
+            index=models.Index(fields=['updated'], name='stat_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:18
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_subquery(model, field):
+    rows = model.objects.filter(**{field: OuterRef('pk')}).order_by().values(field)
+    return Coalesce(Subquery(rows.annotate(count=Count('pk')).values('count')[:1],
+                             output_field=models.IntegerField()), 0)
+
+
+def backfill_counters(apps, schema_editor):
+    Company = apps.get_model('stat_app', 'Company')
+    Department = apps.get_model('stat_app', 'Department')
+    StatTitle = apps.get_model('stat_app', 'StatTitle')
+    Stat = apps.get_model('stat_app', 'Stat')
+    Company.objects.update(department_count=count_subquery(Department, 'company'))
+    Department.objects.update(stat_title_count=count_subquery(StatTitle, 'department'))
+    latest = Stat.objects.filter(title=OuterRef('pk')).order_by('-date', '-pk')
+    StatTitle.objects.update(stat_count=count_subquery(Stat, 'title'),
+                             last_date=Subquery(latest.values('date')[:1]),
+                             last_amount=Subquery(latest.values('amount')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stat_app', '0005_stat_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='department_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='department',
+            name='stat_title_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='stattitle',
+            name='last_amount',
+            field=models.DecimalField(decimal_places=2, editable=False, max_digits=12, null=True),
+        ),
+        migrations.AddField(
+            model_name='stattitle',
+            name='last_date',
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='stattitle',
+            name='stat_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('stat_app', '0006_org_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatImport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(upload_to='imports/')),
+                ('status', models.CharField(choices=[('pending', 'в очереди'), ('running', 'загружается'), ('done', 'загружен'), ('failed', 'ошибка')], default='pending', max_length=10)),
+                ('progress', models.PositiveSmallIntegerField(default=0)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('inserted', models.PositiveIntegerField(default=0)),
+                ('rejected', models.PositiveIntegerField(default=0)),
+                ('rejected_report', models.FileField(blank=True, upload_to='imports/rejected/')),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stat_imports', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'загрузка данных',
+                'verbose_name_plural': 'загрузки данных',
+                'ordering': ['-created'],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-19 18:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stat_app', '0007_stat_import'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=20)),
+                ('object_id', models.PositiveIntegerField()),
+                ('action', models.CharField(choices=[('upsert', 'изменение'), ('delete', 'удаление')], default='upsert', max_length=6)),
+                ('changed', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'изменение',
+                'verbose_name_plural': 'журнал изменений',
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-19 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stat_app', '0008_change_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statimport',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations
+from django.utils import timezone
+
+# parents first, so a client syncing from since=0 gets them before their children
+MODEL_NAMES = ['company', 'department', 'stattitle', 'stat']
+
+
+def backfill_change_log(apps, schema_editor):
+    """
+    Logs an upsert of every row that existed before the change log, in
+    primary key order per model, with one INSERT ... SELECT each.
+    """
+    connection = schema_editor.connection
+    quote_name = connection.ops.quote_name
+    ChangeLog = apps.get_model('stat_app', 'ChangeLog')
+    changed = connection.ops.adapt_datetimefield_value(timezone.now())
+    with connection.cursor() as cursor:
+        for model_name in MODEL_NAMES:
+            model = apps.get_model('stat_app', model_name)
+            pk_column = quote_name(model._meta.pk.column)
+            cursor.execute(
+                'INSERT INTO {} ({}, {}, {}, {}) SELECT %s, {}, %s, %s FROM {} ORDER BY {}'.format(
+                    quote_name(ChangeLog._meta.db_table),
+                    *(quote_name(ChangeLog._meta.get_field(name).column)
+                      for name in ('model', 'object_id', 'action', 'changed')),
+                    pk_column, quote_name(model._meta.db_table), pk_column),
+                (model_name, 'upsert', changed))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stat_app', '0009_stat_import_updated'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_change_log, migrations.RunPython.noop),
+    ]
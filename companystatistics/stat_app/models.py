@@ -1,11 +1,57 @@
+import datetime
+import os
+
 from django.conf import settings
-from django.db import models
+from django.core.exceptions import EmptyResultSet
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
 from django.contrib.contenttypes.models import ContentType
 
+from .caching import invalidate_org_fragments
+from .live import publish_reload, publish_stat
+
+
+def count_subquery(model, field):
+    """
+    Number of `model` rows whose `field` points at the outer row.
+    """
+    rows = model.objects.filter(**{field: OuterRef('pk')}).order_by().values(field)
+    return Coalesce(Subquery(rows.annotate(count=Count('pk')).values('count')[:1],
+                             output_field=models.IntegerField()), 0)
+
+
+class CountersMixin(object):
+    """
+    Leaves `counter_fields` out of ordinary saves of existing rows: they are
+    changed by F() updates only, and a stale instance would overwrite them.
+    """
+    counter_fields = []
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            skip = set(self.counter_fields) | self.get_deferred_fields()
+            kwargs['update_fields'] = [field.attname for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.attname not in skip]
+        super().save(*args, **kwargs)
+
+
+class CompanyQuerySet(models.QuerySet):
+
+    def recount(self):
+        return self.update(department_count=count_subquery(Department, 'company'))
+
 
-class Company(models.Model):
+class Company(CountersMixin, models.Model):
     title = models.CharField(max_length=100)
     slug = models.SlugField(max_length=100, unique=True)
+    department_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = CompanyQuerySet.as_manager()
+    counter_fields = ['department_count']
 
     class Meta:
         verbose_name = 'компания'
@@ -16,38 +62,199 @@ class Company(models.Model):
         return self.title
 
 
-class Department(models.Model):
+class DepartmentQuerySet(models.QuerySet):
+
+    def recount(self):
+        return self.update(stat_title_count=count_subquery(StatTitle, 'department'))
+
+    def delete(self):
+        with transaction.atomic():
+            company_ids = set(self.values_list('company_id', flat=True))
+            result = super().delete()
+            Company.objects.filter(pk__in=company_ids).recount()
+        return result
+
+
+class Department(CountersMixin, models.Model):
     company = models.ForeignKey(Company,
                                 related_name='departments',
                                 on_delete=models.CASCADE)
     title = models.CharField(max_length=100)
     slug = models.SlugField(max_length=100, unique=True)
     overview = models.CharField(max_length=200, null=True, blank=True)
+    stat_title_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = DepartmentQuerySet.as_manager()
+    counter_fields = ['stat_title_count']
 
     class Meta:
         verbose_name = 'отдел'
         verbose_name_plural = 'отделы'
         ordering = ['title']
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # read __dict__ so a deferred column is not fetched per instance
+        self._loaded_company_id = self.__dict__.get('company_id')
+
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        moved = not adding and self.__dict__.get('company_id') != self._loaded_company_id
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding or moved:
+                Company.objects.filter(pk=self.company_id).update(department_count=F('department_count') + 1)
+            if moved:
+                Company.objects.filter(pk=self._loaded_company_id).update(department_count=F('department_count') - 1)
+                stats = Stat.objects.filter(department=self)
+                stats.update(company_id=self.company_id)
+                ChangeLog.objects.record_queryset(stats)
+        self._loaded_company_id = self.__dict__.get('company_id')
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            Company.objects.filter(pk=self.company_id).update(department_count=F('department_count') - 1)
+        return result
+
+
+class StatTitleQuerySet(models.QuerySet):
 
-class StatTitle(models.Model):
+    def add_stat(self, stat):
+        """
+        Counts a new stat and makes it the latest one unless an older date.
+        """
+        return self.add_stats(1, stat.date, stat.amount)
+
+    def add_stats(self, count, date, amount):
+        """
+        Counts `count` new stats and makes the latest of them, on `date`
+        with `amount`, the latest one unless an older date.
+        """
+        newer = Q(last_date__isnull=True) | Q(last_date__lte=date)
+        return self.update(
+            stat_count=F('stat_count') + count,
+            last_date=Case(When(newer, then=Value(date)), default=F('last_date'),
+                           output_field=models.DateField()),
+            last_amount=Case(When(newer, then=Value(amount)), default=F('last_amount'),
+                             output_field=models.DecimalField()),
+        )
+
+    def refresh_latest(self):
+        latest = Stat.objects.filter(title=OuterRef('pk')).order_by('-date', '-pk')
+        return self.update(last_date=Subquery(latest.values('date')[:1]),
+                           last_amount=Subquery(latest.values('amount')[:1]))
+
+    def recount(self):
+        self.update(stat_count=count_subquery(Stat, 'title'))
+        return self.refresh_latest()
+
+    def delete(self):
+        with transaction.atomic():
+            department_ids = set(self.values_list('department_id', flat=True))
+            result = super().delete()
+            Department.objects.filter(pk__in=department_ids).recount()
+        return result
+
+
+class StatTitle(CountersMixin, models.Model):
     department = models.ForeignKey(Department,
                                    related_name='stat_titles',
                                    on_delete=models.CASCADE)
     title = models.CharField(max_length=100)
     overview = models.CharField(max_length=200, null=True, blank=True)
+    stat_count = models.PositiveIntegerField(default=0, editable=False)
+    last_amount = models.DecimalField(decimal_places=2, max_digits=12, null=True, editable=False)
+    last_date = models.DateField(null=True, editable=False)
+
+    objects = StatTitleQuerySet.as_manager()
+    counter_fields = ['stat_count', 'last_amount', 'last_date']
 
     class Meta:
         verbose_name = 'форма'
         verbose_name_plural = 'формы'
         ordering = ['title']
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # read __dict__ so a deferred column is not fetched per instance
+        self._loaded_department_id = self.__dict__.get('department_id')
+
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        moved = not adding and self.__dict__.get('department_id') != self._loaded_department_id
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding or moved:
+                Department.objects.filter(pk=self.department_id).update(stat_title_count=F('stat_title_count') + 1)
+            if moved:
+                Department.objects.filter(pk=self._loaded_department_id).update(
+                    stat_title_count=F('stat_title_count') - 1)
+                stats = Stat.objects.filter(title=self)
+                stats.update(department_id=self.department_id, company_id=self.department.company_id)
+                ChangeLog.objects.record_queryset(stats)
+        self._loaded_department_id = self.__dict__.get('department_id')
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            Department.objects.filter(pk=self.department_id).update(stat_title_count=F('stat_title_count') - 1)
+        return result
+
+
+class StatQuerySet(models.QuerySet):
+
+    def sync_org_keys(self):
+        """
+        Re-copies department and company keys from the stat titles.
+        """
+        stat_titles = StatTitle.objects.filter(pk=OuterRef('title_id'))
+        return self.update(
+            department_id=Subquery(stat_titles.values('department_id')[:1]),
+            company_id=Subquery(stat_titles.values('department__company_id')[:1]),
+        )
+
+    def series(self):
+        """
+        Chart series as title, date and amount columns ordered by title and date.
+        """
+        titles, dates, amounts = [], [], []
+        for title_id, date, amount in self.order_by('title_id', 'date').values_list('title_id', 'date', 'amount'):
+            titles.append(title_id)
+            dates.append(date)
+            amounts.append(amount)
+        return {'titles': titles, 'dates': dates, 'amounts': amounts}
+
+    def insert_rows(self, rows):
+        """
+        Inserts (owner, title, department, company, amount, date) id and
+        string rows with one executemany, bulk_create spends more time
+        building and adapting model instances than the database takes.
+        """
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        columns = ['owner_id', 'title_id', 'department_id', 'company_id', 'amount', 'date', 'created', 'updated']
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            connection.ops.quote_name(self.model._meta.db_table),
+            ', '.join(connection.ops.quote_name(column) for column in columns),
+            ', '.join(['%s'] * len(columns)))
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [row + (now, now) for row in rows])
+
+    def delete(self):
+        with transaction.atomic():
+            keys = set(self.values_list('title_id', 'department_id'))
+            ChangeLog.objects.record_queryset(self, ChangeLog.DELETE)
+            result = super().delete()
+            StatTitle.objects.filter(pk__in={title_id for title_id, _ in keys}).recount()
+            publish_reload(department_id for _, department_id in keys)
+        return result
+
 
 class Stat(models.Model):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL,
@@ -56,6 +263,17 @@ class Stat(models.Model):
     title = models.ForeignKey(StatTitle,
                               related_name='stats',
                               on_delete=models.CASCADE,)
+    # denormalized from title, so scoped queries do not join the org tree
+    department = models.ForeignKey(Department,
+                                   related_name='stats',
+                                   on_delete=models.CASCADE,
+                                   editable=False,
+                                   db_index=False)
+    company = models.ForeignKey(Company,
+                                related_name='stats',
+                                on_delete=models.CASCADE,
+                                editable=False,
+                                db_index=False)
     amount = models.DecimalField(decimal_places=2, max_digits=12)
     date = models.DateField()
     created = models.DateTimeField(auto_now_add=True)
@@ -65,6 +283,202 @@ class Stat(models.Model):
         verbose_name = 'данные'
         verbose_name_plural = 'данные'
         ordering = ['date']
+        indexes = [
+            models.Index(fields=['company', 'date'], name='stat_company_date_idx'),
+            models.Index(fields=['department', 'date'], name='stat_department_date_idx'),
+            models.Index(fields=['title', 'date'], name='stat_title_date_idx'),
+            models.Index(fields=['title', 'amount'], name='stat_title_amount_idx'),
+            models.Index(fields=['date'], name='stat_date_idx'),
+            models.Index(fields=['updated'], name='stat_updated_idx'),
+        ]
+
+    objects = StatQuerySet.as_manager()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # read __dict__ so a deferred column is not fetched per instance
+        self._loaded_title_id = self.__dict__.get('title_id')
 
     def __str__(self):
         return f'{self.date} | {self.amount} | {self.owner}'
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        self.sync_org_keys()
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                StatTitle.objects.filter(pk=self.title_id).add_stat(self)
+            elif self.title_id != self._loaded_title_id:
+                StatTitle.objects.filter(pk=self.title_id).update(stat_count=F('stat_count') + 1)
+                StatTitle.objects.filter(pk=self._loaded_title_id).update(stat_count=F('stat_count') - 1)
+                StatTitle.objects.filter(pk__in=[self.title_id, self._loaded_title_id]).refresh_latest()
+            else:
+                StatTitle.objects.filter(pk=self.title_id).refresh_latest()
+        self._loaded_title_id = self.title_id
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            ChangeLog.objects.record(Stat, [self.pk], ChangeLog.DELETE)
+            result = super().delete(*args, **kwargs)
+            stat_titles = StatTitle.objects.filter(pk=self.title_id)
+            stat_titles.update(stat_count=F('stat_count') - 1)
+            stat_titles.refresh_latest()
+            publish_reload([self.department_id])
+        return result
+
+    def sync_org_keys(self):
+        """
+        Copies department and company keys from the stat title.
+        """
+        self.department_id = self.title.department_id
+        self.company_id = self.title.department.company_id
+
+
+class StatImportQuerySet(models.QuerySet):
+
+    def fail_stale(self):
+        """
+        Fails the pending and running imports without progress for
+        STAT_IMPORT_STALE_AFTER seconds: their thread died with its worker.
+        """
+        now = timezone.now()
+        return self.filter(
+            status__in=[StatImport.PENDING, StatImport.RUNNING],
+            updated__lt=now - datetime.timedelta(seconds=settings.STAT_IMPORT_STALE_AFTER),
+        ).update(status=StatImport.FAILED, error='Загрузка прервана перезапуском сервера.', finished=now)
+
+
+class StatImport(models.Model):
+    """
+    A file of stats uploaded through the admin, loaded in the background.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'в очереди'),
+        (RUNNING, 'загружается'),
+        (DONE, 'загружен'),
+        (FAILED, 'ошибка'),
+    ]
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL,
+                              related_name='stat_imports',
+                              on_delete=models.CASCADE)
+    file = models.FileField(upload_to='imports/')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    progress = models.PositiveSmallIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    inserted = models.PositiveIntegerField(default=0)
+    rejected = models.PositiveIntegerField(default=0)
+    rejected_report = models.FileField(upload_to='imports/rejected/', blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    # the last progress of the import
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    objects = StatImportQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'загрузка данных'
+        verbose_name_plural = 'загрузки данных'
+        ordering = ['-created']
+
+    def __str__(self):
+        return os.path.basename(self.file.name)
+
+
+class ChangeLogQuerySet(models.QuerySet):
+
+    def record(self, model, ids, action='upsert'):
+        """
+        Logs a change of the `model` rows with the primary keys `ids`.
+        """
+        return self.bulk_create([ChangeLog(model=model._meta.model_name, object_id=pk, action=action)
+                                 for pk in ids])
+
+    def record_queryset(self, queryset, action='upsert'):
+        """
+        Logs a change of every row of `queryset` with one INSERT ... SELECT.
+        """
+        pk_column = queryset.model._meta.pk.column
+        try:
+            sql, params = queryset.order_by().values_list('pk').query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        quote_name = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {} ({}, {}, {}, {}) SELECT %s, changed_rows.{}, %s, %s FROM ({}) changed_rows'.format(
+                    quote_name(ChangeLog._meta.db_table),
+                    *(quote_name(ChangeLog._meta.get_field(name).column)
+                      for name in ('model', 'object_id', 'action', 'changed')),
+                    quote_name(pk_column), sql),
+                (queryset.model._meta.model_name, action,
+                 connection.ops.adapt_datetimefield_value(timezone.now())) + tuple(params))
+            return cursor.rowcount
+
+
+class ChangeLog(models.Model):
+    """
+    Inserts, updates and deletes of companies, departments, stat titles and
+    stats, in the order of the monotonic id that the change feed pages by.
+
+    The deletion of a parent also deletes its children, which are not logged
+    one by one. Counters and latest values are derived and not logged.
+    """
+    UPSERT = 'upsert'
+    DELETE = 'delete'
+    ACTION_CHOICES = [
+        (UPSERT, 'изменение'),
+        (DELETE, 'удаление'),
+    ]
+
+    model = models.CharField(max_length=20)
+    object_id = models.PositiveIntegerField()
+    action = models.CharField(max_length=6, choices=ACTION_CHOICES, default=UPSERT)
+    changed = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = ChangeLogQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'изменение'
+        verbose_name_plural = 'журнал изменений'
+        ordering = ['id']
+
+    def __str__(self):
+        return f'{self.id} | {self.action} {self.model} {self.object_id}'
+
+
+@receiver(post_save, sender=Company)
+@receiver(post_save, sender=Department)
+@receiver(post_save, sender=StatTitle)
+@receiver(post_delete, sender=Company)
+@receiver(post_delete, sender=Department)
+@receiver(post_delete, sender=StatTitle)
+def org_changed(sender, **kwargs):
+    invalidate_org_fragments()
+
+
+@receiver(post_save, sender=Company)
+@receiver(post_save, sender=Department)
+@receiver(post_save, sender=StatTitle)
+@receiver(post_save, sender=Stat)
+def log_save(sender, instance, **kwargs):
+    ChangeLog.objects.record(sender, [instance.pk])
+
+
+@receiver(post_save, sender=Stat)
+def publish_saved_stat(sender, instance, created, **kwargs):
+    publish_stat(instance, created)
+
+
+# stats get no post_delete receiver, it would turn off fast deletes of their cascades
+@receiver(post_delete, sender=Company)
+@receiver(post_delete, sender=Department)
+@receiver(post_delete, sender=StatTitle)
+def log_delete(sender, instance, **kwargs):
+    ChangeLog.objects.record(sender, [instance.pk], ChangeLog.DELETE)
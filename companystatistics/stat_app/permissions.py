@@ -0,0 +1,18 @@
+from rest_framework import permissions
+
+
+class ActionPermissionsMixin(object):
+    """
+    Any authenticated user may run `authenticated_actions`, the rest is for staff.
+    """
+    authenticated_actions = ['list', 'retrieve']
+
+    def get_permissions(self):
+        """
+        Instantiates and returns the list of permissions that this view requires.
+        """
+        if self.action in self.authenticated_actions:
+            permission_classes = [permissions.IsAuthenticated]
+        else:
+            permission_classes = [permissions.IsAdminUser]
+        return [permission() for permission in permission_classes]
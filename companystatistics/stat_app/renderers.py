@@ -0,0 +1,121 @@
+import datetime
+import io
+import json
+
+from rest_framework import renderers
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def epoch_day(date):
+    return date.toordinal() - EPOCH_ORDINAL
+
+
+def to_stats_dict(series):
+    """
+    Groups series columns per stat title in the layout the charts read.
+    """
+    stats_dict = {}
+    for title_id, date, amount in zip(series['titles'], series['dates'], series['amounts']):
+        stat_dict = stats_dict.setdefault(str(title_id), {'default': [], 'labels': []})
+        stat_dict['default'].append(float(amount))
+        stat_dict['labels'].append(str(date))
+    return stats_dict
+
+
+class SeriesRendererMixin:
+    """
+    Turns series columns into plain lists: dates as epoch days, amounts as floats.
+
+    Anything that is not a series (e.g. an error response) is passed through.
+    """
+
+    def get_columns(self, data):
+        if not isinstance(data, dict) or 'dates' not in data:
+            return data
+        return {
+            'titles': list(data['titles']),
+            'dates': [epoch_day(date) for date in data['dates']],
+            'amounts': [float(amount) for amount in data['amounts']],
+        }
+
+
+class ColumnarJSONRenderer(SeriesRendererMixin, renderers.BaseRenderer):
+    media_type = 'application/vnd.companystatistics.columnar+json'
+    format = 'columnar'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return json.dumps(self.get_columns(data), separators=(',', ':')).encode()
+
+
+class MessagePackRenderer(SeriesRendererMixin, renderers.BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(self.get_columns(data), default=str)
+
+
+class ArrowRenderer(renderers.BaseRenderer):
+    """
+    Renders series as an Arrow IPC stream with title, date and amount columns.
+    """
+    media_type = 'application/vnd.apache.arrow.stream'
+    format = 'arrow'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, dict) and 'dates' in data:
+            table = pyarrow.table({
+                'title': pyarrow.array(data['titles'], pyarrow.int32()),
+                'date': pyarrow.array(data['dates'], pyarrow.date32()),
+                'amount': pyarrow.array([float(amount) for amount in data['amounts']], pyarrow.float64()),
+            })
+        else:
+            table = pyarrow.table({'detail': [json.dumps(data, default=str)]})
+        sink = io.BytesIO()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue()
+
+
+class EventStreamRenderer(renderers.BaseRenderer):
+    """
+    Lets EventSource requests (`Accept: text/event-stream`) through content
+    negotiation. The stream itself is streamed by the view, only errors are
+    rendered, as an `error` event.
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return f'event: error\ndata: {json.dumps(data)}\n\n'.encode()
+
+
+SERIES_RENDERER_CLASSES = [renderers.JSONRenderer, ColumnarJSONRenderer]
+if msgpack is not None:
+    SERIES_RENDERER_CLASSES.append(MessagePackRenderer)
+if pyarrow is not None:
+    SERIES_RENDERER_CLASSES.append(ArrowRenderer)
@@ -1,10 +1,74 @@
-from rest_framework import serializers
+import datetime
 
-from .models import Company, Department, StatTitle, Stat
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+from rest_framework import permissions, serializers
+
+from .caching import invalidate_org_fragments
+from .live import publish_reload
+from .models import ChangeLog, Company, Department, StatTitle, Stat
+
+
+def batched(items, size):
+    """
+    Splits a list into lists of at most `size` items.
+    """
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+class SparseFieldsetsMixin:
+    """
+    Limits the serialized fields by the `fields` and `omit` query parameters.
+
+    Both take a comma-separated list of field names, e.g. `?fields=date,amount`.
+    Unknown names are a validation error, so a typo does not empty the objects.
+    """
+    # relation name: queryset its serialized objects are prefetched with
+    related_querysets = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method not in permissions.SAFE_METHODS:
+            return
+        fields = request.query_params.get('fields')
+        omit = request.query_params.get('omit')
+        errors = {}
+        for param, value in (('fields', fields), ('omit', omit)):
+            unknown = set(value.split(',')) - set(self.fields) if value else set()
+            if unknown:
+                errors[param] = [f'Unknown fields: {", ".join(sorted(unknown))}.']
+        if errors:
+            raise serializers.ValidationError(errors)
+        if fields:
+            for field_name in set(self.fields) - set(fields.split(',')):
+                self.fields.pop(field_name)
+        if omit:
+            for field_name in omit.split(','):
+                self.fields.pop(field_name, None)
+
+    def optimize_queryset(self, queryset):
+        """
+        Loads only the columns and relations read by the serialized fields.
+        """
+        columns, relations = [], []
+        for field in self.fields.values():
+            try:
+                model_field = queryset.model._meta.get_field(field.source)
+            except FieldDoesNotExist:
+                continue
+            if model_field.concrete and not model_field.many_to_many:
+                columns.append(model_field.name)
+            elif model_field.is_relation:
+                relations.append(Prefetch(field.source, self.related_querysets.get(field.source)))
+        return queryset.only(*columns or [queryset.model._meta.pk.name]).prefetch_related(*relations)
 
 
 # class CompanySerializer(serializers.HyperlinkedModelSerializer):
-class CompanySerializer(serializers.ModelSerializer):
+class CompanySerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     departments = serializers.StringRelatedField(many=True, read_only=True)
 
     class Meta:
@@ -14,7 +78,7 @@ class CompanySerializer(serializers.ModelSerializer):
 
 
 # class DepartmentSerializer(serializers.HyperlinkedModelSerializer):
-class DepartmentSerializer(serializers.Serializer):
+class DepartmentSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     stat_titles = serializers.StringRelatedField(many=True, read_only=True)
 
     class Meta:
@@ -24,18 +88,276 @@ class DepartmentSerializer(serializers.Serializer):
 
 
 # class StatTitleSerializer(serializers.HyperlinkedModelSerializer):
-class StatTitleSerializer(serializers.ModelSerializer):
+class StatTitleSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     stats = serializers.StringRelatedField(many=True, read_only=True)
+    # str(stat) shows its owner
+    related_querysets = {'stats': Stat.objects.select_related('owner')}
 
     class Meta:
         model = StatTitle
         # fields = ['id', 'title', 'overview', 'stats']
-        fields = '__all__'
+        exclude = ['last_amount', 'last_date']
 
 
 # class StatSerializer(serializers.HyperlinkedModelSerializer):
-class StatSerializer(serializers.ModelSerializer):
+class StatSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     class Meta:
         model = Stat
         # fields = ['id', 'amount', 'date']
         fields = '__all__'
+
+
+class StatBulkUpdateListSerializer(serializers.ListSerializer):
+    """
+    Validates a list of stat changes as a whole and applies them with bulk_update.
+    """
+
+    def validate(self, attrs):
+        ids = [item['id'] for item in attrs]
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError('Stat ids must be unique.')
+        found = set()
+        for batch in batched(ids, settings.STAT_BULK_BATCH_SIZE):
+            found.update(Stat.objects.filter(pk__in=batch).values_list('pk', flat=True))
+        if len(found) != len(ids):
+            raise serializers.ValidationError(f'Unknown stat ids: {sorted(set(ids) - found)}.')
+        title_ids = {item['title'] for item in attrs if 'title' in item}
+        if title_ids - set(StatTitle.objects.filter(pk__in=title_ids).values_list('pk', flat=True)):
+            raise serializers.ValidationError('Unknown stat titles.')
+        owner_ids = {item['owner'] for item in attrs if 'owner' in item}
+        owner_model = Stat._meta.get_field('owner').related_model
+        if owner_ids - set(owner_model.objects.filter(pk__in=owner_ids).values_list('pk', flat=True)):
+            raise serializers.ValidationError('Unknown owners.')
+        return attrs
+
+    def update(self, queryset, validated_data):
+        """
+        Applies the changes in batches in one transaction, returns the number of updated stats.
+        """
+        now = timezone.now()
+        title_ids = set()
+        with transaction.atomic():
+            for batch in batched(validated_data, settings.STAT_BULK_BATCH_SIZE):
+                changes = {item.pop('id'): item for item in batch}
+                stats = queryset.in_bulk(list(changes))
+                fields, moved = {'updated'}, []
+                for stat_id, stat in stats.items():
+                    title_ids.add(stat.title_id)
+                    for name, value in changes[stat_id].items():
+                        setattr(stat, Stat._meta.get_field(name).attname, value)
+                        fields.add(name)
+                    if stat.title_id != stat._loaded_title_id:
+                        moved.append(stat_id)
+                        title_ids.add(stat.title_id)
+                    stat.updated = now
+                Stat.objects.bulk_update(stats.values(), fields)
+                ChangeLog.objects.record(Stat, stats)
+                if moved:
+                    Stat.objects.filter(pk__in=moved).sync_org_keys()
+            StatTitle.objects.filter(pk__in=title_ids).recount()
+            publish_reload(StatTitle.objects.filter(pk__in=title_ids).values_list('department_id', flat=True))
+        return len(validated_data)
+
+
+class StatBulkUpdateSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField()
+    # plain ids, checked for the whole list at once
+    title = serializers.IntegerField(required=False)
+    owner = serializers.IntegerField(required=False)
+
+    class Meta:
+        model = Stat
+        fields = ['id', 'title', 'owner', 'amount', 'date']
+        extra_kwargs = {'amount': {'required': False}, 'date': {'required': False}}
+        list_serializer_class = StatBulkUpdateListSerializer
+
+
+class StatBulkDeleteSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+
+class OrgStatTitleSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = StatTitle
+        fields = ['title', 'overview']
+
+
+class OrgDepartmentSerializer(serializers.ModelSerializer):
+    # existing slugs are updated, so no unique validator
+    slug = serializers.SlugField(max_length=100)
+    stat_titles = OrgStatTitleSerializer(many=True, required=False)
+
+    class Meta:
+        model = Department
+        fields = ['title', 'slug', 'overview', 'stat_titles']
+
+
+class OrgCompanySerializer(serializers.ModelSerializer):
+    slug = serializers.SlugField(max_length=100)
+    departments = OrgDepartmentSerializer(many=True, required=False)
+
+    class Meta:
+        model = Company
+        fields = ['title', 'slug', 'departments']
+
+
+class OrgTreeSerializer(serializers.Serializer):
+    """
+    Creates or updates companies, their departments and stat titles from one tree.
+
+    Companies and departments are matched by slug, stat titles by title within
+    the department. Each level is written with one bulk_create and one bulk_update.
+    """
+    companies = OrgCompanySerializer(many=True)
+
+    def validate_companies(self, companies):
+        def check_unique(keys, message):
+            if len(set(keys)) != len(keys):
+                raise serializers.ValidationError(message)
+
+        departments = [department for company in companies for department in company.get('departments', [])]
+        check_unique([company['slug'] for company in companies], 'Company slugs must be unique.')
+        check_unique([department['slug'] for department in departments], 'Department slugs must be unique.')
+        for department in departments:
+            check_unique([stat_title['title'] for stat_title in department.get('stat_titles', [])],
+                         f'Stat titles of {department["slug"]} must be unique.')
+        return companies
+
+    def create(self, validated_data):
+        """
+        Returns the numbers of created and updated rows per level.
+        """
+        report = {}
+        company_nodes = validated_data['companies']
+        department_nodes = [dict(node, company=company_node['slug'])
+                            for company_node in company_nodes for node in company_node.get('departments', [])]
+        with transaction.atomic():
+            company_slugs = [node['slug'] for node in company_nodes]
+            companies, report['companies'] = self.save_level(
+                Company, company_nodes, ['title', 'slug'],
+                lambda: Company.objects.in_bulk(company_slugs, field_name='slug'),
+                key=lambda node: node['slug'])
+
+            for node in department_nodes:
+                node['company_id'] = companies[node.pop('company')].pk
+            department_slugs = [node['slug'] for node in department_nodes]
+            old_company_ids = dict(Department.objects.filter(slug__in=department_slugs).values_list('pk', 'company_id'))
+            departments, report['departments'] = self.save_level(
+                Department, department_nodes, ['company_id', 'title', 'slug', 'overview'],
+                lambda: Department.objects.in_bulk(department_slugs, field_name='slug'),
+                key=lambda node: node['slug'])
+
+            department_ids = [department.pk for department in departments.values()]
+            stat_title_nodes = [dict(node, department_id=departments[department_node['slug']].pk)
+                                for department_node in department_nodes
+                                for node in department_node.get('stat_titles', [])]
+            _, report['stat_titles'] = self.save_level(
+                StatTitle, stat_title_nodes, ['department_id', 'title', 'overview'],
+                lambda: {(stat_title.department_id, stat_title.title): stat_title
+                         for stat_title in StatTitle.objects.filter(department_id__in=department_ids)},
+                key=lambda node: (node['department_id'], node['title']))
+
+            if any(counts['created'] or counts['updated'] for counts in report.values()):
+                company_ids = {department.pk: department.company_id for department in departments.values()}
+                moved = [pk for pk, company_id in old_company_ids.items() if company_ids[pk] != company_id]
+                stats = Stat.objects.filter(department_id__in=moved)
+                stats.sync_org_keys()
+                ChangeLog.objects.record_queryset(stats)
+                # bulk writes skip the counters kept by save()
+                Company.objects.filter(pk__in=[company.pk for company in companies.values()]
+                                       + list(old_company_ids.values())).recount()
+                Department.objects.filter(pk__in=department_ids).recount()
+                invalidate_org_fragments()
+        return report
+
+    def save_level(self, model, nodes, fields, fetch, key):
+        """
+        Creates the missing rows of one level and updates the changed ones,
+        returns the rows of the level by key and the counts.
+        """
+        existing = fetch()
+        created, updated, updated_fields = [], [], set()
+        for node in nodes:
+            values = {field: node[field] for field in fields if field in node}
+            instance = existing.get(key(node))
+            if instance is None:
+                created.append(model(**values))
+                continue
+            changed = {field: value for field, value in values.items() if getattr(instance, field) != value}
+            if changed:
+                for field, value in changed.items():
+                    setattr(instance, field, value)
+                updated.append(instance)
+                updated_fields.update(changed)
+        model.objects.bulk_create(created)
+        if updated:
+            model.objects.bulk_update(updated, updated_fields)
+        counts = {'created': len(created), 'updated': len(updated)}
+        # bulk_create does not set primary keys on every backend, so read them back
+        rows = fetch() if created else existing
+        ChangeLog.objects.record(model, [instance.pk for instance in updated] +
+                                 [row.pk for key, row in rows.items() if key not in existing])
+        return rows, counts
+
+
+class ChangesQuerySerializer(serializers.Serializer):
+    since = serializers.IntegerField(min_value=0, default=0)
+    limit = serializers.IntegerField(min_value=1, required=False)
+
+    def validate_limit(self, limit):
+        return min(limit, settings.CHANGE_FEED_PAGE_SIZE)
+
+
+class LiveQuerySerializer(serializers.Serializer):
+    department = serializers.IntegerField(required=False)
+    title = serializers.IntegerField(required=False)
+
+    def validate(self, attrs):
+        if not attrs:
+            raise serializers.ValidationError('Pass department or title.')
+        return attrs
+
+
+class DashboardQuerySerializer(serializers.Serializer):
+    """
+    Period of the dashboard, the last DASHBOARD_PERIOD_DAYS days by default.
+    """
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+
+    def validate(self, attrs):
+        period = datetime.timedelta(days=settings.DASHBOARD_PERIOD_DAYS - 1)
+        date_to = attrs.get('date_to') or timezone.localdate()
+        date_from = attrs.get('date_from') or date_to - period
+        if date_from > date_to:
+            raise serializers.ValidationError('date_from must not be later than date_to.')
+        if (date_to - date_from).days >= settings.DASHBOARD_MAX_DAYS:
+            raise serializers.ValidationError(
+                f'The period must not be longer than {settings.DASHBOARD_MAX_DAYS} days.')
+        return {'date_from': date_from, 'date_to': date_to}
+
+
+class BatchItemSerializer(serializers.Serializer):
+    method = serializers.ChoiceField(['GET', 'POST', 'PUT', 'PATCH', 'DELETE'], default='GET')
+    path = serializers.CharField()
+    body = serializers.JSONField(required=False)
+
+
+class BatchSerializer(serializers.Serializer):
+    """
+    Sub-requests of a batch: `atomic` runs them in one transaction,
+    `parallel` runs them concurrently, reads only.
+    """
+    requests = BatchItemSerializer(many=True, allow_empty=False)
+    atomic = serializers.BooleanField(default=False)
+    parallel = serializers.BooleanField(default=False)
+
+    def validate_requests(self, requests):
+        if len(requests) > settings.BATCH_MAX_REQUESTS:
+            raise serializers.ValidationError(f'At most {settings.BATCH_MAX_REQUESTS} requests.')
+        return requests
+
+    def validate(self, attrs):
+        if attrs['parallel'] and (attrs['atomic'] or any(item['method'] != 'GET' for item in attrs['requests'])):
+            raise serializers.ValidationError('Only reads can run in parallel.')
+        return attrs
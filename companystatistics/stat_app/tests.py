@@ -1,13 +1,40 @@
 import datetime
-
+import json
+import os
+import random
+import tempfile
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock, skipIf
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase, Client
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import LiveServerTestCase, TestCase, TransactionTestCase, Client
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APITestCase
-
-from .models import Company, Department, StatTitle, Stat
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APITestCase, APIRequestFactory
+
+from . import generating, importing
+from .filters import StatFilterBackend
+from .generating import generate, generate_series
+from .importing import openpyxl
+from .loading import plan
+from .management.commands.load_stats import Command as LoadStatsCommand
+from .management.commands.loadtest import percentile
+from .live import LocalBroadcaster, department_channel, get_broadcaster, title_channel
+from .models import ChangeLog, Company, Department, StatTitle, Stat, StatImport
+from .renderers import msgpack, pyarrow
 from .serializers import CompanySerializer, DepartmentSerializer, StatTitleSerializer, StatSerializer
+from .views import StatViewSet
 
 User = get_user_model()
 
@@ -140,6 +167,22 @@ class TestStatPagesEditor(TestStatPages):
         response = self.client.get(f'/stat/{stat_title.id}/stat_edit/')
         self.assertEqual(response.status_code, 200)
 
+    def test_department_detail_embeds_series(self):
+        User.objects.create_user(username='staff', password='staff', email='staff@cs.local', is_staff=True)
+        self.client.login(username='staff', password='staff')
+        stat_title = StatTitle.objects.first()
+        response = self.client.get('/stat/otdel-1/')
+        self.assertEqual(response.context['stats_dict'],
+                         {str(stat_title.id): {'default': [2.5], 'labels': ['2020-03-23']}})
+        self.assertContains(response, '<script id="statsData" type="application/json">')
+
+    def test_department_detail_skips_series_for_users(self):
+        User.objects.create_user(username='user', password='user', email='user@cs.local')
+        self.client.login(username='user', password='user')
+        response = self.client.get('/stat/otdel-1/')
+        self.assertNotIn('stats_dict', response.context)
+        self.assertNotContains(response, 'statsData')
+
 
 class CreateCompanyAPITest(APITestCase):
     def setUp(self):
@@ -326,7 +369,7 @@ class UpdateDepartmentTest(APITestCase):
         """
         self.user = User.objects.create_user('user', 'user@cs.local', 'user', is_staff=True)
         self.client.login(username='user', password='user')
-        response = self.client.put(reverse(self.url, args=[self.department.id]), self.data)
+        response = self.client.put(reverse(self.url, args=[self.department.id]), self.data, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(Department.objects.count(), 1)
         self.assertEqual(Department.objects.get().title, 'Отдел 2')
@@ -338,7 +381,7 @@ class UpdateDepartmentTest(APITestCase):
         """
         self.user = User.objects.create_user('user', 'user@cs.local', 'user', is_staff=False)
         self.client.login(username='user', password='user')
-        response = self.client.put(reverse(self.url, args=[self.department.id]), self.data)
+        response = self.client.put(reverse(self.url, args=[self.department.id]), self.data, format='json')
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
 
@@ -590,6 +633,23 @@ class UpdateStatTest(APITestCase):
         self.assertEqual(Stat.objects.count(), 1)
         self.assertEqual(Stat.objects.get().amount, 4.0)
 
+    def test_update_is_validated(self):
+        """
+        Ensure invalid changes are rejected and nothing is written.
+        """
+        user = User.objects.create_user('user', 'user@cs.local', 'user', is_staff=True)
+        self.client.login(username='user', password='user')
+        stat = Stat.objects.create(owner=user, title=self.stat_title, amount=2.5, date='2020-04-20')
+        url = reverse(self.url, args=[stat.id])
+        for method, data in [('patch', {'amount': 'много'}),
+                             ('patch', {'title': 0}),
+                             ('patch', {'date': '2020-13-01'}),
+                             ('put', {'amount': 4.0})]:
+            response = getattr(self.client, method)(url, data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, data)
+        stat.refresh_from_db()
+        self.assertEqual((stat.amount, stat.date, stat.title_id), (2.5, datetime.date(2020, 4, 20), self.stat_title.id))
+
     def test_can_not_update_stat(self):
         """
         Ensure common user can not update a stat object.
@@ -635,3 +695,1251 @@ class DeleteStatTest(APITestCase):
         response = self.client.delete(reverse(self.url, args=[stat.id]))
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
         self.assertEqual(Stat.objects.count(), 1)
+
+
+class BulkStatTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@cs.local', 'user', is_staff=True)
+        self.company = Company.objects.create(title='Рога и копыта', slug='Roga-i-Kopyta')
+        self.department = Department.objects.create(company=self.company, title='Отдел 1', slug='Otdel-1')
+        self.other_department = Department.objects.create(company=self.company, title='Отдел 2', slug='Otdel-2')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+        self.other_title = StatTitle.objects.create(department=self.other_department, title='Продажа копыт')
+        self.stats = [Stat.objects.create(owner=self.user, title=self.stat_title, amount=day, date=f'2020-04-{day:02}')
+                      for day in range(1, 11)]
+        self.url = reverse('stat_app:stat-bulk')
+        self.client.login(username='user', password='user')
+
+    def test_bulk_update(self):
+        data = [{'id': stat.id, 'amount': 100} for stat in self.stats[:5]]
+        data.append({'id': self.stats[-1].id, 'title': self.other_title.id, 'date': '2020-05-01'})
+        with self.settings(STAT_BULK_BATCH_SIZE=4):
+            response = self.client.patch(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'updated': 6})
+        self.assertEqual(Stat.objects.filter(amount=100).count(), 5)
+        moved = Stat.objects.get(pk=self.stats[-1].id)
+        self.assertEqual((moved.title_id, moved.department_id), (self.other_title.id, self.other_department.id))
+        self.stat_title.refresh_from_db()
+        self.other_title.refresh_from_db()
+        self.assertEqual((self.stat_title.stat_count, self.stat_title.last_amount), (9, 9))
+        self.assertEqual((self.other_title.stat_count, self.other_title.last_date), (1, datetime.date(2020, 5, 1)))
+
+    def test_bulk_update_is_validated(self):
+        for data in ([{'id': self.stats[0].id, 'amount': 'много'}],
+                     [{'id': self.stats[0].id, 'title': 0}],
+                     [{'id': 0, 'amount': 1}],
+                     [{'id': self.stats[0].id, 'amount': 5}, {'id': self.stats[0].id}],
+                     [{'amount': 5}]):
+            response = self.client.patch(self.url, data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, data)
+        self.assertEqual(list(Stat.objects.values_list('amount', flat=True)), list(range(1, 11)))
+        self.assertEqual(Stat.objects.get(pk=self.stats[0].id).title_id, self.stat_title.id)
+
+    def test_bulk_delete_by_ids(self):
+        with self.settings(STAT_BULK_BATCH_SIZE=3):
+            response = self.client.delete(self.url, {'ids': [stat.id for stat in self.stats[:7]]}, format='json')
+        self.assertEqual(response.data, {'deleted': 7})
+        self.stat_title.refresh_from_db()
+        self.assertEqual((self.stat_title.stat_count, self.stat_title.last_amount), (3, 10))
+
+    def test_bulk_delete_by_filter(self):
+        response = self.client.delete(f'{self.url}?title={self.stat_title.id}&date_from=2020-04-05')
+        self.assertEqual(response.data, {'deleted': 6})
+        self.stat_title.refresh_from_db()
+        self.assertEqual((self.stat_title.stat_count, self.stat_title.last_amount), (4, 4))
+
+    def test_bulk_delete_needs_ids_or_filter(self):
+        response = self.client.delete(self.url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Stat.objects.count(), 10)
+
+    def test_common_user_can_not_bulk_update(self):
+        User.objects.create_user('common', 'common@cs.local', 'common')
+        self.client.login(username='common', password='common')
+        response = self.client.patch(self.url, [{'id': self.stats[0].id, 'amount': 1}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.delete(self.url, {'ids': [self.stats[0].id]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class OrgTreeTest(APITestCase):
+    def setUp(self):
+        User.objects.create_user('user', 'user@cs.local', 'user', is_staff=True)
+        self.client.login(username='user', password='user')
+        self.url = reverse('stat_app:company-tree')
+        self.tree = {'companies': [
+            {'title': 'Рога и копыта', 'slug': 'roga-i-kopyta', 'departments': [
+                {'title': 'Отдел 1', 'slug': 'otdel-1', 'stat_titles': [
+                    {'title': 'Продажа рогов'}, {'title': 'Продажа копыт', 'overview': 'Копыта'}]},
+                {'title': 'Отдел 2', 'slug': 'otdel-2'},
+            ]},
+            {'title': 'Копыта и рога', 'slug': 'kopyta-i-roga'},
+        ]}
+
+    def test_create_tree(self):
+        response = self.client.post(self.url, self.tree, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'companies': {'created': 2, 'updated': 0},
+                                         'departments': {'created': 2, 'updated': 0},
+                                         'stat_titles': {'created': 2, 'updated': 0}})
+        company = Company.objects.get(slug='roga-i-kopyta')
+        department = Department.objects.get(slug='otdel-1')
+        self.assertEqual(company.department_count, 2)
+        self.assertEqual(department.stat_title_count, 2)
+        self.assertEqual(StatTitle.objects.get(title='Продажа копыт').overview, 'Копыта')
+
+    def test_rerun_changes_nothing(self):
+        self.client.post(self.url, self.tree, format='json')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, self.tree, format='json')
+        self.assertEqual(response.data, {level: {'created': 0, 'updated': 0}
+                                         for level in ('companies', 'departments', 'stat_titles')})
+        self.assertFalse([query for query in queries if query['sql'].startswith(('INSERT', 'UPDATE "stat_app'))])
+
+    def test_update_and_move(self):
+        self.client.post(self.url, self.tree, format='json')
+        user = User.objects.get()
+        stat = Stat.objects.create(owner=user, title=StatTitle.objects.get(title='Продажа рогов'),
+                                   amount=1, date='2020-04-01')
+        companies = self.tree['companies']
+        companies[1]['departments'] = [companies[0]['departments'].pop(0)]
+        companies[1]['departments'][0]['stat_titles'][1]['overview'] = 'Копыта оптом'
+        companies[1]['departments'][0]['stat_titles'].append({'title': 'Продажа хвостов'})
+        response = self.client.post(self.url, self.tree, format='json')
+        self.assertEqual(response.data, {'companies': {'created': 0, 'updated': 0},
+                                         'departments': {'created': 0, 'updated': 1},
+                                         'stat_titles': {'created': 1, 'updated': 1}})
+        other_company = Company.objects.get(slug='kopyta-i-roga')
+        stat.refresh_from_db()
+        self.assertEqual(stat.company_id, other_company.id)
+        self.assertEqual(other_company.department_count, 1)
+        self.assertEqual(Company.objects.get(slug='roga-i-kopyta').department_count, 1)
+        self.assertEqual(Department.objects.get(slug='otdel-1').stat_title_count, 3)
+
+    def test_duplicate_slugs(self):
+        self.tree['companies'][1]['departments'] = [{'title': 'Отдел 1', 'slug': 'otdel-1'}]
+        response = self.client.post(self.url, self.tree, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Company.objects.exists())
+
+    def test_common_user_can_not_load_tree(self):
+        User.objects.create_user('common', 'common@cs.local', 'common')
+        self.client.login(username='common', password='common')
+        response = self.client.post(self.url, self.tree, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_load_org_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', encoding='utf-8') as f:
+            json.dump(self.tree, f)
+            f.flush()
+            out = StringIO()
+            call_command('load_org', f.name, stdout=out)
+        self.assertIn('departments: 2 created, 0 updated', out.getvalue())
+        self.assertEqual(StatTitle.objects.count(), 2)
+
+
+class StatImportTest(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = self.settings(MEDIA_ROOT=media_root.name, STAT_IMPORT_IN_BACKGROUND=False, STAT_IMPORT_BATCH_SIZE=2)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        User.objects.create_superuser('admin', 'admin@cs.local', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.company = Company.objects.create(title='Рога и копыта', slug='roga-i-kopyta')
+        self.department = Department.objects.create(company=self.company, title='Отдел 1', slug='otdel-1')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+
+    def upload(self, name, content):
+        upload = SimpleUploadedFile(name, content)
+        return self.client.post(reverse('admin:stat_app_stat_import'), {'file': upload})
+
+    def test_import_csv(self):
+        content = '\n'.join([
+            'title_id;department;title;amount;date',
+            f'{self.stat_title.id};;;2,5;01.04.2020',
+            ';otdel-1;продажа рогов;3;2020-04-02',
+            ';otdel-1;Продажа копыт;1;2020-04-03',
+            f'{self.stat_title.id};;;много;2020-04-04',
+            '',
+            f'{self.stat_title.id};;;4;2020-04-05',
+        ]).encode('cp1251')
+        response = self.upload('stats.csv', content)
+        stat_import = StatImport.objects.get()
+        self.assertRedirects(response, reverse('admin:stat_app_stat_import_progress', args=[stat_import.id]))
+        self.assertEqual((stat_import.status, stat_import.processed, stat_import.inserted, stat_import.rejected),
+                         (StatImport.DONE, 5, 3, 2))
+        stat = Stat.objects.get(date='2020-04-01')
+        self.assertEqual((stat.amount, stat.department_id, stat.company_id), (2.5, self.department.id, self.company.id))
+        self.stat_title.refresh_from_db()
+        self.assertEqual((self.stat_title.stat_count, self.stat_title.last_amount), (3, 4))
+
+        status_data = self.client.get(reverse('admin:stat_app_stat_import_status', args=[stat_import.id])).json()
+        self.assertEqual((status_data['progress'], status_data['rejected']), (100, 2))
+        response = self.client.get(status_data['rejected_report'])
+        report = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(report[0], 'строка;ошибка;title_id;department;title;amount;date')
+        self.assertEqual([line.split(';')[0] for line in report[1:]], ['4', '5'])
+
+    def test_failed_import_keeps_committed_batches_consistent(self):
+        content = '\n'.join(['title_id;amount;date'] + [f'{self.stat_title.id};{day};2020-04-{day:02}'
+                                                        for day in range(1, 6)]).encode()
+        save_batch = importing.save_batch
+
+        def fail_second_batch(stat_import, stats, **counts):
+            if StatImport.objects.get(pk=stat_import.pk).processed:
+                raise RuntimeError('disk full')
+            save_batch(stat_import, stats, **counts)
+
+        with mock.patch('stat_app.importing.save_batch', fail_second_batch), \
+                self.assertLogs('stat_app.importing', 'ERROR'):
+            self.upload('stats.csv', content)
+        stat_import = StatImport.objects.get()
+        self.assertEqual((stat_import.status, stat_import.error), (StatImport.FAILED, 'disk full'))
+        self.assertEqual(Stat.objects.count(), 2)
+        self.stat_title.refresh_from_db()
+        self.assertEqual((self.stat_title.stat_count, self.stat_title.last_amount), (2, 2))
+        self.assertEqual(ChangeLog.objects.filter(model='stat').count(), 2)
+
+    def test_counters_are_bumped_per_batch(self):
+        user = User.objects.get(username='admin')
+        Stat.objects.create(owner=user, title=self.stat_title, amount=9, date='2020-05-01')
+        content = '\n'.join(['title_id;amount;date'] + [f'{self.stat_title.id};{day};2020-04-{day:02}'
+                                                        for day in range(1, 6)]).encode()
+        with mock.patch('stat_app.models.StatTitleQuerySet.recount') as recount:
+            self.upload('stats.csv', content)
+        recount.assert_not_called()
+        self.stat_title.refresh_from_db()
+        self.assertEqual((self.stat_title.stat_count, self.stat_title.last_amount), (6, 9))
+
+    def test_stale_imports_fail(self):
+        user = User.objects.get(username='admin')
+        stale = StatImport.objects.create(owner=user, file='imports/stale.csv', status=StatImport.RUNNING)
+        running = StatImport.objects.create(owner=user, file='imports/running.csv', status=StatImport.RUNNING)
+        StatImport.objects.filter(pk=stale.pk).update(updated=timezone.now() - datetime.timedelta(hours=1))
+
+        status_data = self.client.get(reverse('admin:stat_app_stat_import_status', args=[stale.id])).json()
+        self.assertEqual(status_data['status'], StatImport.FAILED)
+        self.assertTrue(status_data['error'])
+        self.assertEqual(StatImport.objects.get(pk=running.pk).status, StatImport.RUNNING)
+
+    def test_rejects_unsupported_files(self):
+        response = self.upload('stats.txt', b'title_id,amount,date')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(StatImport.objects.exists())
+
+    def test_common_user_can_not_import(self):
+        User.objects.create_user('user', 'user@cs.local', 'user', is_staff=True)
+        self.client.login(username='user', password='user')
+        response = self.upload('stats.csv', b'title_id,amount,date')
+        self.assertEqual(response.status_code, 403)
+
+    @skipIf(openpyxl is None, 'openpyxl is not installed')
+    def test_import_xlsx(self):
+        workbook = openpyxl.Workbook()
+        workbook.active.append(['Department', 'Title', 'Amount', 'Date'])
+        workbook.active.append(['otdel-1', 'Продажа рогов', 2.5, datetime.datetime(2020, 4, 1)])
+        workbook.active.append(['otdel-2', 'Продажа рогов', 1, datetime.datetime(2020, 4, 2)])
+        content = BytesIO()
+        workbook.save(content)
+        self.upload('stats.xlsx', content.getvalue())
+        stat_import = StatImport.objects.get()
+        self.assertEqual((stat_import.inserted, stat_import.rejected), (1, 1))
+        self.assertEqual(Stat.objects.get().date, datetime.date(2020, 4, 1))
+
+
+class LoadStatsTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        User.objects.create_user('loader', 'loader@cs.local', 'loader')
+        company = Company.objects.create(title='Рога и копыта', slug='roga-i-kopyta')
+        self.department = Department.objects.create(company=company, title='Отдел 1', slug='otdel-1')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def load(self, *paths, **options):
+        out, err = StringIO(), StringIO()
+        call_command('load_stats', *paths, owner='loader', verbosity=2, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_load_csv_and_ndjson(self):
+        csv_path = self.write('stats.csv', 'department;title;amount;date\n'
+                                           'otdel-1;Продажа рогов;2,5;01.04.2020\n'
+                                           'otdel-1;Продажа копыт;1;2020-04-02\n'
+                                           '\n'
+                                           'otdel-1;Продажа рогов;3.25;2020-04-03\n')
+        ndjson_path = self.write('stats.ndjson', '\n'.join([
+            json.dumps({'title_id': self.stat_title.id, 'amount': 4, 'date': '2020-04-04'}),
+            json.dumps({'Title_ID': self.stat_title.id, 'amount': '1.234', 'date': '2020-04-05'}),
+            '{oops',
+        ]))
+        out, err = self.load(csv_path, ndjson_path, workers=0)
+        self.assertIn('Loaded 3 stats, rejected 3 rows', out)
+        self.assertEqual(sorted(line.split(': ')[0] for line in err.splitlines()),
+                         [f'{csv_path}:3', f'{ndjson_path}:2', f'{ndjson_path}:3'])
+        self.assertIn(f'{csv_path}:3: Форма не найдена.', err)
+        self.stat_title.refresh_from_db()
+        self.assertEqual((self.stat_title.stat_count, self.stat_title.last_amount), (3, 4))
+        stat = Stat.objects.get(date='2020-04-03')
+        self.assertEqual((stat.amount, stat.department_id), (3.25, self.department.id))
+        self.assertEqual(ChangeLog.objects.filter(model='stat').count(), 3)
+
+    def test_load_in_worker_processes(self):
+        rows = ''.join(f'{self.stat_title.id},{day},2020-04-{day:02}\n' for day in range(1, 31))
+        path = self.write('stats.csv', 'title_id,amount,date\n' + rows)
+        with mock.patch('stat_app.management.commands.load_stats.plan', wraps=plan) as planned:
+            out, err = self.load(path, workers=2, chunk_size=64)
+        planned.assert_called_once_with([path], 64)
+        self.assertEqual(len(plan([path], 64)), 6)
+        self.assertIn('Loaded 30 stats, rejected 0 rows', out)
+        self.assertEqual(sorted(Stat.objects.values_list('amount', flat=True)), list(range(1, 31)))
+
+    def test_unsupported_file(self):
+        path = self.write('stats.txt', '')
+        with self.assertRaises(CommandError):
+            self.load(path)
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_load_parquet(self):
+        import pyarrow.parquet
+
+        path = os.path.join(self.directory, 'stats.parquet')
+        pyarrow.parquet.write_table(pyarrow.table({
+            'title_id': [self.stat_title.id, 0],
+            'amount': [1.5, 2],
+            'date': [datetime.date(2020, 4, 1), datetime.date(2020, 4, 2)],
+        }), path)
+        out, err = self.load(path, workers=0)
+        self.assertIn('Loaded 1 stats, rejected 1 rows', out)
+
+
+class LoadStatsIndexesTest(TransactionTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'stats.csv')
+        User.objects.create_user('loader', 'loader@cs.local', 'loader')
+        company = Company.objects.create(title='Рога и копыта', slug='roga-i-kopyta')
+        department = Department.objects.create(company=company, title='Отдел 1', slug='otdel-1')
+        self.stat_title = StatTitle.objects.create(department=department, title='Продажа рогов')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('title_id,amount,date\n')
+            f.writelines(f'{self.stat_title.id},{day},2020-04-{day:02}\n' for day in range(1, 11))
+
+    def stat_indexes(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Stat._meta.db_table)
+        return {index.name for index in Stat._meta.indexes} & set(constraints)
+
+    def load(self, **options):
+        """
+        Returns the stat indexes there were at each write of the load.
+        """
+        indexes_during_load = []
+        write = LoadStatsCommand.write
+
+        def spy_write(command, *args):
+            indexes_during_load.append(self.stat_indexes())
+            return write(command, *args)
+
+        with mock.patch.object(LoadStatsCommand, 'write', spy_write):
+            call_command('load_stats', self.path, owner='loader', workers=0, stdout=StringIO(), **options)
+        return indexes_during_load
+
+    def test_indexes_are_kept_by_default(self):
+        self.assertEqual(self.load(), [{index.name for index in Stat._meta.indexes}])
+
+    def test_indexes_are_rebuilt(self):
+        self.assertEqual(self.load(drop_indexes=True), [set()])
+        self.assertEqual(self.stat_indexes(), {index.name for index in Stat._meta.indexes})
+        self.stat_title.refresh_from_db()
+        self.assertEqual(self.stat_title.stat_count, 10)
+
+
+class GenerateStatsTest(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('loader', 'loader@cs.local', 'loader')
+
+    def test_generate_stats(self):
+        out = StringIO()
+        call_command('generate_stats', owner='loader', companies=2, departments=3, titles=2, stats=50, stdout=out)
+        self.assertIn('Generated 12 stat titles and 600 stats', out.getvalue())
+        self.assertEqual(Company.objects.get(slug='gen-1').department_count, 3)
+        self.assertEqual(Department.objects.get(slug='gen-1-2').stat_title_count, 2)
+        stat_title = StatTitle.objects.filter(department__slug='gen-0-0').first()
+        self.assertEqual(stat_title.stat_count, 50)
+        self.assertEqual(stat_title.last_date, Stat.objects.filter(title=stat_title).latest('date').date)
+        self.assertEqual(Stat.objects.filter(company__slug='gen-1').count(), 300)
+        self.assertEqual(ChangeLog.objects.filter(model='stat').count(), 600)
+        with self.assertRaises(CommandError):
+            call_command('generate_stats', owner='loader', stdout=out)
+
+    def test_start(self):
+        call_command('generate_stats', '--start=2020-02-29', owner='loader', departments=1, titles=1, stats=5,
+                     stdout=StringIO())
+        # the first days may be gaps
+        self.assertGreaterEqual(Stat.objects.earliest('date').date, datetime.date(2020, 2, 29))
+        self.assertLess(Stat.objects.earliest('date').date, datetime.date(2020, 4, 1))
+
+    def test_rows_are_flushed_within_a_series(self):
+        save_rows = generating.save_rows
+        with mock.patch('stat_app.generating.save_rows', wraps=save_rows) as spy:
+            _, inserted = generate(self.owner, titles=2, stats=25, transaction_size=10)
+        self.assertEqual(inserted, 50)
+        self.assertEqual([len(args[0]) for args, _ in spy.call_args_list], [10] * 5)
+        self.assertEqual(Stat.objects.count(), 50)
+
+    def test_deterministic(self):
+        series = []
+        for prefix in ('a', 'b'):
+            stat_titles, _ = generate(self.owner, departments=2, titles=2, stats=200, seed=1, prefix=prefix)
+            series.append([list(Stat.objects.filter(title=stat_title).order_by('date').values_list('date', 'amount'))
+                           for stat_title in stat_titles])
+        self.assertEqual(series[0], series[1])
+        self.assertNotEqual(series[0][0], series[0][1])
+
+    def test_series(self):
+        points = list(generate_series(random.Random(3), 1000))
+        self.assertEqual(len(points), 1000)
+        dates = [datetime.datetime.strptime(date, '%Y-%m-%d').date() for date, _ in points]
+        self.assertEqual(dates, sorted(set(dates)))
+        self.assertTrue(all(Decimal(amount) >= 0 for _, amount in points))
+
+
+@override_settings(LOADTEST_DATABASE=True)
+class LoadTestCommandTest(LiveServerTestCase):
+    def test_loadtest(self):
+        out = StringIO()
+        # one user, concurrent writes to the in-memory test database may hit its table locks
+        call_command('loadtest', url=self.live_server_url, users=1, duration=0.5, companies=1, departments=2,
+                     titles=1, stats=3, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['errors'], 0, report)
+        self.assertGreater(report['urls']['stat_app:department_detail']['requests'], 0)
+        self.assertEqual(set(report['urls']['department_list']), {'requests', 'errors', 'rps', 'mean_ms',
+                                                                  'p50_ms', 'p95_ms', 'p99_ms'})
+        self.assertEqual(Department.objects.get(slug='loadtest-0-1').stat_title_count, 1)
+        self.assertEqual(StatTitle.objects.get(department__slug='loadtest-0-0').stat_count, 3)
+        self.assertEqual(list(User.objects.values_list('username', flat=True)), ['loadtest-owner'])
+
+    def test_seeded_users(self):
+        seeded = []
+
+        def run(command, base_url, org, password, options):
+            seeded.extend(User.objects.filter(username__startswith='loadtest-').exclude(username='loadtest-owner'))
+            seeded.append(password)
+            raise RuntimeError('server down')
+
+        with mock.patch('stat_app.management.commands.loadtest.Command.run', run), \
+                self.assertRaises(RuntimeError):
+            call_command('loadtest', url=self.live_server_url, users=2, companies=1, departments=1, titles=1,
+                         stats=1, clean=True, stdout=StringIO())
+        *users, password = seeded
+        self.assertEqual(len(users), 2)
+        self.assertFalse(any(user.is_staff for user in users))
+        self.assertTrue(users[0].check_password(password))
+        self.assertNotEqual(password, 'loadtest')
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Company.objects.exists())
+
+    @override_settings(LOADTEST_DATABASE=False)
+    def test_refuses_unmarked_database(self):
+        with self.assertRaises(CommandError):
+            call_command('loadtest', url=self.live_server_url, stdout=StringIO())
+        self.assertFalse(Company.objects.exists())
+
+    def test_percentile(self):
+        timings = list(range(1, 101))
+        self.assertEqual([percentile(timings, p) for p in (50, 95, 99)], [50, 95, 99])
+        self.assertEqual(percentile([7], 99), 7)
+
+
+@override_settings(CHANGE_FEED_LAG=0)
+class ChangeFeedTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@cs.local', 'user', is_staff=True)
+        self.company = Company.objects.create(title='Рога и копыта', slug='roga-i-kopyta')
+        self.department = Department.objects.create(company=self.company, title='Отдел 1', slug='otdel-1')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+        self.stat = Stat.objects.create(owner=self.user, title=self.stat_title, amount=1, date='2020-04-01')
+        self.url = reverse('stat_app:api-changes')
+        self.client.login(username='user', password='user')
+
+    def get_changes(self, since=0, **params):
+        response = self.client.get(self.url, dict(params, since=since))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def summary(self, data):
+        return [(change['model'], change['id'], change['action']) for change in data['changes']]
+
+    def test_inserts(self):
+        data = self.get_changes()
+        self.assertEqual(self.summary(data), [('company', self.company.id, 'upsert'),
+                                              ('department', self.department.id, 'upsert'),
+                                              ('stattitle', self.stat_title.id, 'upsert'),
+                                              ('stat', self.stat.id, 'upsert')])
+        self.assertEqual(data['changes'][3]['data']['company_id'], self.company.id)
+        self.assertFalse(data['has_more'])
+        self.assertEqual(self.get_changes(data['cursor'])['changes'], [])
+
+    def test_pages(self):
+        data = self.get_changes(limit=3)
+        self.assertEqual(len(data['changes']), 3)
+        self.assertTrue(data['has_more'])
+        data = self.get_changes(data['cursor'], limit=3)
+        self.assertEqual(self.summary(data), [('stat', self.stat.id, 'upsert')])
+        self.assertFalse(data['has_more'])
+
+    def test_updates_and_deletes(self):
+        cursor = self.get_changes()['cursor']
+        response = self.client.patch(reverse('stat_app:stat-detail', args=[self.stat.id]), {'amount': 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        other = Stat.objects.create(owner=self.user, title=self.stat_title, amount=2, date='2020-04-02')
+        data = self.get_changes(cursor)
+        self.assertEqual(self.summary(data), [('stat', self.stat.id, 'upsert'), ('stat', other.id, 'upsert')])
+        self.assertEqual(data['changes'][0]['data']['amount'], 5)
+
+        cursor, department_id = data['cursor'], self.department.id
+        Stat.objects.filter(pk=other.pk).delete()
+        self.department.delete()
+        self.assertEqual(self.summary(self.get_changes(cursor)), [('stat', other.id, 'delete'),
+                                                                  ('stattitle', self.stat_title.id, 'delete'),
+                                                                  ('department', department_id, 'delete')])
+
+    def test_deleted_rows_are_sent_once(self):
+        stat_id = self.stat.id
+        self.stat.delete()
+        data = self.get_changes()
+        self.assertEqual(self.summary(data)[-1], ('stat', stat_id, 'delete'))
+        self.assertEqual(len([change for change in data['changes'] if change['model'] == 'stat']), 1)
+
+    def test_queries_do_not_grow_with_changes(self):
+        Stat.objects.bulk_create([Stat(owner=self.user, title=self.stat_title, department=self.department,
+                                       company=self.company, amount=day, date=f'2020-05-{day:02}')
+                                  for day in range(1, 31)])
+        ChangeLog.objects.record_queryset(Stat.objects.all())
+        with CaptureQueriesContext(connection) as queries:
+            data = self.get_changes()
+        self.assertEqual(len(data['changes']), 34)
+        self.assertLessEqual(len([query for query in queries if 'stat_app_' in query['sql']]), 6)
+
+    def test_page_stops_at_unsettled_change(self):
+        old = timezone.now() - datetime.timedelta(minutes=5)
+        ChangeLog.objects.update(changed=old)
+        department_entry = ChangeLog.objects.get(model='department')
+        ChangeLog.objects.filter(pk=department_entry.pk).update(changed=timezone.now())
+        with self.settings(CHANGE_FEED_LAG=60):
+            data = self.get_changes()
+            self.assertEqual(self.summary(data), [('company', self.company.id, 'upsert')])
+            self.assertLess(data['cursor'], department_entry.pk)
+
+            ChangeLog.objects.filter(pk=department_entry.pk).update(changed=old)
+            self.assertEqual([change['model'] for change in self.get_changes(data['cursor'])['changes']],
+                             ['department', 'stattitle', 'stat'])
+
+    def test_lag_hides_recent_changes(self):
+        with self.settings(CHANGE_FEED_LAG=60):
+            self.assertEqual(self.get_changes()['changes'], [])
+
+    def test_anonymous(self):
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(LIVE_UPDATES=True, LIVE_KEEPALIVE=0.01, LIVE_STREAM_TIMEOUT=1)
+@mock.patch('stat_app.live.transaction.on_commit', lambda func: func())
+class LiveStatsTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@cs.local', 'user', is_staff=True)
+        company = Company.objects.create(title='Рога и копыта', slug='roga-i-kopyta')
+        self.department = Department.objects.create(company=company, title='Отдел 1', slug='otdel-1')
+        self.other_department = Department.objects.create(company=company, title='Отдел 2', slug='otdel-2')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+        self.stat = Stat.objects.create(owner=self.user, title=self.stat_title, amount=1, date='2020-04-01')
+        self.client.login(username='user', password='user')
+        self.subscription = get_broadcaster().subscribe([department_channel(self.department.id)])
+        self.addCleanup(self.subscription.close)
+
+    def events(self):
+        events = []
+        while True:
+            event = self.subscription.get(timeout=0)
+            if event is None:
+                return events
+            events.append(event)
+
+    def test_broadcaster(self):
+        broadcaster = LocalBroadcaster()
+        subscription = broadcaster.subscribe(['title:1', 'title:2'])
+        broadcaster.publish('title:2', {'type': 'reload'})
+        broadcaster.publish('title:3', {'type': 'point'})
+        self.assertEqual(subscription.get(timeout=0), {'type': 'reload'})
+        self.assertIsNone(subscription.get(timeout=0))
+        subscription.close()
+        self.assertEqual(broadcaster.subscriptions, {})
+
+    def test_save_publishes_point(self):
+        title_subscription = get_broadcaster().subscribe([title_channel(self.stat_title.id)])
+        self.addCleanup(title_subscription.close)
+        stat = Stat.objects.create(owner=self.user, title=self.stat_title, amount='2.50', date='2020-04-02')
+        point = {'type': 'point', 'id': stat.id, 'title': self.stat_title.id, 'department': self.department.id,
+                 'date': '2020-04-02', 'amount': 2.5, 'created': True}
+        self.assertEqual(self.events(), [point])
+        self.assertEqual(title_subscription.get(timeout=0), point)
+
+    def test_api_update_publishes_point(self):
+        response = self.client.patch(reverse('stat_app:stat-detail', args=[self.stat.id]), {'amount': 5})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(event['id'], event['amount'], event['created']) for event in self.events()],
+                         [(self.stat.id, 5.0, False)])
+
+    def test_bulk_changes_publish_reload(self):
+        response = self.client.patch(reverse('stat_app:stat-bulk'), [{'id': self.stat.id, 'amount': 7}],
+                                     format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.events(), [{'type': 'reload', 'department': self.department.id}])
+        self.stat.delete()
+        self.assertEqual(self.events(), [{'type': 'reload', 'department': self.department.id}])
+
+    def test_other_department_not_published(self):
+        stat_title = StatTitle.objects.create(department=self.other_department, title='Продажа копыт')
+        Stat.objects.create(owner=self.user, title=stat_title, amount=1, date='2020-04-01')
+        self.assertEqual(self.events(), [])
+
+    def test_stream(self):
+        response = self.client.get(reverse('stat_app:api-live'), {'department': self.department.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = iter(response.streaming_content)
+        self.assertEqual(next(content), b'retry: 3000\n\n')
+        self.assertEqual(next(content), b': keepalive\n\n')
+        stat = Stat.objects.create(owner=self.user, title=self.stat_title, amount=2, date='2020-04-02')
+        chunk = next(content).decode()
+        self.assertTrue(chunk.startswith('event: point\ndata: '))
+        self.assertEqual(json.loads(chunk.split('data: ', 1)[1])['id'], stat.id)
+        response.close()
+        self.assertEqual(set(get_broadcaster().subscriptions), {department_channel(self.department.id)})
+
+    def test_event_source_request(self):
+        response = self.client.get(reverse('stat_app:api-live'), {'department': self.department.id},
+                                   HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(next(iter(response.streaming_content)), b'retry: 3000\n\n')
+        response.close()
+
+        response = self.client.get(reverse('stat_app:api-live'), HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(response.content.startswith(b'event: error\ndata: '))
+
+    def test_stream_requires_channel_and_login(self):
+        response = self.client.get(reverse('stat_app:api-live'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.logout()
+        response = self.client.get(reverse('stat_app:api-live'), {'department': self.department.id})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_off_without_live_updates(self):
+        detail_url = reverse('stat_app:department_detail', args=[self.department.slug])
+        self.assertContains(self.client.get(detail_url), 'EventSource')
+        with self.settings(LIVE_UPDATES=False):
+            response = self.client.get(reverse('stat_app:api-live'), {'department': self.department.id},
+                                       HTTP_ACCEPT='text/event-stream')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            self.assertNotContains(self.client.get(detail_url), 'EventSource')
+
+
+@override_settings(CHANGE_FEED_LAG=0)
+class ChangeLogBackfillTest(TransactionTestCase):
+    before = [('stat_app', '0007_stat_import')]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        apps = executor.loader.project_state(self.before).apps
+        user = apps.get_model(settings.AUTH_USER_MODEL).objects.create(username='editor', is_staff=True)
+        company = apps.get_model('stat_app', 'Company').objects.create(title='Рога и копыта', slug='roga-i-kopyta')
+        department = apps.get_model('stat_app', 'Department').objects.create(
+            company=company, title='Отдел 1', slug='otdel-1')
+        stat_title = apps.get_model('stat_app', 'StatTitle').objects.create(department=department, title='Продажа')
+        Stat = apps.get_model('stat_app', 'Stat')
+        self.stat_ids = [Stat.objects.create(owner=user, title=stat_title, department=department, company=company,
+                                             amount=day, date=f'2020-04-{day:02}').pk for day in (1, 2)]
+        self.ids = {'company': company.pk, 'department': department.pk, 'stattitle': stat_title.pk}
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_rows_from_before_the_log_are_synced(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.get(username='editor'))
+        response = client.get(reverse('stat_app:api-changes'), {'since': 0})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(change['model'], change['id'], change['action']) for change in response.data['changes']],
+                         [(model_name, pk, 'upsert') for model_name, pk in self.ids.items()]
+                         + [('stat', pk, 'upsert') for pk in self.stat_ids])
+        self.assertEqual(response.data['changes'][-1]['data']['amount'], 2)
+
+
+class DashboardTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('user', 'user@cs.local', 'user')
+        self.company = Company.objects.create(title='Рога и копыта', slug='roga-i-kopyta')
+        self.department = Department.objects.create(company=self.company, title='Отдел 1', slug='otdel-1')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+        Stat.objects.create(owner=self.user, title=self.stat_title, amount=1, date='2020-04-01')
+        Stat.objects.create(owner=self.user, title=self.stat_title, amount=2, date='2020-04-01')
+        Stat.objects.create(owner=self.user, title=self.stat_title, amount=4, date='2020-04-03')
+        Stat.objects.create(owner=self.user, title=self.stat_title, amount=8, date='2020-05-01')
+        self.url = reverse('stat_app:api-dashboard', args=[self.company.slug])
+        self.period = {'date_from': '2020-04-01', 'date_to': '2020-04-30'}
+        self.client.force_authenticate(self.user)
+
+    def add_department(self, number):
+        department = Department.objects.create(company=self.company, title=f'Отдел {number}',
+                                               slug=f'otdel-{number}')
+        for title in ('Продажа рогов', 'Продажа копыт'):
+            stat_title = StatTitle.objects.create(department=department, title=title)
+            Stat.objects.create(owner=self.user, title=stat_title, amount=1, date='2020-04-02')
+
+    def test_dashboard(self):
+        response = self.client.get(self.url, self.period)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['company']['slug'], 'roga-i-kopyta')
+        self.assertEqual(response.data['period'], self.period)
+        [department] = response.data['departments']
+        self.assertEqual(department['slug'], 'otdel-1')
+        [stat_title] = department['stat_titles']
+        self.assertEqual(stat_title['id'], self.stat_title.id)
+        self.assertEqual((stat_title['last_amount'], stat_title['last_date']), (8.0, '2020-05-01'))
+        self.assertEqual(stat_title['total'], 7.0)
+        self.assertEqual(stat_title['sparkline'], {'dates': ['2020-04-01', '2020-04-03'], 'amounts': [3.0, 4.0]})
+
+    def test_rows_missing_from_earlier_queries_are_skipped(self):
+        other_company = Company.objects.create(title='Копыта и рога', slug='kopyta-i-roga')
+        other_department = Department.objects.create(company=other_company, title='Отдел 2', slug='otdel-2')
+        other_title = StatTitle.objects.create(department=other_department, title='Продажа копыт')
+        stat = Stat.objects.create(owner=self.user, title=other_title, amount=16, date='2020-04-02')
+        Stat.objects.filter(pk=stat.pk).update(company=self.company)
+        response = self.client.get(self.url, self.period)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        [department] = response.data['departments']
+        self.assertEqual([stat_title['total'] for stat_title in department['stat_titles']], [7.0])
+
+    def test_constant_queries(self):
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(self.url, self.period)
+        for number in range(2, 12):
+            self.add_department(number)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(self.url, self.period)
+        self.assertEqual(len(response.data['departments']), 11)
+        self.assertEqual(len(large), len(small))
+
+    def test_cached_by_data_version(self):
+        self.client.get(self.url, self.period)
+        with CaptureQueriesContext(connection) as cached:
+            self.client.get(self.url, self.period)
+        # the company and the data version
+        self.assertEqual(len(cached), 2)
+        Stat.objects.create(owner=self.user, title=self.stat_title, amount=16, date='2020-04-03')
+        response = self.client.get(self.url, self.period)
+        self.assertEqual(response.data['departments'][0]['stat_titles'][0]['total'], 23.0)
+
+    def test_default_period(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['period']['date_to'], str(timezone.localdate()))
+
+    def test_invalid(self):
+        response = self.client.get(self.url, {'date_from': '2020-05-01', 'date_to': '2020-04-01'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(self.url, {'date_from': '2018-01-01', 'date_to': '2020-04-01'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('stat_app:api-dashboard', args=['missing']))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BatchTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@cs.local', 'user')
+        self.editor = User.objects.create_user('editor', 'editor@cs.local', 'editor', is_staff=True)
+        self.company = Company.objects.create(title='Рога и копыта', slug='roga-i-kopyta')
+        department = Department.objects.create(company=self.company, title='Отдел 1', slug='otdel-1')
+        self.stat_title = StatTitle.objects.create(department=department, title='Продажа рогов')
+        self.stat = Stat.objects.create(owner=self.user, title=self.stat_title, amount=1, date='2020-04-01')
+        self.url = reverse('stat_app:api-batch')
+        self.stat_url = reverse('stat_app:stat-detail', args=[self.stat.id])
+
+    def batch(self, requests, **options):
+        response = self.client.post(self.url, dict(options, requests=requests), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['responses']
+
+    def test_reads(self):
+        self.client.login(username='user', password='user')
+        responses = self.batch([
+            {'path': reverse('stat_app:company-list')},
+            {'path': self.stat_url},
+            {'path': reverse('stat_app:stat-list') + f'?title={self.stat_title.id}'},
+        ])
+        self.assertEqual([response['status'] for response in responses], [200, 200, 200])
+        self.assertEqual(responses[0]['data']['results'][0]['slug'], 'roga-i-kopyta')
+        self.assertEqual(responses[1]['data']['amount'], '1.00')
+        self.assertEqual(responses[2]['data']['count'], 1)
+
+    def test_permissions_of_user(self):
+        self.client.login(username='user', password='user')
+        responses = self.batch([{'method': 'PUT', 'path': self.stat_url, 'body': {'amount': 5}}])
+        self.assertEqual(responses[0]['status'], status.HTTP_403_FORBIDDEN)
+        self.client.logout()
+        response = self.client.post(self.url, {'requests': [{'path': self.stat_url}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_writes(self):
+        self.client.login(username='editor', password='editor')
+        responses = self.batch([
+            {'method': 'PATCH', 'path': self.stat_url, 'body': {'amount': 5}},
+            {'method': 'POST', 'path': reverse('stat_app:stat-list'), 'body': {'title': self.stat_title.id}},
+        ])
+        self.assertEqual([response['status'] for response in responses], [200, 400])
+        self.stat.refresh_from_db()
+        self.assertEqual(self.stat.amount, 5)
+
+    def test_atomic_writes_roll_back(self):
+        self.client.login(username='editor', password='editor')
+        responses = self.batch([
+            {'method': 'PATCH', 'path': self.stat_url, 'body': {'amount': 5}},
+            {'method': 'POST', 'path': reverse('stat_app:stat-list'), 'body': {'title': self.stat_title.id}},
+            {'method': 'DELETE', 'path': self.stat_url},
+        ], atomic=True)
+        self.assertEqual([response['status'] for response in responses], [200, 400, 424])
+        self.stat.refresh_from_db()
+        self.assertEqual(self.stat.amount, 1)
+
+    def test_rejected_paths(self):
+        self.client.login(username='user', password='user')
+        responses = self.batch([
+            {'path': '/admin/'},
+            {'path': self.url},
+            {'path': reverse('stat_app:api-live') + '?department=1'},
+            {'path': reverse('stat_app:api-root') + 'missing/'},
+        ])
+        self.assertEqual([response['status'] for response in responses], [400, 400, 400, 404])
+
+    def test_invalid(self):
+        self.client.login(username='user', password='user')
+        for data in ({'requests': []},
+                     {'requests': [{'path': self.stat_url}] * 21},
+                     {'requests': [{'method': 'DELETE', 'path': self.stat_url}], 'parallel': True}):
+            response = self.client.post(self.url, data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BatchParallelTest(TransactionTestCase):
+    def test_parallel_reads(self):
+        User.objects.create_user('user', 'user@cs.local', 'user')
+        Company.objects.create(title='Рога и копыта', slug='roga-i-kopyta')
+        client = APIClient()
+        client.login(username='user', password='user')
+        response = client.post(reverse('stat_app:api-batch'), {
+            'requests': [{'path': reverse('stat_app:company-list')}] * 8, 'parallel': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['data']['count'] for item in response.data['responses']], [1] * 8)
+
+
+class StatOrgKeysTest(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(title='Рога и копыта', slug='Roga-i-Kopyta')
+        self.other_company = Company.objects.create(title='Копыта и рога', slug='Kopyta-i-Roga')
+        self.department = Department.objects.create(company=self.company, title='Отдел 1', slug='Otdel-1')
+        self.other_department = Department.objects.create(
+            company=self.other_company, title='Отдел 2', slug='Otdel-2')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+        self.user = User.objects.create_user('user', 'user@cs.local', 'user', is_staff=True)
+        self.stat = Stat.objects.create(owner=self.user, title=self.stat_title, amount=2.5, date='2020-04-20')
+
+    def test_keys_set_on_create(self):
+        """
+        Ensure a new stat carries the department and company of its title.
+        """
+        stat = Stat.objects.get()
+        self.assertEqual(stat.department_id, self.department.id)
+        self.assertEqual(stat.company_id, self.company.id)
+
+    def test_keys_follow_stat_title_move(self):
+        """
+        Ensure stats follow their stat_title to another department.
+        """
+        self.stat_title.department = self.other_department
+        self.stat_title.save()
+        stat = Stat.objects.get()
+        self.assertEqual(stat.department_id, self.other_department.id)
+        self.assertEqual(stat.company_id, self.other_company.id)
+
+    def test_keys_follow_department_move(self):
+        """
+        Ensure stats follow their department to another company.
+        """
+        self.department.company = self.other_company
+        self.department.save()
+        self.assertEqual(Stat.objects.get().company_id, self.other_company.id)
+
+    def test_keys_follow_api_update(self):
+        """
+        Ensure changing the stat title through the API re-syncs the keys.
+        """
+        other_title = StatTitle.objects.create(department=self.other_department, title='Продажа копыт')
+        self.client.login(username='user', password='user')
+        data = StatSerializer(self.stat).data
+        data.update({'title': other_title.id})
+        response = self.client.put(reverse('stat_app:stat-detail', args=[self.stat.id]), data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stat = Stat.objects.get()
+        self.assertEqual(stat.department_id, self.other_department.id)
+        self.assertEqual(stat.company_id, self.other_company.id)
+
+    def test_data_filtered_by_department(self):
+        """
+        Ensure the chart feed can be scoped to one department.
+        """
+        other_title = StatTitle.objects.create(department=self.other_department, title='Продажа копыт')
+        Stat.objects.create(owner=self.user, title=other_title, amount=1, date='2020-04-21')
+        self.client.login(username='user', password='user')
+        response = self.client.get(reverse('stat_app:api-data'), {'department': self.department.id})
+        self.assertEqual(list(response.json()['stats_dict']), [str(self.stat_title.id)])
+
+
+class FilterStatTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@cs.local', 'user', is_staff=False)
+        self.client.login(username='user', password='user')
+        self.company = Company.objects.create(title='Рога и копыта', slug='Roga-i-Kopyta')
+        self.department = Department.objects.create(company=self.company, title='Отдел 1', slug='Otdel-1')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+        self.other_title = StatTitle.objects.create(department=self.department, title='Продажа копыт')
+        Stat.objects.create(owner=self.user, title=self.stat_title, amount=1, date='2020-04-01')
+        Stat.objects.create(owner=self.user, title=self.stat_title, amount=5, date='2020-04-10')
+        Stat.objects.create(owner=self.user, title=self.other_title, amount=10, date='2020-04-20')
+        self.url = reverse('stat_app:stat-list')
+
+    def filtered_plan(self, **params):
+        request = APIRequestFactory().get(self.url, params)
+        view = StatViewSet(request=Request(request), format_kwarg=None)
+        queryset = StatFilterBackend().filter_queryset(view.request, view.queryset, view)
+        return queryset.explain()
+
+    def test_filter_by_title_and_dates(self):
+        """
+        Ensure stats can be filtered by stat_title and a date range.
+        """
+        response = self.client.get(self.url, {'title': self.stat_title.id, 'date_from': '2020-04-05'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([stat['date'] for stat in response.data['results']], ['2020-04-10'])
+
+    def test_filter_by_amount(self):
+        """
+        Ensure stats can be filtered by an amount range within a stat_title.
+        """
+        response = self.client.get(self.url, {'title': self.stat_title.id, 'amount_max': '2'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 1)
+
+    def test_filter_by_company(self):
+        """
+        Ensure stats can be filtered by company.
+        """
+        response = self.client.get(self.url, {'company': self.company.id, 'date_to': '2020-04-15'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+
+    def test_reject_invalid_combinations(self):
+        """
+        Ensure inverted ranges and unscoped amount filters are rejected.
+        """
+        for params in [{'date_from': '2020-05-01', 'date_to': '2020-04-01'},
+                       {'title': self.stat_title.id, 'amount_min': '5', 'amount_max': '1'},
+                       {'amount_min': '1'},
+                       {'company': 'x'}]:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+    def test_filters_use_indexes(self):
+        """
+        Ensure every filter is answered from an index, not a table scan.
+        """
+        for params in [{'title': self.stat_title.id},
+                       {'department': self.department.id, 'date_from': '2020-04-05'},
+                       {'company': self.company.id, 'date_to': '2020-04-15'},
+                       {'owner': self.user.id},
+                       {'date_from': '2020-04-05', 'date_to': '2020-04-15'},
+                       {'title': self.stat_title.id, 'amount_min': '2'},
+                       {'updated_since': '2020-01-01T00:00:00Z'}]:
+            plan = self.filtered_plan(**params)
+            self.assertRegex(plan, r'SEARCH (TABLE )?stat_app_stat USING (COVERING )?INDEX', params)
+
+
+class SparseFieldsetsTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@cs.local', 'user', is_staff=False)
+        self.client.login(username='user', password='user')
+        self.company = Company.objects.create(title='Рога и копыта', slug='Roga-i-Kopyta')
+        self.department = Department.objects.create(company=self.company, title='Отдел 1', slug='Otdel-1')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+        Stat.objects.create(owner=self.user, title=self.stat_title, amount=2.5, date='2020-04-20')
+
+    def test_fields(self):
+        """
+        Ensure only the requested fields are serialized and selected.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('stat_app:stat-list'), {'fields': 'date,amount'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['results'][0]), {'date', 'amount'})
+        select = [query['sql'] for query in queries if 'FROM "stat_app_stat"' in query['sql']][-1]
+        self.assertNotIn('"created"', select)
+
+    def test_omit(self):
+        """
+        Ensure omitted fields are not serialized.
+        """
+        response = self.client.get(reverse('stat_app:stat-list'), {'omit': 'created,updated,owner'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('created', response.data['results'][0])
+        self.assertIn('amount', response.data['results'][0])
+
+    def test_unknown_fields(self):
+        """
+        Ensure a misspelt field name is reported instead of emptying the objects.
+        """
+        response = self.client.get(reverse('stat_app:stat-list'), {'fields': 'date,amout', 'omit': 'foo'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data, {'fields': ['Unknown fields: amout.'], 'omit': ['Unknown fields: foo.']})
+        response = self.client.get(reverse('stat_app:stat-detail', args=[Stat.objects.get().id]), {'fields': 'amout'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_related_fields_prefetched(self):
+        """
+        Ensure reverse relations are loaded in one query for the whole page.
+        """
+        for i in range(5):
+            Company.objects.create(title=f'Компания {i}', slug=f'company-{i}')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('stat_app:company-list'), {'fields': 'title,departments'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len([query for query in queries if 'stat_app_department' in query['sql']]), 1)
+
+
+class SeriesRendererTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@cs.local', 'user', is_staff=False)
+        self.client.login(username='user', password='user')
+        self.company = Company.objects.create(title='Рога и копыта', slug='Roga-i-Kopyta')
+        self.department = Department.objects.create(company=self.company, title='Отдел 1', slug='Otdel-1')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+        Stat.objects.create(owner=self.user, title=self.stat_title, amount=2.5, date='1970-01-02')
+        Stat.objects.create(owner=self.user, title=self.stat_title, amount=4, date='1970-01-03')
+        self.url = reverse('stat_app:api-data')
+
+    def test_json(self):
+        """
+        Ensure the default JSON layout is kept for the charts.
+        """
+        response = self.client.get(self.url)
+        self.assertEqual(response.json(), {'stats_dict': {str(self.stat_title.id): {
+            'default': [2.5, 4.0], 'labels': ['1970-01-02', '1970-01-03']}}})
+
+    def test_columnar(self):
+        """
+        Ensure the columnar layout uses epoch days and float amounts.
+        """
+        response = self.client.get(self.url, {'format': 'columnar'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {
+            'titles': [self.stat_title.id] * 2, 'dates': [1, 2], 'amounts': [2.5, 4.0]})
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        """
+        Ensure MessagePack is selected by the Accept header.
+        """
+        response = self.client.get(self.url, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content)['dates'], [1, 2])
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_arrow(self):
+        """
+        Ensure the Arrow stream decodes to typed columns.
+        """
+        response = self.client.get(self.url, {'format': 'arrow'})
+        table = pyarrow.ipc.open_stream(response.content).read_all()
+        self.assertEqual(table.column('date').to_pylist(), [datetime.date(1970, 1, 2), datetime.date(1970, 1, 3)])
+        self.assertEqual(table.column('amount').to_pylist(), [2.5, 4.0])
+
+
+class StatPermissionsTest(APITestCase):
+    def setUp(self):
+        self.company = Company.objects.create(title='Рога и копыта', slug='Roga-i-Kopyta')
+        self.department = Department.objects.create(company=self.company, title='Отдел 1', slug='Otdel-1')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+        self.user = User.objects.create_user('editor', 'editor@cs.local', 'editor', is_staff=False)
+        self.stat = Stat.objects.create(owner=self.user, title=self.stat_title, amount=2.5, date='2020-04-20')
+        self.client.login(username='editor', password='editor')
+        self.url = reverse('stat_app:stat-detail', args=[self.stat.id])
+
+    def test_model_permission_does_not_allow_update(self):
+        """
+        Ensure writes stay staff-only for users with change_stat.
+        """
+        self.user.user_permissions.add(Permission.objects.get(codename='change_stat'))
+        data = StatSerializer(self.stat).data
+        data.update({'amount': 4.0})
+        response = self.client.put(self.url, data)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(Stat.objects.get().amount, 2.5)
+
+    def test_staff_may_update(self):
+        """
+        Ensure staff can update a stat without model permissions.
+        """
+        self.user.is_staff = True
+        self.user.save()
+        data = StatSerializer(self.stat).data
+        data.update({'amount': 4.0})
+        response = self.client.put(self.url, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Stat.objects.get().amount, 4.0)
+
+
+class CountersTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@cs.local', 'user')
+        self.company = Company.objects.create(title='Рога и копыта', slug='Roga-i-Kopyta')
+        self.other_company = Company.objects.create(title='Копыта и рога', slug='Kopyta-i-Roga')
+        self.department = Department.objects.create(company=self.company, title='Отдел 1', slug='Otdel-1')
+        self.stat_title = StatTitle.objects.create(department=self.department, title='Продажа рогов')
+
+    def add_stat(self, amount, date, stat_title=None):
+        return Stat.objects.create(owner=self.user, title=stat_title or self.stat_title, amount=amount, date=date)
+
+    def assertCounters(self, company, department, stat_title, last=None):
+        self.company.refresh_from_db()
+        self.department.refresh_from_db()
+        self.stat_title.refresh_from_db()
+        self.assertEqual(self.company.department_count, company)
+        self.assertEqual(self.department.stat_title_count, department)
+        self.assertEqual(self.stat_title.stat_count, stat_title)
+        if last:
+            self.assertEqual((self.stat_title.last_date, self.stat_title.last_amount), last)
+
+    def test_create(self):
+        self.add_stat(2, '2020-04-20')
+        self.add_stat(1, '2020-04-01')
+        self.assertCounters(1, 1, 2, (datetime.date(2020, 4, 20), 2))
+
+    def test_edit_and_delete_latest(self):
+        self.add_stat(1, '2020-04-01')
+        latest = self.add_stat(2, '2020-04-20')
+        latest.amount = 3
+        latest.save()
+        self.assertCounters(1, 1, 2, (datetime.date(2020, 4, 20), 3))
+        latest.delete()
+        self.assertCounters(1, 1, 1, (datetime.date(2020, 4, 1), 1))
+
+    def test_queryset_delete(self):
+        self.add_stat(1, '2020-04-01')
+        self.add_stat(2, '2020-04-20')
+        Stat.objects.filter(date__gt='2020-04-10').delete()
+        self.assertCounters(1, 1, 1, (datetime.date(2020, 4, 1), 1))
+        StatTitle.objects.all().delete()
+        Department.objects.all().delete()
+        self.company.refresh_from_db()
+        self.assertEqual(self.company.department_count, 0)
+
+    def test_move(self):
+        self.department.company = self.other_company
+        self.department.save()
+        self.other_company.refresh_from_db()
+        self.assertCounters(0, 1, 0)
+        self.assertEqual(self.other_company.department_count, 1)
+
+    def test_stat_moves_title(self):
+        other_title = StatTitle.objects.create(department=self.department, title='Продажа копыт')
+        stat = self.add_stat(1, '2020-04-01')
+        stat.title = other_title
+        stat.save()
+        other_title.refresh_from_db()
+        self.assertCounters(1, 2, 0, (None, None))
+        self.assertEqual((other_title.stat_count, other_title.last_amount), (1, 1))
+
+    def test_recount_command(self):
+        self.add_stat(1, '2020-04-01')
+        StatTitle.objects.update(stat_count=10, last_amount=None, last_date=None)
+        Company.objects.update(department_count=10)
+        call_command('recount', stdout=StringIO())
+        self.assertCounters(1, 1, 1, (datetime.date(2020, 4, 1), 1))
+
+    def test_list_reads_counters(self):
+        self.client.login(username='user', password='user')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/')
+        self.assertContains(response, 'Отделов: 1')
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+
+
+class OrgFragmentCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.company = Company.objects.create(title='Рога и копыта', slug='roga-i-kopyta')
+        self.department = Department.objects.create(company=self.company, title='Отдел 1', slug='otdel-1')
+        User.objects.create_user(username='user', password='user', email='user@cs.local')
+        self.client.login(username='user', password='user')
+
+    def get_list(self, path='/'):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        return response, [query for query in queries if 'stat_app_' in query['sql']]
+
+    def test_warm_cache_skips_org_queries(self):
+        self.get_list()
+        response, queries = self.get_list()
+        self.assertContains(response, 'Отдел 1')
+        self.assertEqual(queries, [])
+
+    def test_company_page_is_cached_separately(self):
+        self.get_list()
+        response, queries = self.get_list('/stat/company/roga-i-kopyta/')
+        self.assertContains(response, 'Отдел 1')
+        self.assertTrue(queries)
+        response, queries = self.get_list('/stat/company/roga-i-kopyta/')
+        # only the company is looked up by slug
+        self.assertEqual(len(queries), 1)
+
+    def test_org_change_invalidates_fragments(self):
+        self.get_list()
+        Department.objects.create(company=self.company, title='Отдел 2', slug='otdel-2')
+        response, queries = self.get_list()
+        self.assertContains(response, 'Отдел 2')
+        self.assertContains(response, 'Отделов: 2')
+
+    def test_api_update_invalidates_fragments(self):
+        User.objects.filter(username='user').update(is_staff=True)
+        self.get_list()
+        response = self.client.patch(reverse('stat_app:department-detail', args=[self.department.id]),
+                                     {'title': 'Отдел продаж'}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response, queries = self.get_list()
+        self.assertContains(response, 'Отдел продаж')
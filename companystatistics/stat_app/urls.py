@@ -19,9 +19,6 @@ urlpatterns = [
     path('company/<slug:company>/',
          views.DepartmentListView.as_view(),
          name='department_list_company'),
-    path('<slug:slug>/',
-         views.DepartmentDetailView.as_view(),
-         name='department_detail'),
     path('<int:department_id>/stat_title_create/',
          views.stat_title_create,
          name='stat_title_create'),
@@ -33,8 +30,16 @@ urlpatterns = [
          name='stat_edit'),
 
     path('api/data/', views.get_data, name='api-data'),
+    path('api/changes/', views.get_changes, name='api-changes'),
+    path('api/live/', views.get_live, name='api-live'),
+    path('api/batch/', views.batch, name='api-batch'),
+    path('api/companies/<slug:slug>/dashboard/', views.get_dashboard, name='api-dashboard'),
 
     path('api/', include(router.urls)),
+    # last, any other single segment is a department slug
+    path('<slug:slug>/',
+         views.DepartmentDetailView.as_view(),
+         name='department_detail'),
     # path('schema/', schema_view),
     # path('docs/', include_docs_urls(title='Stat API'))
 ]
@@ -1,16 +1,32 @@
+import datetime
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Count
-from django.http import JsonResponse
+from django.db import transaction
+from django.utils import timezone
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
+from django.urls import reverse
 from django.views.generic import DetailView
 from django.views.generic.base import TemplateResponseMixin, View
-from rest_framework import viewsets, permissions, status
+from rest_framework import viewsets, permissions, renderers, status
+from rest_framework.decorators import action, api_view, permission_classes, renderer_classes
 from rest_framework.response import Response
 
+from . import dashboard
+from .batch import run_batch
+from .caching import get_org_version, invalidate_org_fragments
+from .filters import StatFilterBackend
 from .forms import StatForm, StatTitleForm
-from .models import Department, Company, StatTitle, Stat
-from .serializers import CompanySerializer, DepartmentSerializer, StatTitleSerializer, StatSerializer
+from .live import (department_channel, event_stream, get_broadcaster, publish_reload, publish_stat,
+                   title_channel)
+from .models import ChangeLog, Department, Company, StatTitle, Stat
+from .permissions import ActionPermissionsMixin
+from .renderers import SERIES_RENDERER_CLASSES, EventStreamRenderer, to_stats_dict
+from .serializers import (CompanySerializer, DepartmentSerializer, StatTitleSerializer, StatSerializer,
+                          BatchSerializer, ChangesQuerySerializer, DashboardQuerySerializer, LiveQuerySerializer,
+                          StatBulkUpdateSerializer, StatBulkDeleteSerializer, OrgTreeSerializer, batched)
 
 
 class DepartmentListView(LoginRequiredMixin, TemplateResponseMixin, View):
@@ -18,17 +34,18 @@ class DepartmentListView(LoginRequiredMixin, TemplateResponseMixin, View):
     template_name = 'stat_app/department/list.html'
 
     def get(self, request, company=None):
-        companies = Company.objects.annotate(
-            total_departments=Count('departments'))
-        departments = Department.objects.annotate(
-            total_stat_titles=Count('stat_titles'))
+        companies = Company.objects.all()
+        departments = Department.objects.select_related('company')
         if company:
             company = get_object_or_404(Company, slug=company)
             departments = departments.filter(company=company)
 
+        # the querysets are only evaluated when the cached fragments are stale
         return self.render_to_response({'companies': companies,
                                         'company': company,
-                                        'departments': departments})
+                                        'departments': departments,
+                                        'org_version': get_org_version(),
+                                        'org_cache_timeout': settings.ORG_CACHE_TIMEOUT})
 
 
 class DepartmentDetailView(LoginRequiredMixin, DetailView):
@@ -39,9 +56,13 @@ class DepartmentDetailView(LoginRequiredMixin, DetailView):
         context = super(DepartmentDetailView,
                         self).get_context_data(**kwargs)
         stat_titles = StatTitle.objects.filter(department=self.object)
-        stats = Stat.objects.all()
+        stats = Stat.objects.filter(department=self.object).select_related('owner')
         context['stat_titles'] = stat_titles
         context['stats'] = stats
+        if self.request.user.is_staff:
+            # embedded for the first chart render, range changes go to the API
+            context['stats_dict'] = to_stats_dict(stats.series())
+            context['live_updates'] = settings.LIVE_UPDATES
 
         return context
 
@@ -103,58 +124,182 @@ def stat_title_create(request, department_id=None):
         return render(request, 'stat_app/stat_title/form.html', context)
 
 
+@api_view(['GET'])
+@renderer_classes(SERIES_RENDERER_CLASSES)
 def get_data(request, *args, **kwargs):
-    stats = Stat.objects.all()
+    """
+    Chart series of the stats, accepts the same filters as StatViewSet.
 
-    stats_dict = {str(StatTitle.objects.filter(title=stat.title).first().id): {'default': [], 'labels': []} for stat in
-                  stats}
+    Rendered as `stats_dict` for JSON, or as title/date/amount columns
+    for the columnar, MessagePack and Arrow formats.
+    """
+    stats = StatFilterBackend().filter_queryset(request, Stat.objects.all(), None)
+    series = stats.series()
 
-    for stat in stats:
-        stats_dict[str(StatTitle.objects.filter(title=stat.title).first().id)]['default'].append(float(stat.amount))
-        stats_dict[str(StatTitle.objects.filter(title=stat.title).first().id)]['labels'].append(str(stat.date))
+    if request.accepted_renderer.format != 'json':
+        return Response(series)
     data = {
-        'stats_dict': stats_dict,
+        'stats_dict': to_stats_dict(series),
     }
 
-    return JsonResponse(data)
+    return Response(data)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+@renderer_classes([renderers.JSONRenderer, EventStreamRenderer])
+def get_live(request, *args, **kwargs):
+    """
+    Server-sent events of the stats of a `department` and/or stat `title`:
+    a `point` event per saved stat, and a `reload` event of a department
+    after bulk changes. Off unless LIVE_UPDATES, as each stream holds a
+    server thread.
+    """
+    if not settings.LIVE_UPDATES:
+        return Response({'detail': 'Live updates are off.'}, status=status.HTTP_404_NOT_FOUND)
+    query = LiveQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    channels = []
+    if 'department' in query.validated_data:
+        channels.append(department_channel(query.validated_data['department']))
+    if 'title' in query.validated_data:
+        channels.append(title_channel(query.validated_data['title']))
+    # subscribed before the response starts, so no event is missed in between
+    subscription = get_broadcaster().subscribe(channels)
+    response = StreamingHttpResponse(event_stream(subscription), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # keeps nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def get_dashboard(request, slug, *args, **kwargs):
+    """
+    Company overview in one response: departments, their stat titles with
+    latest values, totals and sparklines over `date_from`..`date_to`.
+    """
+    company = get_object_or_404(Company, slug=slug)
+    query = DashboardQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    return Response(dashboard.get_dashboard(company, **query.validated_data))
 
 
-class CompanyViewSet(viewsets.ModelViewSet):
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def batch(request, *args, **kwargs):
+    """
+    Runs a list of `{method, path, body}` API sub-requests as the same user
+    and returns their `{status, data}` in order.
+    """
+    serializer = BatchSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    prefix = reverse('stat_app:api-root')
+    return Response({'responses': run_batch(request, prefix, **serializer.validated_data)})
+
+
+CHANGE_FEED_MODELS = {model._meta.model_name: model for model in (Company, Department, StatTitle, Stat)}
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def get_changes(request, *args, **kwargs):
+    """
+    Changes of companies, departments, stat titles and stats after the
+    `since` cursor, oldest first: the current row for an upsert, or a
+    tombstone for a delete. Pass the returned `cursor` as the next `since`
+    until `has_more` is false.
+
+    A deleted company, department or stat title also deletes its children.
+
+    A page ends before the first entry younger than CHANGE_FEED_LAG, as
+    transactions still running may commit entries with lower ids. Entries
+    of a transaction that runs longer than the lag, e.g. a large bulk
+    update or import, may still commit below a cursor already returned and
+    be missed.
+    """
+    query = ChangesQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    since = query.validated_data['since']
+    limit = query.validated_data.get('limit', settings.CHANGE_FEED_PAGE_SIZE)
+    settled = timezone.now() - datetime.timedelta(seconds=settings.CHANGE_FEED_LAG)
+    entries = ChangeLog.objects.filter(pk__gt=since)
+    # `changed` is set before the INSERT, so it does not grow with the id
+    unsettled = entries.filter(changed__gt=settled).order_by('pk').values_list('pk', flat=True).first()
+    if unsettled is not None:
+        entries = entries.filter(pk__lt=unsettled)
+    entries = list(entries.values_list('pk', 'model', 'object_id', 'action')[:limit + 1])
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    # only the last change of a row matters, its current state is sent
+    latest = {}
+    for cursor, model_name, object_id, change_action in entries:
+        latest.pop((model_name, object_id), None)
+        latest[model_name, object_id] = (cursor, change_action)
+    upserts = {}
+    for (model_name, object_id), (cursor, change_action) in latest.items():
+        if change_action == ChangeLog.UPSERT:
+            upserts.setdefault(model_name, []).append(object_id)
+    rows = {}
+    for model_name, ids in upserts.items():
+        for row in CHANGE_FEED_MODELS[model_name].objects.filter(pk__in=ids).values():
+            rows[model_name, row['id']] = row
+
+    changes = []
+    for (model_name, object_id), (cursor, change_action) in latest.items():
+        change = {'cursor': cursor, 'model': model_name, 'id': object_id, 'action': change_action}
+        if change_action == ChangeLog.UPSERT:
+            if (model_name, object_id) not in rows:
+                # deleted since, its tombstone comes later
+                continue
+            change['data'] = rows[model_name, object_id]
+        changes.append(change)
+    return Response({
+        'changes': changes,
+        'cursor': entries[-1][0] if entries else since,
+        'has_more': has_more,
+    })
+
+
+class SparseFieldsetsViewSetMixin:
+    """
+    Pushes the fields picked by `?fields=` / `?omit=` down to the queryset.
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.method in permissions.SAFE_METHODS:
+            queryset = self.get_serializer().optimize_queryset(queryset)
+        return queryset
+
+
+class CompanyViewSet(ActionPermissionsMixin, SparseFieldsetsViewSetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows companies to be viewed or edited.
     """
     queryset = Company.objects.all().order_by('title')
     serializer_class = CompanySerializer
-    # permission_classes = [permissions.IsAuthenticated]
 
-    def get_permissions(self):
+    @action(detail=False, methods=['post'])
+    def tree(self, request, *args, **kwargs):
         """
-        Instantiates and returns the list of permissions that this view requires.
+        Creates or updates companies with their departments and stat titles
+        from `{"companies": [{"title", "slug", "departments": [{..., "stat_titles": [...]}]}]}`.
         """
-        if self.action in ['list', 'retrieve']:
-            permission_classes = [permissions.IsAuthenticated]
-        else:
-            permission_classes = [permissions.IsAdminUser]
-        return [permission() for permission in permission_classes]
+        serializer = OrgTreeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.save())
 
 
-class DepartmentViewSet(viewsets.ModelViewSet):
+class DepartmentViewSet(ActionPermissionsMixin, SparseFieldsetsViewSetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows departments to be viewed or edited.
     """
     queryset = Department.objects.all().order_by('title')
     serializer_class = DepartmentSerializer
 
-    def get_permissions(self):
-        """
-        Instantiates and returns the list of permissions that this view requires.
-        """
-        if self.action in ['list', 'retrieve']:
-            permission_classes = [permissions.IsAuthenticated]
-        else:
-            permission_classes = [permissions.IsAdminUser]
-        return [permission() for permission in permission_classes]
-
     # def perform_create(self, serializer):
     #     company_id = self.kwargs.get('company_id')
     #     company = get_object_or_404(Company, id=company_id)
@@ -174,35 +319,29 @@ class DepartmentViewSet(viewsets.ModelViewSet):
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
     def update(self, request, *args, **kwargs):
-        try:
-            query_dict = request.data
-            item = dict(query_dict.items())
-            department_id = kwargs.get('pk')
-            if not department_id:
-                raise AttributeError
-            Department.objects.filter(id=department_id).update(**item)
-            return Response(status=status.HTTP_200_OK)
-        except AttributeError:
-            return Response(status=status.HTTP_400_BAD_REQUEST)
-
-
-class StatTitleViewSet(viewsets.ModelViewSet):
+        department = self.get_object()
+        serializer = self.get_serializer(department, data=request.data, partial=kwargs.get('partial', False))
+        serializer.is_valid(raise_exception=True)
+        item = serializer.validated_data
+        with transaction.atomic():
+            Department.objects.filter(id=department.id).update(**item)
+            ChangeLog.objects.record(Department, [department.id])
+            if 'company' in item and item['company'].pk != department.company_id:
+                stats = Stat.objects.filter(department_id=department.id)
+                stats.sync_org_keys()
+                ChangeLog.objects.record_queryset(stats)
+                Company.objects.filter(pk__in=[department.company_id, item['company'].pk]).recount()
+            invalidate_org_fragments()
+        return Response(status=status.HTTP_200_OK)
+
+
+class StatTitleViewSet(ActionPermissionsMixin, SparseFieldsetsViewSetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows stat_titles to be viewed or edited.
     """
     queryset = StatTitle.objects.all().order_by('title')
     serializer_class = StatTitleSerializer
 
-    def get_permissions(self):
-        """
-        Instantiates and returns the list of permissions that this view requires.
-        """
-        if self.action in ['list', 'retrieve']:
-            permission_classes = [permissions.IsAuthenticated]
-        else:
-            permission_classes = [permissions.IsAdminUser]
-        return [permission() for permission in permission_classes]
-
     def create(self, request, *args, **kwargs):
         try:
             item = request.data
@@ -217,34 +356,32 @@ class StatTitleViewSet(viewsets.ModelViewSet):
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
     def update(self, request, *args, **kwargs):
-        try:
-            query_dict = request.data
-            item = dict(query_dict.items())
-            id_ = kwargs.get('pk')
-            if not id_:
-                raise AttributeError
-            StatTitle.objects.filter(id=id_).update(**item)
-            return Response(status=status.HTTP_200_OK)
-        except AttributeError:
-            return Response(status=status.HTTP_400_BAD_REQUEST)
-
-
-class StatViewSet(viewsets.ModelViewSet):
+        stat_title = self.get_object()
+        serializer = self.get_serializer(stat_title, data=request.data, partial=kwargs.get('partial', False))
+        serializer.is_valid(raise_exception=True)
+        item = serializer.validated_data
+        with transaction.atomic():
+            StatTitle.objects.filter(id=stat_title.id).update(**item)
+            ChangeLog.objects.record(StatTitle, [stat_title.id])
+            if 'department' in item and item['department'].pk != stat_title.department_id:
+                stats = Stat.objects.filter(title_id=stat_title.id)
+                stats.sync_org_keys()
+                ChangeLog.objects.record_queryset(stats)
+                department_ids = [stat_title.department_id, item['department'].pk]
+                Department.objects.filter(pk__in=department_ids).recount()
+                publish_reload(department_ids)
+            invalidate_org_fragments()
+        return Response(status=status.HTTP_200_OK)
+
+
+class StatViewSet(ActionPermissionsMixin, SparseFieldsetsViewSetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows stats to be viewed or edited.
     """
     queryset = Stat.objects.all().order_by('-date')
     serializer_class = StatSerializer
-
-    def get_permissions(self):
-        """
-        Instantiates and returns the list of permissions that this view requires.
-        """
-        if self.action in ['list', 'retrieve', 'create']:
-            permission_classes = [permissions.IsAuthenticated]
-        else:
-            permission_classes = [permissions.IsAdminUser]
-        return [permission() for permission in permission_classes]
+    filter_backends = [StatFilterBackend]
+    authenticated_actions = ['list', 'retrieve', 'create']
 
     def create(self, request, *args, **kwargs):
         try:
@@ -263,13 +400,47 @@ class StatViewSet(viewsets.ModelViewSet):
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
     def update(self, request, *args, **kwargs):
-        try:
-            query_dict = request.data
-            item = dict(query_dict.items())
-            id_ = kwargs.get('pk')
-            if not id_:
-                raise AttributeError
-            Stat.objects.filter(id=id_).update(**item)
-            return Response(status=status.HTTP_200_OK)
-        except AttributeError:
-            return Response(status=status.HTTP_400_BAD_REQUEST)
+        stat = self.get_object()
+        serializer = self.get_serializer(stat, data=request.data, partial=kwargs.get('partial', False))
+        serializer.is_valid(raise_exception=True)
+        item = dict(serializer.validated_data, updated=timezone.now())
+        with transaction.atomic():
+            title_ids = [stat.title_id]
+            Stat.objects.filter(id=stat.id).update(**item)
+            ChangeLog.objects.record(Stat, [stat.id])
+            if 'title' in item and item['title'].pk != stat.title_id:
+                Stat.objects.filter(id=stat.id).sync_org_keys()
+                title_ids.append(item['title'].pk)
+                # the point leaves the charts of its old stat title
+                publish_reload([stat.department_id])
+            StatTitle.objects.filter(pk__in=title_ids).recount()
+            stat.refresh_from_db()
+            publish_stat(stat, created=False)
+        return Response(status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['patch', 'delete'])
+    def bulk(self, request, *args, **kwargs):
+        """
+        PATCH a list of `{id, ...changes}`, or DELETE by `{"ids": [...]}`
+        or by the list filters, e.g. `?title=1&date_from=2020-04-01`.
+        """
+        if request.method == 'DELETE':
+            return self.bulk_destroy(request)
+        serializer = StatBulkUpdateSerializer(self.get_queryset(), data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        return Response({'updated': serializer.save()})
+
+    def bulk_destroy(self, request):
+        if request.data:
+            serializer = StatBulkDeleteSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            deleted = 0
+            with transaction.atomic():
+                for batch in batched(serializer.validated_data['ids'], settings.STAT_BULK_BATCH_SIZE):
+                    deleted += Stat.objects.filter(pk__in=batch).delete()[0]
+            return Response({'deleted': deleted})
+        if not set(request.query_params) & set(StatFilterBackend.lookups):
+            # never delete everything by accident
+            return Response({'detail': 'Pass ids or at least one filter.'}, status=status.HTTP_400_BAD_REQUEST)
+        deleted, _ = self.filter_queryset(self.get_queryset()).delete()
+        return Response({'deleted': deleted})